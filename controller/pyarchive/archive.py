@@ -1,21 +1,26 @@
 # -*- encoding: utf-8 -*-
 import datetime as dt
-
-try:
-    from cStringIO import StringIO as BytesIO
-except ImportError:
-    from io import BytesIO
 import logging
 import os
-from os import lstat
 import dill
 
-import pycdlib
-
 from .consts import *
 from .file_db import FileDatabase
 from .hash_db import *
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM, HASH_SHA512, check_algorithm
+from .hasher import HASH_BACKEND_AUTO
 from .hash_file_entry import iso9660_dir, HashFileEntry
+from .path_index import path_index_size, write_path_index
+from .project_store import ProjectStore, is_project_store, DISC_BURNED
+from .catalogue import catalogue_size
+from .chunker import CHUNK_MIN_FILE_SIZE
+from .iso_layout import DEFAULT_MARGIN_SECTORS
+from .segmenter import SEGMENT_NEXT_FIT
+from .spanning import max_pieces
+from .iso_builder import ON_MISMATCH_FAIL, IsoPlan, build_iso, iso_filename
+from .pipeline import IsoPipeline
+from .iso_stream import stream_iso
+from .manifests import DEFAULT_SAMPLE_FRACTION, MANIFEST_OFF, import_manifests
 
 
 # import tarfile
@@ -66,22 +71,10 @@ class PyarchiveFilter(logging.Filter):
 
 #!/usr/bin/env python3
 from argparse import ArgumentParser
-from fnmatch import fnmatch
-from os import fsdecode, fsencode, getcwd, lstat, readlink, stat_result
-from pathlib import Path
+from os import fsdecode, fsencode, getcwd, readlink, stat_result
 import re
 
 
-# fnmatch patterns, specifically:
-IMPORT_FILENAME_PATTERNS = [
-    DB_FILENAME,
-    HASH_FILENAME,
-    HASH_FILENAME + ".asc",
-    "*.sha512sum",
-    "*.sha512sum.asc",
-    "DIGESTS",
-    "DIGESTS.asc",
-]
 SURROGATE_ESCAPES = re.compile(r"([\udc80-\udcff])")
 
 ADDED_COLOR = "\033[01;32m"
@@ -90,14 +83,6 @@ MODIFIED_COLOR = "\033[01;31m"
 NO_COLOR = "\033[00m"
 
 
-def find_external_hash_files(path: Path):
-    for dirpath_str, _, filenames in walk(str(path)):
-        dirpath = Path(dirpath_str).absolute()
-        for filename in filenames:
-            if any(fnmatch(filename, pattern) for pattern in IMPORT_FILENAME_PATTERNS):
-                yield dirpath / filename
-
-
 def print_file_list(files):
     for filename in sorted(files):
         printable_filename = SURROGATE_ESCAPES.sub("\ufffd", str(filename))
@@ -123,7 +108,10 @@ def list_dirs(files):
     print()
 
 
-def load_archiver_from_json(filename="archiver.dill"):
+def load_archiver_from_json(filename=ARCHIVER_FILENAME):
+    """Loads an archiver from either a dill pickle or, for a .sqlite file, a ProjectStore"""
+    if is_project_store(filename):
+        return ProjectStore(filename).load()
     with open(filename, "rb") as f:
         # The protocol version used is detected automatically, so we do not
         # have to specify it.
@@ -131,6 +119,20 @@ def load_archiver_from_json(filename="archiver.dill"):
     return archiver
 
 
+def disc_readme(disc_num=None):
+    """The readme file is created fresh for each disc created.  It should consist of specific information about
+    this disc and also information about the archive process.  It is the same length whatever disc_num is."""
+    readme = f"""# Archive File created by www.drummonds.net
+This archive was created {dt.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
+{README_DISC_LINE.format("-" if disc_num is None else disc_num)}
+
+The data for this archive is stored in the directory /DATA.
+There is a catalogue of this archive stored in catalouge.json.  This catalogue has a list of all the files
+archived in this run and on which disc they are stored.  The same catalogue is written to each disc in the 
+archive series."""
+    return readme.encode("utf-8")
+
+
 class Archiver:
     """This holds the information on the archiving project - potentially should keep state over multiple
     invocations.  This means that you do not have to hold in memory a temporary copy of all discs but
@@ -138,33 +140,113 @@ class Archiver:
 
     def __init__(self):
         self.iso_path_root = PurePosixPath("/DATA")
-
-    def save(self, filename="archiver.dill"):
-        with open(filename, "wb") as f:
-            # Pickle the 'data' dictionary using the highest protocol available.
-            dill.dump(self, f, dill.HIGHEST_PROTOCOL)
-
-    def create_file_database(self, usb_path, job_name="new"):
+        self.store = None  # ProjectStore if saved to or loaded from SQLite
+        self.quarantined = {}  # file_hash -> details of files that had changed when their disc was built
+
+    def __getattr__(self, name):
+        """When loaded from a ProjectStore the file and hash databases are only read when first used."""
+        store = self.__dict__.get("store")
+        if store is not None and name in ("file_db", "hash_db"):
+            value = store.load_database(name)
+            setattr(self, name, value)
+            return value
+        raise AttributeError(name)
+
+    def save(self, filename=ARCHIVER_FILENAME):
+        """Saves to a dill pickle or, for a .sqlite file, incrementally to a ProjectStore"""
+        if is_project_store(filename):
+            store = getattr(self, "store", None)
+            if store is None or store.filename != str(filename):
+                store = ProjectStore(filename)
+            store.save(self)
+        else:
+            for name in ("file_db", "hash_db"):  # Make sure anything still in a store is pickled
+                try:
+                    getattr(self, name)
+                except AttributeError:
+                    pass
+            with open(filename, "wb") as f:
+                # Pickle the 'data' dictionary using the highest protocol available.
+                dill.dump(self, f, dill.HIGHEST_PROTOCOL)
+
+    def mark_disc_burned(self, disc_num):
+        """Records that a disc has been written.  This locks the archive against resegmenting."""
+        self.locked = True
+        store = getattr(self, "store", None)
+        if store is not None:
+            store.mark_disc(disc_num, DISC_BURNED)
+        else:
+            if not hasattr(self, "burned_discs"):
+                self.burned_discs = set()
+            self.burned_discs.add(disc_num)
+
+    def create_file_database(
+        self,
+        usb_path,
+        job_name="new",
+        hash_cache=None,
+        verbose=False,
+        scan_threads=None,
+        manifests=MANIFEST_OFF,
+        manifest_sample=DEFAULT_SAMPLE_FRACTION,
+        hash_algorithm=DEFAULT_HASH_ALGORITHM,
+        block_size=None,
+    ):
+        """
+        :param hash_cache: optional HashCache, unchanged files found in it are not read again.  It must be for
+            hash_algorithm.
+        :param scan_threads: number of threads listing directories in parallel, worthwhile on network shares
+        :param manifests: 'off', 'trust' or 'sample' the SHA512SUM and similar manifests in the tree, files given a
+            hash from one are not read again, see manifests.  Off by default as the catalogue hashes are what the
+            archive trusts.
+        :param manifest_sample: fraction of the files of each manifest checked when sampling
+        :param hash_algorithm: algorithm of every hash in the archive, one of hash_algorithms.HASH_ALGORITHMS.
+            Manifests are SHA-512 so they are only used by sha512 archives.
+        :param block_size: if given the CRC32 of each block of this many bytes of each file is worked out as it is
+            hashed and catalogued so that verify_disc can check quickly, see block_digests.  Every file is read so
+            manifests are not used.
+        """
+        check_algorithm(hash_algorithm)
+        if hash_cache is not None and getattr(hash_cache, "algorithm", HASH_SHA512) != hash_algorithm:
+            raise PyArchiveError(f"Hash cache is for {hash_cache.algorithm} but the archive is {hash_algorithm}")
         # Create database
         self.file_db = FileDatabase(usb_path)
+        self.file_db.hash_algorithm = hash_algorithm
+        self.file_db.block_size = block_size or None
+        self.file_db.hash_cache = hash_cache
+        self.file_db.scan_threads = scan_threads
         self.job_name = job_name
         # Check to make sure not overwriting database
         self.file_db.update(
             usb_path
         )  # Scan directory to add files
-        # Need to load the hash files into the Has list
-
-    def convert_to_hash_database(self, verbose=False):
+        if verbose:
+            print(f"Scanned {self.file_db.scan_stats}")
+        if hash_algorithm != HASH_SHA512 or block_size:
+            manifests = MANIFEST_OFF
+        self.file_db.manifest_stats = import_manifests(self.file_db, manifests, manifest_sample)
+        if verbose:
+            print(f"Imported {self.file_db.manifest_stats}")
+
+    def convert_to_hash_database(self, verbose=False, n_jobs=1, backend=HASH_BACKEND_AUTO):
+        """Hashes every file and inverts the file database into a hash database.
+        :param n_jobs: number of hashing processes, 1 hashes in this process and None uses one per core
+        :param backend: 'mmap', 'stream' or 'auto' to choose by file system
+        """
         if not self.is_locked:
-            self.file_db.calculate_file_hash(verbose)
+            if n_jobs == 1:
+                self.file_db.calculate_file_hash(verbose, backend)
+            else:
+                self.file_db.p_calculate_file_hash(verbose, n_jobs, backend)
+            if self.file_db.hash_cache is not None:
+                self.file_db.hash_cache.close()  # Write out new hashes and apply eviction
             # Create database
             self.hash_db = HashDatabase(self.file_db, self.iso_path_root)
         else:
             raise PyArchiveError('Archive locked so cannot calculate hashes')
 
-    def write_iso(self, pretend=False, disc_num=None, job_name="new"):
-        """No ISO file will be created if there are not files in it.  Eg using a disc num that is
-        not being used."""
+    def iso_plan(self, disc_num=None):
+        """Gathers what goes on disc_num into an IsoPlan that build_iso can make into an image."""
         try:
             if disc_num is None and self.hash_db.last_disc_number is not None:
                 raise PyArchiveError("disc_num is None but archive has been segmented")
@@ -172,101 +254,113 @@ class Archiver:
                 raise PyArchiveError(
                     f"disc_num is {disc_num} but archive has not been segmented"
                 )
-            else:
-                # Create ISO file
-                iso = pycdlib.PyCdlib()
-                if disc_num is None:  # Assuming standard is one based.
-                    seqnum = 0
-                else:
-                    seqnum = disc_num
-                iso.new(
-                    interchange_level=3,
-                    udf="2.60",
-                    app_ident_str="PyArchive (C) 2018 drummonds.net",
-                    abstract_file="README.MKD",
-                    set_size=self.last_disc_num,
-                    seqnum=seqnum,
-                )
         except AttributeError:
             raise PyArchiveError(
                 f"Probably have not yet created hash db"
             )
-
-        # The readme file is created fresh for each disc created.  It should consist of specific information about
-        # this disc and also information about the archive process
-        readme = f"""# Archive File created by www.drummonds.net
-This archive was created {dt.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}
-
-The data for this archive is stored in the directory /DATA.
-There is a catalogue of this archive stored in catalouge.json.  This catalogue has a list of all the files
-archived in this run and on which disc they are stored.  The same catalogue is written to each disc in the 
-archive series."""
-        readme_bytes = readme.encode("utf-8")
-        iso.add_fp(
-            BytesIO(readme_bytes),
-            len(readme_bytes),
-            "/README.MKD;1",
-            udf_path="/README.MKD",
-        )
-        iso.add_file(
-            str("catalogue.json"),
-            "/CATALOGUE.JSON;1",
-            udf_path="/catalogue.json"  # Same catalogue for each disc
-            # So that you can go to single disc and then find where to go next - which disc to read rather than
-            # having to read all the files.
+        chunks = getattr(self.hash_db, "chunks", None)
+        if chunks and not self.is_segmented:
+            raise PyArchiveError("Chunked files are placed on discs by segment, segment the archive first")
+        self.write_path_index()
+        plan = IsoPlan(
+            disc_num,
+            self.last_disc_num if self.is_segmented else 1,  # pycdlib needs a set size for a single disc
+            disc_readme(disc_num),
+            os.path.abspath("catalogue.json"),
+            os.path.abspath(PATH_INDEX_FILENAME),
+            self.hash_db.segment_size if self.is_segmented else None,
+            getattr(self.hash_db, "hash_algorithm", DEFAULT_HASH_ALGORITHM),
         )
-        # Todo add_file which says which disc this is in which catalogue
-
-        # iso.add_directory(str(self.iso_path_root), udf_path=str(self.iso_path_root))
-        # iso.add_directory(
-        #     str(self.iso_path_root) + "/TESTDIR",
-        #     udf_path=str(self.iso_path_root) + "/testDir",
-        # )
-        dir_count = 0
         for this_dir in self.hash_db.hash_entries.dir_entries(disc_num=disc_num):
-            # Todo add Bridge format and iso9660
-            # iso.add_directory(iso9660_dir(this_dir), udf_path=this_dir)
-            # After 10^8 directories (which breaks a standard ISO 9660 the formatting will vary
-            if this_dir == "/DATA":
-                iso.add_directory(
-                    "/DATA", udf_path="/DATA"
-                )  # Add root data directory to both ISO and UDF
-            else:
-                iso.add_directory(
-                    f"/DATA/{dir_count:08}", udf_path=this_dir
-                )  # Note can't use "/" as ISO 9660 root as we are adding
-                # a directory and this would only be the root
-            dir_count += 1
-        any_files = False
-        file_count = 0
+            plan.add_directory(this_dir)
         for this_file in self.hash_db.files(disc_num=disc_num):
-            # Todo add Bridge format and iso9660
-            # iso.add_file(
-            #     str(this_file.filename),
-            #     this_file.iso9660_path,
-            #     udf_path=str(this_file.udf_absolute_path),
-            # )
-            iso.add_file(
-                str(this_file.file_system_path),
-                f"/DATA/{file_count:08}",  # All data files in same directory and anonymise names :(
-                udf_path=str(this_file.udf_absolute_path),
-            )
-            any_files = True
-            file_count += 1
-        if (
-            not pretend and any_files
-        ):  # Will not write out a cataloge with no files in it
-            if disc_num is None:
-                filename = f"{job_name}.iso"
+            if this_file.chunks is not None:  # Its chunks are added below
+                continue
+            if this_file.pack is not None:
+                plan.add_packed_file(
+                    this_file.pack,
+                    str(this_file.file_system_path),
+                    this_file.pack_offset,
+                    this_file.size,
+                    this_file.file_hash,
+                )
             else:
-                filename = f"{job_name}_{disc_num:04}.iso"
-            # If file exists then iso.write will just overwrite part of it so need to delete it first.
-            try:
-                os.remove(filename)
-            except FileNotFoundError:
-                pass
-            iso.write(filename)
-            iso.close()
+                plan.add_file(
+                    str(this_file.file_system_path),
+                    str(this_file.udf_absolute_path),
+                    this_file.size,
+                    this_file.file_hash,
+                )
+        if chunks:
+            self._add_chunks(plan, disc_num)
+        return plan
+
+    def _add_chunks(self, plan, disc_num):
+        """Adds the chunks on disc_num to plan, each read from the first chunked file that holds it"""
+        chunks = self.hash_db.chunks
+        wanted = {file_hash for file_hash, chunk in chunks.items() if chunk.disc_num == disc_num}
+        if not wanted:
+            return
+        data_root = str(self.iso_path_root)
+        if data_root not in plan.directories:
+            plan.directories.insert(0, data_root)  # Chunks are packed in the data root
+        for entry in self.hash_db.files():
+            if not wanted:
+                break
+            if entry.chunks is None:
+                continue
+            offset = 0
+            for chunk_hash in entry.chunks:
+                chunk = chunks[chunk_hash]
+                if chunk_hash in wanted:
+                    wanted.discard(chunk_hash)
+                    plan.add_packed_file(
+                        chunk.pack, str(entry.file_system_path), chunk.pack_offset, chunk.size, chunk_hash, offset
+                    )
+                offset += chunk.size
+
+    def write_iso(
+        self, pretend=False, disc_num=None, job_name="new", stream_to=None, progress=None, on_mismatch=ON_MISMATCH_FAIL
+    ):
+        """No ISO file will be created if there are not files in it.  Eg using a disc num that is
+        not being used.
+        :param stream_to: pipe, FIFO path or other binary file to stream the image into instead of writing
+            job_name_NNNN.iso, see iso_stream
+        :param progress: called with (bytes done, total bytes) while streaming
+        :param on_mismatch: 'fail' to stop if a file no longer matches its hash or 'quarantine' to write it and
+            record it in quarantined
+        """
+        plan = self.iso_plan(disc_num)
+        quarantined = []
+        try:
+            if stream_to is not None and not pretend:
+                return stream_iso(plan, stream_to, progress=progress, on_mismatch=on_mismatch, quarantined=quarantined)
+            return build_iso(plan, iso_filename(job_name, disc_num), pretend, on_mismatch, quarantined)
+        finally:
+            for source, file_hash, actual_hash in quarantined:
+                self.quarantine(disc_num, source, file_hash, actual_hash)
+
+    def quarantine(self, disc_num, source, file_hash, actual_hash):
+        """Records that the copy of source on disc_num does not match the catalogue so it must be archived again"""
+        if not hasattr(self, "quarantined"):
+            self.quarantined = {}
+        self.quarantined[file_hash] = {"disc_num": disc_num, "source": str(source), "actual_hash": actual_hash}
+        log.warning(f"Quarantined {source} on disc {disc_num}, it has changed since it was catalogued")
+
+    def iso_pipeline(self, disc_nums=None, job_name="new", **kwargs):
+        """Builds the images of disc_nums (default all discs) in the background, see IsoPipeline"""
+        if disc_nums is None:
+            disc_nums = range(self.last_disc_num + 1)
+        return IsoPipeline(self, disc_nums, job_name, **kwargs)
+
+    def write_path_index(self):
+        """Writes the path index next to the catalogue unless it is already newer than the catalogue"""
+        try:
+            if os.stat(PATH_INDEX_FILENAME).st_mtime >= os.stat(DB_FILENAME).st_mtime:
+                return
+        except FileNotFoundError:
+            pass
+        write_path_index(self.hash_db, PATH_INDEX_FILENAME)
 
     @property
     def is_locked(self):
@@ -277,12 +371,36 @@ archive series."""
         except AttributeError:  # NO hash db so not segmented
             return False
 
-    def segment(self, size):
+    def chunk_files(self, min_file_size=CHUNK_MIN_FILE_SIZE, n_jobs=1, verbose=False):
+        """Splits the files of at least min_file_size bytes into chunks so that near copies share their data on disc,
+        see chunker.  Segment afterwards.  Returns (bytes of the files chunked, bytes of their distinct chunks)."""
+        if self.is_locked:
+            raise PyArchiveError("Archive is locked so cannot chunk files")
+        return self.hash_db.chunk_files(min_file_size, n_jobs, verbose)
+
+    def segment(self, size, strategy=SEGMENT_NEXT_FIT, margin=DEFAULT_MARGIN_SECTORS, pack_threshold=0, span_min=0):
+        """Allocates every file to a disc, see segmenter for the strategies.
+        The README, catalogue and path index on every disc are allowed for exactly, the catalogue at the size it
+        will be once segmented.  Files smaller than pack_threshold are packed a directory at a time, see iso_layout.
+        A file too big for a disc is spanned over several, as are files cut to top up a disc if span_min is given,
+        see spanning.  Returns the bytes used on each disc."""
         if not self.is_locked:
-            catalogue_size = (
-                (2048 + lstat(str(str("catalogue.json"))).st_size) // 2048
-            ) * 2048  # Account for sector size
-            self.hash_db.segment(size, catalogue_size)
+            self.hash_db.unspan()
+            disc_size = interpret_disc_capacity(size)
+            data_size = sum(entry.size for entry in self.hash_db.files())
+            max_disc_num = 2 * (data_size // disc_size + 1)  # Much more than any strategy will use
+            packable = self.hash_db.packable(pack_threshold)
+            pieces = max_pieces(
+                (entry.size for entry in self.hash_db.files() if entry.chunks is None),
+                disc_size,
+                max_disc_num if span_min else 0,
+            )
+            root_files = [
+                (README_FILENAME, len(disc_readme())),
+                ("catalogue.json", catalogue_size(self.hash_db, disc_size, size, max_disc_num, packable, pieces)),
+                (PATH_INDEX_FILENAME, path_index_size(self.hash_db)),
+            ]
+            return self.hash_db.segment(size, root_files, strategy, margin, pack_threshold, packable, span_min)
         else:
             raise PyArchiveError('Archive is locked so cannot resegment')
 
@@ -296,9 +414,13 @@ archive series."""
     def get_info(self):
         """Returns summary information on archive"""
         try:
-            return self.hash_db.get_info()
+            result = self.hash_db.get_info()
         except:
-            return self.file_db.get_info()
+            result = self.file_db.get_info()
+        quarantined = getattr(self, "quarantined", {})
+        if quarantined:
+            result += f"Quarantined files, changed since catalogued = {len(quarantined):,}\n"
+        return result
 
     def print_files(self):
         self.file_db.print_files()
@@ -315,6 +437,6 @@ archive series."""
     def get_all_disc_info(self):
         """Returns summary information on all discs"""
         result = ''
-        for i in range(self.last_disc_num):
+        for i in range(self.last_disc_num + 1):
             result += self.get_disc_info(i)
         return result
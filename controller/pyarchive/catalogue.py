@@ -0,0 +1,255 @@
+"""Streaming writer and reader for catalogue.json.
+
+The writer emits one entry at a time straight to the file so memory use does not grow with the size of the
+catalogue.  The layout is the same as before, an object with the entries under "files" keyed by hash and sorted
+by hash, so older readers (and json.load) still work.  If large files have been chunked (see chunker) where each
+chunk is follows under "chunks", also keyed by hash.
+
+The reader is an incremental parser for just this shape of document.  It yields one (file_hash, entry dict) at a
+time and never holds more than a read buffer and a single entry, so a catalogue can be loaded back into a
+HashDatabase or searched without parsing the whole document in one go.
+"""
+import json
+import os
+from pathlib import Path
+import re
+
+from .consts import *
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM
+from .iso_layout import PACK_MAX_SIZE, pack_path
+
+READ_CHUNK_SIZE = 1024 * 1024
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+
+def _indent(text, prefix):
+    return text.replace("\n", "\n" + prefix)
+
+
+def write_entries(f, entries, indent="    ", disc_num=None):
+    """Writes the "files" object, each entry of the HashFileEntries sorted by hash, to text file f.
+    :param disc_num: if not None written as the disc number of every entry, see catalogue_size
+    """
+    f.write("{")
+    for i, file_hash in enumerate(sorted(entries.keys())):
+        entry = entries[file_hash]
+        data = entry.to_catalogue_dict()
+        if disc_num is not None:
+            data["disc_num"] = disc_num
+        f.write(",\n" if i else "\n")
+        f.write(f"{indent}    {json.dumps(file_hash)}: ")
+        f.write(_indent(json.dumps(data, ensure_ascii=False, indent=4), indent + "    "))
+    f.write(f"\n{indent}}}" if entries else "}")
+
+
+def write_chunks(f, chunks, indent="    ", disc_num=None, pack=None):
+    """Writes the "chunks" object, where each Chunk is keyed by hash, to text file f.
+    :param disc_num: if not None written as the disc number of every chunk, see catalogue_size
+    :param pack: if not None (pack, offset) written as the pack of every chunk
+    """
+    f.write("{")
+    for i, file_hash in enumerate(sorted(chunks.keys())):
+        data = chunks[file_hash].to_catalogue_dict()
+        if disc_num is not None:
+            data["disc_num"] = disc_num
+        if pack is not None:
+            data["pack"], data["pack_offset"] = pack
+        f.write(",\n" if i else "\n")
+        f.write(f"{indent}    {json.dumps(file_hash)}: {json.dumps(data, ensure_ascii=False)}")
+    f.write(f"\n{indent}}}" if chunks else "}")
+
+
+def _write_document(f, entries, header, disc_num=None, chunks=None, pack=None):
+    f.write('{\n    "files": ')
+    write_entries(f, entries, disc_num=disc_num)
+    if chunks:
+        f.write(',\n    "chunks": ')
+        write_chunks(f, chunks, disc_num=disc_num, pack=pack)
+    for key in sorted(header):
+        f.write(f",\n    {json.dumps(key)}: {json.dumps(header[key], ensure_ascii=False)}")
+    f.write("\n}\n")
+
+
+def write_catalogue(hash_db, filename):
+    """Writes the catalogue of hash_db to filename.  It is written to a temporary file first so that a failure
+    part way through does not leave a truncated catalogue."""
+    filename = Path(filename)
+    temp_name = filename.with_name(filename.name + ".tmp")
+    with temp_name.open("w", encoding="utf-8") as f:
+        _write_document(f, hash_db.hash_entries, catalogue_header(hash_db), chunks=getattr(hash_db, "chunks", None))
+    os.replace(str(temp_name), str(filename))
+
+
+class _ByteCounter:
+    """Text file which only counts the UTF-8 bytes written to it"""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text.encode("utf-8"))
+
+
+def _pack_fields_size(entry, indent="    "):
+    """Most bytes that the pack fields add to the catalogue entry of a packed file"""
+    fields = {"pack": pack_path(entry.directory, 9999), "pack_offset": PACK_MAX_SIZE}
+    prefix = ",\n" + indent + "        "
+    return sum(
+        len((prefix + json.dumps(key) + ": " + json.dumps(value, ensure_ascii=False)).encode("utf-8"))
+        for key, value in fields.items()
+    )
+
+
+def _span_size(pieces, max_disc_num, segment_size, data_root, indent="    "):
+    """Most bytes that spanning files into pieces pieces in all adds to the catalogue: a chunk for each piece, its
+    hash in the chunks of its file and at worst a list of chunks for each file"""
+    data = {
+        "disc_num": max_disc_num,
+        "pack": pack_path(data_root, 9999),
+        "pack_offset": PACK_MAX_SIZE,
+        "size": segment_size,
+    }
+    file_hash = json.dumps("0" * 128)
+    chunk = len(f",\n{indent}    {file_hash}: {json.dumps(data, ensure_ascii=False)}".encode("utf-8"))
+    listed = len(f",\n{indent * 4}{file_hash}")
+    chunk_list = len(f',\n{indent * 3}"chunks": [\n{indent * 3}]')
+    return len(f',\n{indent}"chunks": {{\n{indent}}}') + pieces * (chunk + listed + chunk_list)
+
+
+def catalogue_size(hash_db, segment_size=None, disc_size=None, max_disc_num=None, packable=None, pieces=0):
+    """Bytes that write_catalogue would write for hash_db.
+    Given the segmenting parameters it is the size once hash_db is segmented, taking every disc number to be as
+    long as max_disc_num, so that segment can reserve space for the catalogue before the discs are known.
+    :param packable: DiscLayout test of which entries will be packed, their pack fields are allowed for
+    :param pieces: most pieces that files will be spanned into, see spanning
+    """
+    header = catalogue_header(hash_db)
+    pack = None
+    if max_disc_num is not None:
+        header["segment_size"] = segment_size
+        header["disc_size"] = disc_size
+        header["last_disc_number"] = max_disc_num
+        pack = pack_path(str(hash_db.iso_path_root), 9999), PACK_MAX_SIZE
+    counter = _ByteCounter()
+    _write_document(
+        counter, hash_db.hash_entries, header, disc_num=max_disc_num, chunks=getattr(hash_db, "chunks", None), pack=pack
+    )
+    if packable is not None:
+        counter.size += sum(_pack_fields_size(entry) for entry in hash_db.files() if packable(entry))
+    if pieces:
+        counter.size += _span_size(pieces, max_disc_num, segment_size, str(hash_db.iso_path_root))
+    return counter.size
+
+
+def catalogue_header(hash_db):
+    """The values other than "files" which are written at the top level of the catalogue"""
+    header = {
+        "version": hash_db.version,
+        "hash_algorithm": getattr(hash_db, "hash_algorithm", DEFAULT_HASH_ALGORITHM),
+    }
+    if getattr(hash_db, "block_size", None):
+        header["block_size"] = hash_db.block_size
+    if hash_db.is_segmented:
+        header["segment_size"] = hash_db.segment_size
+        header["disc_size"] = hash_db.str_catalogue_size
+        header["last_disc_number"] = hash_db.last_disc_number
+    return header
+
+
+class CatalogueReader:
+    """Iterates over the entries of a catalogue.json file as (file_hash, entry dict).
+    Top level values other than "files" are put in self.header as they are met, so they are all there once the
+    iteration has finished.
+    """
+
+    def __init__(self, f, chunk_size=READ_CHUNK_SIZE):
+        """
+        :param f: catalogue opened in text mode
+        """
+        self.f = f
+        self.chunk_size = chunk_size
+        self.header = {}
+        self._text = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+        self._text = self._text[self._pos:] + chunk
+        self._pos = 0
+
+    def _skip_whitespace(self):
+        while True:
+            self._pos = _WHITESPACE.match(self._text, self._pos).end()
+            if self._pos < len(self._text) or self._eof:
+                return
+            self._fill()
+
+    def _next_char(self):
+        """Consumes and returns the next non whitespace character, '' at the end of the file"""
+        self._skip_whitespace()
+        if self._pos >= len(self._text):
+            return ""
+        self._pos += 1
+        return self._text[self._pos - 1]
+
+    def _peek(self):
+        self._skip_whitespace()
+        return self._text[self._pos : self._pos + 1]
+
+    def _expect(self, expected):
+        found = self._next_char()
+        if found != expected:
+            raise PyArchiveError(f"Catalogue is not valid, expected '{expected}' but found '{found}'")
+
+    def _value(self):
+        """Decodes the next JSON value, reading more of the file until the whole value is in the buffer"""
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._text, self._pos)
+                if end < len(self._text) or self._eof:  # A number at the end of the buffer may be cut short
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self._eof:
+                    raise PyArchiveError(f"Catalogue is not valid: {e}")
+            self._fill()
+
+    def __iter__(self):
+        self._expect("{")
+        if self._peek() == "}":
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == "files":
+                self._expect("{")
+                if self._peek() == "}":
+                    self._next_char()
+                else:
+                    while True:
+                        file_hash = self._value()
+                        self._expect(":")
+                        yield file_hash, self._value()
+                        separator = self._next_char()
+                        if separator == "}":
+                            break
+                        elif separator != ",":
+                            raise PyArchiveError(f"Catalogue is not valid, found '{separator}' after {file_hash}")
+            else:
+                self.header[key] = self._value()
+            separator = self._next_char()
+            if separator == "}":
+                return
+            elif separator != ",":
+                raise PyArchiveError(f"Catalogue is not valid, found '{separator}' after {key}")
+
+
+def read_catalogue(filename=DB_FILENAME):
+    """Yields (file_hash, entry dict) from a catalogue file"""
+    with open(str(filename), encoding="utf-8") as f:
+        yield from CatalogueReader(f)
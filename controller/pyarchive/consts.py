@@ -3,8 +3,16 @@ import re
 
 # 1: 'version' field added
 # 2: entry 'file_type' field added; symlinks now treated correctly
-DATABASE_VERSION = 1
+# 3: catalogue written by streaming writer; disc_num written for disc 0; segment details in the header
+# 4: small files may be packed, their entries have 'pack' and 'pack_offset' fields
+# 5: large files may be chunked, their entries list 'chunks' which are found in the top level 'chunks'
+# 6: 'hash_algorithm' in the header, see hash_algorithms, a catalogue without it is sha512
+# 7: entries may have 'block_crc32', the CRC32s of each 'block_size' (in the header) bytes, see block_digests
+DATABASE_VERSION = 7
 DB_FILENAME = "catalogue.json"
+CATALOGUE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+PATH_INDEX_FILENAME = "catalogue.idx"
+PATH_INDEX_ISO_NAME = "CATALOGUE.IDX;1"
 
 HASH_FUNCTION = hashlib.sha512
 # Mostly used for importing from saved hash files
@@ -15,8 +23,20 @@ EMPTY_FILE_HASH = (
 
 SHA512_HASH_PATTERN = re.compile(r"^[0-9a-fA-F]{128}$")
 
+README_FILENAME = "README.MKD"
+# Line of README.MKD saying which disc it is on, the same length for every disc so segment can allow for it
+README_DISC_LINE = "This is disc {:>8} of the archive series."
+README_DISC_PATTERN = re.compile(r"^This is disc +(\d+) of the archive series\.$", re.MULTILINE)
+
 HASH_FILENAME = "SHA512SUM"
 
+ARCHIVER_FILENAME = "archiver.dill"
+PROJECT_STORE_FILENAME = "archiver.sqlite"
+
+HASH_CACHE_FILENAME = "hash_cache.sqlite"
+HASH_CACHE_MAX_ENTRIES = 10000000
+HASH_CACHE_MAX_AGE_DAYS = 365
+
 
 class PyArchiveError(Exception):
     pass
@@ -0,0 +1,43 @@
+"""Shared table of directory paths so that millions of entries don't each carry a full path string.
+An entry keeps a small integer directory id and its own name; the full path is only built when asked for.
+File names are interned as well as many trees repeat the same names (index.html, Thumbs.db ...).
+"""
+import posixpath
+import sys
+
+
+class DirectoryTable:
+    def __init__(self):
+        self.paths = []  # dir_id -> directory path
+        self.ids = {}  # directory path -> dir_id
+
+    def intern(self, dirpath):
+        """Returns the id of dirpath, adding it if it is new"""
+        try:
+            return self.ids[dirpath]
+        except KeyError:
+            dir_id = len(self.paths)
+            self.paths.append(dirpath)
+            self.ids[dirpath] = dir_id
+            return dir_id
+
+    def split(self, path):
+        """Splits a posix path string into (dir_id, name)"""
+        dirpath, name = posixpath.split(path)
+        return self.intern(dirpath), sys.intern(name)
+
+    def find(self, path):
+        """(dir_id, name) of a posix path string, None if its directory is not in the table"""
+        dirpath, name = posixpath.split(path)
+        dir_id = self.ids.get(dirpath)
+        return None if dir_id is None else (dir_id, name)
+
+    def join(self, dir_id, name):
+        """Returns the posix path string for (dir_id, name)"""
+        return posixpath.join(self.paths[dir_id], name)
+
+    def __getitem__(self, dir_id):
+        return self.paths[dir_id]
+
+    def __len__(self):
+        return len(self.paths)
@@ -5,24 +5,24 @@ This is a temporary structure and although can be preserved by pickle is not int
 So it does not need versioning.
 """
 from collections import OrderedDict
-from pathlib import Path, PurePosixPath
+from pathlib import Path, PurePath, PurePosixPath
 from os import fsdecode, fsencode, getcwd, lstat, readlink, stat_result, getcwd
-from scandir import walk
+from os.path import dirname, join
 from sys import stderr
 
 from .consts import *
 from .hash_file_entry import interpret_disc_capacity
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM
+from .hash_cache import cache_key
+from .hasher import hash_work_item, HashStats, HASH_BACKEND_AUTO
 from .file_entry import FileEntry
+from .scanner import scan_tree, scan_tree_threaded, ScanStats
+from .stats import ArchiveStats
 
-from multiprocessing import Process, Queue
-from math import sqrt
+from operator import itemgetter
+import time
 from joblib import Parallel, delayed
-from multiprocessing import Process, Queue, cpu_count
-
-
-def do_hash(entry):
-    """Make an easy parallel task"""
-    entry.calculate_file_hash()
+from multiprocessing import cpu_count
 
 
 class FileDatabase:
@@ -32,6 +32,11 @@ class FileDatabase:
         self.file_entries = OrderedDict()  # of FileEntry
         self.segment_size = None  # DB is started not segmented
         self.last_disc_number = None  # This starts as a non segmented archive
+        self.hash_cache = None  # Optional HashCache consulted before reading file contents
+        self.hash_algorithm = DEFAULT_HASH_ALGORITHM  # Algorithm of every hash in the archive, see hash_algorithms
+        self.block_size = None  # Block size of the block CRC32s worked out with each hash, see block_digests
+        self.scan_threads = None  # Number of threads listing directories, None for a single threaded scan
+        self._stats = None  # ArchiveStats of the entries, built when first needed
 
     def segment(self, size, catalogue_size=0):
         """
@@ -82,17 +87,27 @@ class FileDatabase:
     def is_segmented(self):
         return self.last_disc_number is not None
 
+    @property
+    def stats(self):
+        """ArchiveStats of the entries, kept up to date by update"""
+        if getattr(self, "_stats", None) is None:  # Also databases pickled before there were statistics
+            self._stats = ArchiveStats(PurePath, ancestors=False)
+            for entry in self.file_entries.values():
+                self._stats.add(entry.size, dirname(entry.path))
+        return self._stats
+
     def _find_changes(self):
         """
         Walks the filesystem. Identifies noteworthy files -- those
         that were added, removed, or changed (size, mtime or type).
 
-        Returns a 3-tuple of sets of FileEntry objects:
-        [0] added files
-        [1] removed files
-        [2] modified files
+        Returns a 3-tuple of FileEntry objects:
+        [0] added files, a list in scan order
+        [1] removed files, a set
+        [2] modified files, a set
 
-        self.entries is not modified; this method only reports changes.
+        self.entries is not modified; this method only reports changes.  The scan rate is left in
+        self.scan_stats.
                 Should make parallel like this
         from joblib import Parallel, delayed
 	import multiprocessing
@@ -111,24 +126,25 @@ class FileDatabase:
         Returns the number of file hashes imported.
 
         """
-        added = set()
+        added = []  # In scan order so that file_entries order is reproducible
         modified = set()
         existing_files = set()
-        for dirpath_str, _, filenames in walk(str(self.path)):
-            dirpath = Path(dirpath_str)
-            for filename in filenames:
-                # Make the assumption the database is never in the path
-                abs_filename = (dirpath / filename).absolute()
-                if abs_filename in self.file_entries:
-                    entry = self.file_entries[abs_filename]
-                    existing_files.add(entry)
-                    st = lstat(str(abs_filename))
-                    if entry != st:
-                        modified.add(entry)
-                else:
-                    entry = FileEntry(self, abs_filename)
-                    entry.update_attrs()
-                    added.add(entry)
+        self.scan_stats = ScanStats()
+        if getattr(self, "scan_threads", None):
+            scan = scan_tree_threaded(str(self.path), self.scan_stats, self.scan_threads)
+        else:
+            scan = scan_tree(str(self.path), self.scan_stats)
+        for dirpath, name, st in scan:
+            # Make the assumption the database is never in the path
+            entry = self.file_entries.get(join(dirpath, name))
+            if entry is not None:
+                existing_files.add(entry)
+                if entry != st:
+                    modified.add(entry)
+            else:
+                entry = FileEntry.from_scan(self, dirpath, name, st)
+                self._lookup_hash(entry)
+                added.append(entry)
         removed = set(self.file_entries.values()) - existing_files
         return added, removed, modified
 
@@ -145,11 +161,13 @@ class FileDatabase:
         if this_path is None:
             this_path = self.path
         added, removed, modified = self._find_changes()
-        for entry in added:
-            entry.update()  # Calculate hash
-            self.file_entries[entry.filename] = entry
+        stats = self.stats
+        for entry in added:  # Attributes were filled in from the scan
+            self.file_entries[entry.path] = entry
+            stats.add(entry.size, dirname(entry.path))
         for entry in removed:
-            del self.file_entries[entry.filename]
+            del self.file_entries[entry.path]
+            stats.remove(entry.size, dirname(entry.path))
         # Entries will appear in 'modified' if the size, mtime or type
         # change. This will not be reliable over time (you need hashes to do that)
         # I've seen a lot of spurious mtime mismatches on vfat
@@ -158,21 +176,26 @@ class FileDatabase:
         content_modified = set()
         for entry in modified:
             old_entry = entry
+            stats.remove(entry.size, dirname(entry.path))
             entry.update()
+            stats.add(entry.size, dirname(entry.path))
+            entry.file_hash = None  # Stale, so rehash or pick up from the cache
+            entry.block_crc32 = None
+            self._lookup_hash(entry)
             if entry != old_entry:
                 content_modified.add(entry)
         return (
-            {entry.filename for entry in added},
-            {entry.filename for entry in removed},
-            {entry.filename for entry in content_modified},
+            {entry.path for entry in added},
+            {entry.path for entry in removed},
+            {entry.path for entry in content_modified},
         )
 
     def status(self):
         added, removed, modified = self._find_changes()
         return (
-            {entry.filename for entry in added},
-            {entry.filename for entry in removed},
-            {entry.filename for entry in modified},
+            {entry.path for entry in added},
+            {entry.path for entry in removed},
+            {entry.path for entry in modified},
         )
 
     def verify(self, verbose_failures=False):
@@ -228,28 +251,15 @@ class FileDatabase:
         return len(self.file_entries)
 
     def get_info(self):
-        """Returns summary information on archive"""
-        count_files = 0
-        size_files = 0
-        disc_nums = set()
+        """Returns summary information on archive from the statistics kept by update"""
+        stats = self.stats
+        count_files = stats.files
+        size_files = stats.bytes
         entries_no_disc = 0
-        for entry in self.files():
-            count_files += 1
-            size_files += entry.size
-            if self.is_segmented:
-                if entry.disc_num is None:
-                    entries_no_disc += 1
-                else:
-                    disc_nums |= {entry.disc_num}
-        max_length = 0
-        longest_dir = ""
-        dirs = set()
-        for this_dir in self.file_entries:
-            dirs = dirs | {this_dir.parent}
-            length = len(Path(this_dir).parts) - 2
-            if length > max_length:
-                longest_dir = this_dir.parent
-                max_length = length
+        if self.is_segmented:
+            entries_no_disc = sum(1 for entry in self.files() if entry.disc_num is None)
+        max_length = stats.max_depth
+        longest_dir = stats.longest_dir
         result = ""
         result += f"Number of files = {count_files:,}\n"
         result += f"Data size       = {size_files:,}\n"
@@ -266,16 +276,77 @@ class FileDatabase:
             result += (
                 f"  {entries_no_disc} entries have not been allocated a disc number and should have been.\n"
             )
-        result += f"Number of dirs  = {len(dirs)}\n"
+        result += f"Number of dirs  = {stats.dir_count}\n"
         result += f"Max dir depth   = {max_length} (on source file system)\n"
         result += f" Dir =: {longest_dir}\n"
         return result
 
+    def _lookup_hash(self, entry):
+        """Fills in the hash of an entry, and its block CRC32s if wanted, from the hash cache if they are there."""
+        if self.hash_cache is not None and getattr(entry, "file_hash", None) is None:
+            file_hash, block_crc32 = self.hash_cache.get_digests(
+                getattr(entry, "cache_key", None), getattr(self, "block_size", None)
+            )
+            if file_hash is not None:
+                entry.file_hash = file_hash
+                entry.block_crc32 = block_crc32
+
+    def _remember_hash(self, entry):
+        """Puts a freshly calculated hash in the hash cache.  The file is stat'ed again so that a file which
+        changed while it was being hashed is not cached against its old key."""
+        if self.hash_cache is not None:
+            key = getattr(entry, "cache_key", None)
+            if key is not None and cache_key(lstat(entry.path)) == key:
+                block_crc32 = getattr(entry, "block_crc32", None)
+                block_size = getattr(self, "block_size", None) if block_crc32 is not None else None
+                self.hash_cache.put(key, entry.file_hash, block_size, block_crc32)
+
+    def _inodes_to_hash(self, stats):
+        """The entries that have no hash yet, after checking the hash cache, grouped by inode so that a file is read
+        once however many hard links it has.  A link to a file which already has a hash is given it.
+        The scanner's (st_dev, st_ino, size, mtime) is the same for every link to a file, it is the cache key.
+        :param stats: HashStats to which the links not read are added
+        :return: list of (entry to read, the other links to the same file)
+        """
+        known = {}  # cache key -> an entry already hashed
+        groups = OrderedDict()  # cache key, or the path of a symlink or if the inode is unknown, -> entries with no hash
+        for entry in self.file_entries.values():
+            self._lookup_hash(entry)
+            key = getattr(entry, "cache_key", None)
+            file_hash = getattr(entry, "file_hash", None)
+            if file_hash is not None:
+                if key is not None:
+                    known[key] = entry
+            else:
+                groups.setdefault(entry.path if key is None else key, []).append(entry)
+        result = []
+        for key, entries in groups.items():
+            if key in known:
+                self._share_hash(known[key], entries, stats)
+            else:
+                result.append((entries[0], entries[1:]))
+        return result
+
+    def _share_hash(self, entry, links, stats):
+        """Gives the hash of entry, and its block CRC32s, to the other hard links to the same file"""
+        for link in links:
+            link.file_hash = entry.file_hash
+            link.block_crc32 = getattr(entry, "block_crc32", None)
+        stats.links += len(links)
+
     # Single Threaded version
-    def calculate_file_hash(self, verbose=False):
+    def calculate_file_hash(self, verbose=False, backend=HASH_BACKEND_AUTO):
+        """
+        :param backend: how files are read, see hasher.  'auto' picks mmap or stream per file system.
+        """
+        self.hash_stats = HashStats()
+        algorithm = getattr(self, "hash_algorithm", DEFAULT_HASH_ALGORITHM)  # Also databases pickled before it
+        block_size = getattr(self, "block_size", None)
         count = 0
-        for entry in self.file_entries.values():
-            entry.calculate_file_hash()
+        for entry, links in self._inodes_to_hash(self.hash_stats):
+            entry.calculate_file_hash(backend, self.hash_stats, algorithm, block_size)
+            self._remember_hash(entry)
+            self._share_hash(entry, links, self.hash_stats)
             count += 1
             if verbose:
                 if (count % 1000) == 0:
@@ -284,10 +355,44 @@ class FileDatabase:
                     print('.', end='', flush=True)
         if verbose and not ((count % 1000) == 0):  # Close off line if part finished
             print(f" {count}", flush=True)
-
-    # Multithreaded version
-    def p_calculate_file_hash(self, verbose=False):
-        """This is a simple version where the whole input queue is built, then processed in parallel to a results queue
-        and then back in a single process the results queue is processed"""
-        Parallel(n_jobs=2)(delayed(do_hash)(entry) for entry in self.file_entries.values())
-
+        if verbose:
+            print(f"Hashed {self.hash_stats}")
+
+    # Multiprocess version
+    def p_calculate_file_hash(self, verbose=False, n_jobs=None, backend=HASH_BACKEND_AUTO):
+        """Hashes every entry using a pool of worker processes.
+        Each work item is just the path and size of a file and each worker returns (path, digest, block CRC32s),
+        which is then merged back into file_entries in this process.  The largest files are sent first so that one
+        big file is not left running on its own at the end.  A file with several hard links is only sent once.
+
+        :param n_jobs: number of worker processes, None for one per core
+        :param backend: how files are read, see hasher
+        """
+        if n_jobs is None:
+            n_jobs = cpu_count()
+        start = time.perf_counter()
+        self.hash_stats = HashStats()
+        algorithm = getattr(self, "hash_algorithm", DEFAULT_HASH_ALGORITHM)
+        block_size = getattr(self, "block_size", None)
+        groups = self._inodes_to_hash(self.hash_stats)
+        links = {str(entry.filename): others for entry, others in groups}
+        work = sorted(
+            ((str(entry.filename), entry.size) for entry, _ in groups),
+            key=itemgetter(1),
+            reverse=True,
+        )
+        results = Parallel(n_jobs=n_jobs, verbose=10 if verbose else 0)(
+            delayed(hash_work_item)(path, size, backend, algorithm, block_size) for path, size in work
+        )
+        for path, file_hash, block_crc32 in results:
+            entry = self.file_entries[path]
+            entry.file_hash = file_hash
+            entry.block_crc32 = block_crc32
+            self._remember_hash(entry)
+            self._share_hash(entry, links[path], self.hash_stats)
+        # Wall clock throughput of the whole pool
+        self.hash_stats.files = len(work)
+        self.hash_stats.bytes = sum(size for _, size in work)
+        self.hash_stats.seconds = time.perf_counter() - start
+        if verbose:
+            print(f"Hashed {self.hash_stats}")
@@ -1,11 +1,13 @@
 from enum import Enum
-from mmap import mmap, ACCESS_READ
 from pathlib import Path, PurePosixPath
 from os import fsencode, lstat, readlink, stat_result
+from os.path import join
 
 from stat import S_ISLNK, S_ISREG
 
 from .consts import *
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM
+from .hasher import calculate_path_digests, HASH_BACKEND_AUTO
 
 
 class FileEntryType(Enum):
@@ -13,25 +15,73 @@ class FileEntryType(Enum):
     TYPE_SYMLINK = 1
 
 
+def entry_type(st):
+    """FileEntryType from an lstat result"""
+    if S_ISLNK(st.st_mode):
+        return FileEntryType.TYPE_SYMLINK
+    # Treat it as a file even if it's missing.
+    return FileEntryType.TYPE_FILE
+
+
 class FileEntry:
     """This represents each file stored.
     It is also meant to deal with:
         - both symlinks and files
         - Building a catalogue before you have the hashes for each file
+    Entries are slotted as there is one per file and there may be millions of them.  The path string is the
+    same object as the entry's key in FileDatabase.file_entries.
     """
 
+    __slots__ = (
+        "parent", "path", "size", "mtime", "type", "_disc_num", "file_hash", "dev", "ino", "mtime_ns", "block_crc32"
+    )
+
     def __init__(
         self, parent, filename, size=None, mtime=None, type=None, disc_num=None
     ):
-        # In memory, "filename" should be an absolute Path
+        # In memory the absolute filename is kept as a string, see the filename property
         self.parent = parent
-        self.filename = filename
+        self.path = str(filename)
         self.size = size
         self.mtime = mtime
         self.type = type
         self._disc_num = None
         self.disc_num = disc_num
 
+    @classmethod
+    def from_scan(cls, parent, dirpath, name, st):
+        """Creates an entry from what the scanner found without stat'ing the file again"""
+        result = cls(parent, join(dirpath, name))
+        result.update_from_stat(st)
+        return result
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):  # (dict, slots) from a default pickle
+            state = state[1]
+        if "filename" in state:  # Pickled before filename was kept as a string
+            state["path"] = str(state.pop("filename"))
+        if state.get("cache_key"):  # Pickled before the stat fields were kept separately
+            state["dev"], state["ino"], _, state["mtime_ns"] = state["cache_key"]
+        for name, value in state.items():
+            if name in self.__slots__:
+                setattr(self, name, value)
+
+    @property
+    def cache_key(self):
+        """Key of this file in a HashCache, None if unknown.  A symlink is hashed by what it points to, which its
+        own lstat doesn't change with, so it has none and is neither cached nor grouped with hard links."""
+        if getattr(self, "ino", None) and getattr(self, "type", None) != FileEntryType.TYPE_SYMLINK:
+            return self.dev, self.ino, self.size, self.mtime_ns
+        return None
+
+    @property
+    def filename(self):
+        """Absolute Path of the file, built on demand"""
+        return Path(self.path)
+
     @property
     def disc_num(self):
         if hasattr(self, "_disc_num"):
@@ -59,43 +109,44 @@ class FileEntry:
                 and self.mtime == other.mtime
                 and (self.type == other.type)
             )
+        elif isinstance(other, stat_result):  # Compare with an lstat of the file
+            return (
+                self.size == other.st_size
+                and self.mtime == other.st_mtime
+                and self.type == entry_type(other)
+            )
         return super().__eq__(other)
 
+    def update_from_stat(self, st):
+        """Sets size, mtime and type from a single lstat result"""
+        self.size, self.mtime = st.st_size, st.st_mtime
+        self.dev, self.ino, self.mtime_ns = st.st_dev, st.st_ino, st.st_mtime_ns
+        self.type = entry_type(st)
+
     def update_attrs(self):
-        s = lstat(str(self.filename))
+        s = lstat(self.path)
         self.size, self.mtime = s.st_size, s.st_mtime
+        self.dev, self.ino, self.mtime_ns = s.st_dev, s.st_ino, s.st_mtime_ns
 
     def update_type(self):
-        if self.filename.is_symlink():
-            self.type = FileEntryType.TYPE_SYMLINK
-        else:
-            # Treat it as a file even if it's missing.
-            self.type = FileEntryType.TYPE_FILE
+        self.type = entry_type(lstat(self.path))
 
     def update(self):
-        self.update_attrs()
-        self.update_type()
+        self.update_from_stat(lstat(self.path))
 
     def __str__(self):
-        return str(self.filename)
+        return self.path
 
     def __hash__(self):
-        return hash(self.filename)
+        return hash(self.path)
 
     @property
     def relative_path(self):
         """Returns relative path to parent directory"""
         return PurePosixPath(self.filename.relative_to(self.parent.path))
 
-    def calculate_file_hash(self):
-        if self.filename.is_file():
-            if lstat(str(self.filename)).st_size > 0:
-                with self.filename.open("rb") as f:
-                    with mmap(f.fileno(), 0, access=ACCESS_READ) as m:
-                        self.file_hash = HASH_FUNCTION(m).hexdigest()
-            else:
-                self.file_hash = EMPTY_FILE_HASH
-        elif self.filename.is_symlink():
-            # The link target will suffice as the "contents"
-            target = readlink(str(self.filename))
-            self.file_hash = HASH_FUNCTION(fsencode(target)).hexdigest()
+    def calculate_file_hash(
+        self, backend=HASH_BACKEND_AUTO, stats=None, algorithm=DEFAULT_HASH_ALGORITHM, block_size=None
+    ):
+        """:param block_size: if given block_crc32 is set to the CRC32s of each block, see block_digests"""
+        self.file_hash, self.block_crc32 = calculate_path_digests(self.filename, backend, stats, algorithm, block_size)
@@ -0,0 +1,143 @@
+"""A persistent cache of file digests so that an unchanged tree is not rehashed on every archive run.
+Entries are keyed on (st_dev, st_ino, size, mtime_ns), so any change to a file, or a different file at the
+same path, misses the cache.  The cache is a small SQLite file which by default lives next to catalogue.json.
+
+Eviction is least recently used: entries that have not been hit for max_age_days are removed and the cache is
+then trimmed to max_entries.
+
+Each hash algorithm has its own table, "hashes" being SHA-512, so one cache serves archives of any algorithm.
+The block CRC32s of a file (see block_digests) are kept with its digest when they were worked out.
+"""
+import sqlite3
+import time
+
+from .consts import *
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM, check_algorithm
+
+
+def cache_key(st):
+    """Returns the cache key for an os.stat_result or None if the file system has no usable inode number
+    (eg FAT on some platforms) in which case the file is never cached."""
+    if not st.st_ino:
+        return None
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class HashCache:
+    def __init__(
+        self,
+        filename=HASH_CACHE_FILENAME,
+        max_entries=HASH_CACHE_MAX_ENTRIES,
+        max_age_days=HASH_CACHE_MAX_AGE_DAYS,
+        algorithm=DEFAULT_HASH_ALGORITHM,
+    ):
+        self.filename = str(filename)
+        self.algorithm = check_algorithm(algorithm)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._pending = []  # New digests not yet written
+        self._touched = []  # Keys that have been hit since the last flush
+
+    def __getstate__(self):
+        """The connection can't be pickled, it is reopened on first use."""
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pending"] = []
+        state["_touched"] = []
+        return state
+
+    @property
+    def table(self):
+        algorithm = getattr(self, "algorithm", DEFAULT_HASH_ALGORITHM)  # Also caches pickled before algorithms
+        return "hashes" if algorithm == DEFAULT_HASH_ALGORITHM else "hashes_" + algorithm.replace("-", "_")
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filename)
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                " dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,"
+                " file_hash TEXT NOT NULL, last_used REAL NOT NULL,"
+                " PRIMARY KEY (dev, ino, size, mtime_ns))"
+            )
+            self._connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table} (last_used)"
+            )
+            columns = {row[1] for row in self._connection.execute(f"PRAGMA table_info({self.table})")}
+            for name, column_type in (("block_size", "INTEGER"), ("block_crc32", "TEXT")):
+                if name not in columns:  # A cache created before block CRC32s
+                    self._connection.execute(f"ALTER TABLE {self.table} ADD COLUMN {name} {column_type}")
+        return self._connection
+
+    def get(self, key, block_size=None):
+        """Returns the cached digest for key or None.  If block_size is given it is only returned if the block
+        CRC32s of that block size were cached with it, see get_digests."""
+        return self.get_digests(key, block_size)[0]
+
+    def get_digests(self, key, block_size=None):
+        """Returns (digest, block CRC32s) cached for key, (None, None) if it isn't cached or if block_size is given
+        and the block CRC32s of that block size weren't cached"""
+        if key is None:
+            return None, None
+        row = self.connection.execute(
+            f"SELECT file_hash, block_size, block_crc32 FROM {self.table}"
+            " WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+            key,
+        ).fetchone()
+        if row is None or (block_size and (row[1] != block_size or row[2] is None)):
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        self._touched.append(key)
+        return row[0], row[2] if block_size else None
+
+    def put(self, key, file_hash, block_size=None, block_crc32=None):
+        if key is not None and file_hash is not None:
+            self._pending.append(key + (file_hash, block_size, block_crc32))
+            if len(self._pending) >= 10000:
+                self.flush()
+
+    def flush(self):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (dev, ino, size, mtime_ns, file_hash, block_size, block_crc32,"
+                " last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (row + (now,) for row in self._pending),
+            )
+            self.connection.executemany(
+                f"UPDATE {self.table} SET last_used=? WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+                ((now,) + key for key in self._touched),
+            )
+        self._pending = []
+        self._touched = []
+
+    def evict(self):
+        """Drop entries which have not been used recently and then the least recently used beyond max_entries."""
+        with self.connection:
+            if self.max_age_days is not None:
+                self.connection.execute(
+                    f"DELETE FROM {self.table} WHERE last_used < ?",
+                    (time.time() - self.max_age_days * 24 * 3600,),
+                )
+            if self.max_entries is not None:
+                self.connection.execute(
+                    f"DELETE FROM {self.table} WHERE rowid IN"
+                    f" (SELECT rowid FROM {self.table} ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def close(self):
+        """Writes out pending entries, applies the eviction policy and closes the file."""
+        if self._connection is not None or self._pending:
+            self.flush()
+            self.evict()
+            self._connection.close()
+            self._connection = None
+
+    def __len__(self):
+        return self.connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
@@ -1,7 +1,8 @@
 from collections import OrderedDict
 from enum import Enum
-import json
 from mmap import mmap, ACCESS_READ
+from multiprocessing import cpu_count
+import os
 from pathlib import Path, PurePosixPath
 from os import fsdecode, fsencode, getcwd, lstat, readlink, stat_result, getcwd
 from os.path import normpath
@@ -13,77 +14,246 @@ except ImportError:
 from stat import S_ISLNK, S_ISREG
 from sys import stderr
 
+from joblib import Parallel, delayed
+
 from .consts import *
 from .file_db import FileDatabase
 from .file_entry import FileEntryType, FileEntry
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM, check_algorithm
+from .catalogue import CatalogueReader, write_catalogue
+from .chunker import CHUNK_MIN_FILE_SIZE, Chunk, chunk_work_item
 from .hash_file_entry import HashFileEntries, HashFileEntry, interpret_disc_capacity
+from .iso_layout import DEFAULT_MARGIN_SECTORS, SECTOR_SIZE, DiscLayout
+from .segmenter import SEGMENT_NEXT_FIT, fill_report, segment_entries
+from .spanning import SpanPiece, Spanner
 
 
 class HashDatabase:
 
-    def __init__(self, file_db: FileDatabase, iso_path_root):
+    def __init__(self, file_db: FileDatabase, iso_path_root, path=None):
+        """
+        :param file_db: FileDatabase whose entries are added, or None to start empty
+        :param path: source path of the files when there is no file_db
+        """
         self.iso_path_root = iso_path_root
         self.db_path = Path(DB_FILENAME)
-        self.hash_entries = HashFileEntries.create(self.iso_path_root, file_db.path)
+        if file_db is not None:
+            path = file_db.path
+        self.hash_entries = HashFileEntries.create(self.iso_path_root, path)
         self.version = DATABASE_VERSION
         self.segment_size = None  # DB is started not segmented
         self.last_disc_number = None  # This starts as a non segmented archive
-        self.update(file_db)
+        self.chunks = None  # file_hash -> Chunk of the chunked files, see chunk_files
+        self.spanned = []  # file_hash of the files segment spanned over discs, their pieces are chunks
+        self.hash_algorithm = DEFAULT_HASH_ALGORITHM
+        self.block_size = None  # Of the block CRC32s of the entries, see block_digests
+        if file_db is not None:
+            self.hash_algorithm = getattr(file_db, "hash_algorithm", DEFAULT_HASH_ALGORITHM)
+            self.block_size = getattr(file_db, "block_size", None)
+            self.update(file_db)
 
     def save(self, catalogue_name=DB_FILENAME):
         """Save the current catalogue to file as a JSON file.
-        It should be possible to reread this file later and recreate this record."""
-        filename = Path(getcwd()) / catalogue_name
-        data = {
-            # Todo If use original path then need to create dynamically the path to match
-            # "OriginalPath": str(self.path),
-            "version": self.version,
-            "files": json.loads(self.hash_entries.to_json()),
-            # List of directories are derived from file paths
-            # List of catalogues as GUID, the first will be this catalogue
-        }
-        with filename.open("w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, sort_keys=True, indent=4)
+        It should be possible to reread this file later and recreate this record, see from_catalogue.
+        The catalogue is streamed to the file one entry at a time."""
+        # Todo If use original path then need to create dynamically the path to match
+        # List of directories are derived from file paths
+        # List of catalogues as GUID, the first will be this catalogue
+        write_catalogue(self, Path(getcwd()) / catalogue_name)
+
+    @classmethod
+    def from_catalogue(cls, filename=DB_FILENAME, iso_path_root=PurePosixPath("/DATA"), path=None):
+        """Reads a catalogue.json, eg from an archive disc, back into a HashDatabase.
+        :param path: where the source files are (or are to be restored to), the catalogue doesn't record it
+        """
+        result = cls(None, iso_path_root, path)
+        with open(str(filename), encoding="utf-8") as f:
+            reader = CatalogueReader(f)
+            for file_hash, data in reader:
+                result.hash_entries[file_hash] = HashFileEntry.from_catalogue_dict(
+                    result.hash_entries, file_hash, data
+                )
+        chunks = reader.header.pop("chunks", None)
+        if chunks is not None:
+            data_root = str(iso_path_root)
+            result.chunks = OrderedDict(
+                (file_hash, Chunk.from_catalogue_dict(file_hash, data, data_root)) for file_hash, data in chunks.items()
+            )
+        result.version = reader.header.get("version", DATABASE_VERSION)
+        result.hash_algorithm = check_algorithm(reader.header.get("hash_algorithm", DEFAULT_HASH_ALGORITHM))
+        result.block_size = reader.header.get("block_size")
+        if "segment_size" in reader.header:
+            result.segment_size = reader.header["segment_size"]
+            result.int_catalogue_size = reader.header["segment_size"]
+            result.str_catalogue_size = reader.header["disc_size"]
+            result.last_disc_number = reader.header["last_disc_number"]
+        return result
 
-    def segment(self, size, catalogue_size):
+    def segment(
+        self,
+        size,
+        root_files,
+        strategy=SEGMENT_NEXT_FIT,
+        margin=DEFAULT_MARGIN_SECTORS,
+        pack_threshold=0,
+        packable=None,
+        span_min=0,
+    ):
         """
         For a catalogue will place each file onto a disc.
         This will overwrite the segments if carrie out repeatedly.
-        :param size:
-        :return:
+        :param size: disc capacity eg 'bd' or a number of bytes
+        :param root_files: (name, size) of the files such as the catalogue written to the root of every disc
+        :param strategy: one of SEGMENT_STRATEGIES, see segmenter
+        :param margin: sectors to leave free on each disc
+        :param pack_threshold: files smaller than this are packed together, see iso_layout, 0 packs nothing
+        :param packable: packable(pack_threshold) if the caller has already made it
+        :param span_min: smallest piece of a file cut to top up a disc, 0 to only span files too big for a disc.  The
+            spanned files are read to hash their pieces, see spanning.
+        :return: list of bytes used on each disc
         """
         self.str_catalogue_size = size
         new_size = interpret_disc_capacity(size)
         self.int_catalogue_size = new_size
         self.segment_size = new_size
-        OVERHEAD = (
-            500000 + catalogue_size
-        )  # This is the number of bytes of overhead that will be used for size of iso file
-        # TODO needs a method to deal more accruately with directory sizes
-        FILE_OVERHEAD = (
-            2048
-        )  # This is the number of bytes of overhead this is allocated for each file in addition
-        # to the actual contents of the file.  Needs to cover directory entries.
-        min_size = OVERHEAD + FILE_OVERHEAD + next(iter(self.files())).size
-        if new_size <= min_size:
-            raise PyArchiveError(f"Disc too small {new_size:,}, cannot fit first file on with overhead {min_size:,}.")
-
-        count = OVERHEAD # Count the number of bytes used
-        self.last_disc_number = 0
+        capacity = new_size // SECTOR_SIZE - margin
+        data_root = str(self.iso_path_root)
+        self.unspan()
+        self.hash_entries.discard_index()  # Every entry moves, rebuild the index in catalogue order afterwards
+        if packable is None:
+            packable = self.packable(pack_threshold)
+
+        def spannable(entry):
+            """Whole files, a symlink being catalogued with the size of the link"""
+            return (
+                isinstance(entry, HashFileEntry)
+                and entry.chunks is None
+                and not packable(entry)
+                and not os.path.islink(entry.file_system_path)
+            )
+
+        algorithm = getattr(self, "hash_algorithm", DEFAULT_HASH_ALGORITHM)
+        spanner = Spanner(spannable, data_root, span_min, algorithm, getattr(self, "chunks", None) or ())
+        discs = segment_entries(
+            self._segment_entries(), capacity, lambda: DiscLayout(root_files, data_root, packable), strategy, spanner
+        )
+        self._span_files(spanner.spanned())
+        chunks = getattr(self, "chunks", None)
+        if chunks:
+            for entry in self.files():
+                if entry.chunks is not None:  # Listed with its first chunk, as restore starts there
+                    entry.disc_num = chunks[entry.chunks[0]].disc_num
+        self.segment_strategy = strategy
+        self.pack_threshold = pack_threshold
+        self.span_min = span_min
+        if pack_threshold or chunks:
+            self.version = DATABASE_VERSION  # Readers must know about packs and chunks
+        self.disc_usage = [disc.size for disc in discs]
+        self.last_disc_number = len(discs) - 1
+        return self.disc_usage
+
+    def _segment_entries(self):
+        """What segment places on discs in catalogue order, each chunked file being replaced by those of its chunks
+        not already placed so that near copies tend to share a disc"""
+        chunks = getattr(self, "chunks", None)
+        if not chunks:
+            return list(self.files())
+        result = []
+        placed = set()
+        for entry in self.files():
+            if entry.chunks is None:
+                result.append(entry)
+                continue
+            for chunk_hash in entry.chunks:
+                if chunk_hash not in placed:
+                    placed.add(chunk_hash)
+                    result.append(chunks[chunk_hash])
+        return result
+
+    def _span_files(self, spanned):
+        """Lists the pieces of each file the segmenter cut, see spanning, as the file's chunks.  A piece left off the
+        discs as the same as another is found by its hash."""
+        if not spanned:
+            return
+        if self.chunks is None:
+            self.chunks = OrderedDict()
+        for entry, pieces in spanned.items():
+            for piece in pieces:
+                if piece.disc_num is not None:
+                    self.chunks[piece.piece_hash] = Chunk(
+                        piece.piece_hash, piece.size, piece.directory, piece.disc_num, piece.pack, piece.pack_offset
+                    )
+            entry.chunks = [piece.piece_hash for piece in pieces]
+            entry.pack, entry.pack_offset = None, None
+            self.spanned.append(entry.file_hash)
+
+    def unspan(self):
+        """Makes the files spanned by segment whole again, dropping the chunks that only they had"""
+        spanned = getattr(self, "spanned", None) or []
+        for file_hash in spanned:
+            if file_hash in self.hash_entries:
+                self.hash_entries[file_hash].chunks = None
+        if spanned and self.chunks:
+            wanted = {chunk_hash for entry in self.files() if entry.chunks for chunk_hash in entry.chunks}
+            for chunk_hash in [chunk_hash for chunk_hash in self.chunks if chunk_hash not in wanted]:
+                del self.chunks[chunk_hash]
+        self.spanned = []
+
+    def packable(self, pack_threshold):
+        """Returns the DiscLayout test of which entries to pack.  A symlink is catalogued with the size of the link
+        rather than of the file it links to so is never packed.  Chunks and the pieces of spanned files are always
+        packed."""
+        small = {
+            entry.file_hash
+            for entry in self.files()
+            if entry.size < pack_threshold and entry.chunks is None and not os.path.islink(entry.file_system_path)
+        }
+        return lambda entry: isinstance(entry, (Chunk, SpanPiece)) or entry.file_hash in small
+
+    def chunk_files(self, min_file_size=CHUNK_MIN_FILE_SIZE, n_jobs=1, verbose=False, **params):
+        """Splits each file of at least min_file_size bytes into content defined chunks, see chunker, so that segment
+        stores each distinct chunk once.  Any earlier chunking is replaced so segment again afterwards.  A file which
+        has changed since it was hashed is left whole.
+        :param n_jobs: number of chunking processes, None for one per core
+        :param params: min_size, max_size and mask_bits of the chunks, see chunker.iter_chunks
+        :return: (bytes of the files chunked, bytes of their distinct chunks)
+        """
+        work = []
+        self.spanned = []
         for entry in self.files():
-            size_on_disc = (
-                (2048 + entry.size) // 2048
-            ) * 2048 + FILE_OVERHEAD
-            if (count + size_on_disc) >= self.segment_size:
-                # If too big to fit file in segment then start a new disc
-                count = OVERHEAD
-                self.last_disc_number += 1
-            # Only add
-            entry.disc_num = self.last_disc_number
-            count += size_on_disc
-            if count > self.segment_size:
-                # if file is too big to fit on a single disc with overhad
-                raise PyArchiveError(f"Disc too small {new_size:,}, cannot fit file {entry.filename} on disc {self.last_disc_number} with overhead {count:,}.")
+            entry.chunks = None
+            if entry.size >= min_file_size and not os.path.islink(entry.file_system_path):
+                work.append((str(entry.file_system_path), entry.file_hash))
+        algorithm = getattr(self, "hash_algorithm", DEFAULT_HASH_ALGORITHM)
+        if n_jobs == 1:
+            results = (chunk_work_item(path, file_hash, algorithm, **params) for path, file_hash in work)
+        else:
+            results = Parallel(n_jobs=n_jobs or cpu_count(), verbose=10 if verbose else 0)(
+                delayed(chunk_work_item)(path, file_hash, algorithm, **params) for path, file_hash in work
+            )
+        data_root = str(self.iso_path_root)
+        self.chunks = OrderedDict()
+        chunked = 0
+        for file_hash, actual_hash, chunks in results:
+            entry = self.hash_entries[file_hash]
+            if actual_hash != file_hash:
+                stderr.write(f"{entry.file_system_path} has changed since it was hashed so is not chunked\n")
+                continue
+            entry.chunks = [chunk_hash for chunk_hash, _ in chunks]
+            chunked += entry.size
+            for chunk_hash, size in chunks:
+                if chunk_hash not in self.chunks:
+                    self.chunks[chunk_hash] = Chunk(chunk_hash, size, data_root)
+        return chunked, sum(chunk.size for chunk in self.chunks.values())
+
+    def fill_report(self):
+        """Text report of how full each disc is, empty if not segmented by this version"""
+        disc_usage = getattr(self, "disc_usage", None)
+        if not self.is_segmented or not disc_usage:
+            return ""
+        return f"Disc fill ({getattr(self, 'segment_strategy', SEGMENT_NEXT_FIT)}):\n" + fill_report(
+            disc_usage, self.segment_size
+        )
 
     @property
     def is_segmented(self):
@@ -147,39 +317,24 @@ class HashDatabase:
             self.hash_entries.add_hash_file(entry)
 
     def files(self, disc_num=None):
-        for entry in self.hash_entries.values():
-            if disc_num is None:  # without a disc num specification return all files
-                yield entry
-            elif entry.disc_num == disc_num:  # only get entries for this disc_num
-                yield entry
+        if disc_num is None:  # without a disc num specification return all files
+            yield from self.hash_entries.values()
+        else:  # only get entries for this disc_num
+            yield from self.hash_entries.disc_entries(disc_num)
 
     def get_info(self, for_disc_num = None):
-        """Returns summary information on archive"""
-        count_files = 0
-        size_files = 0
-        disc_nums = set()
-        entries_no_disc = 0
-        largest_file = 0
-        for entry in self.files():
-            if for_disc_num is None or entry.disc_num is None or for_disc_num == entry.disc_num:
-                count_files += 1
-                size_files += entry.size
-                if self.is_segmented:
-                    if entry.disc_num is None:
-                        entries_no_disc += 1
-                    else:
-                        disc_nums |= {entry.disc_num}
-                if entry.size > largest_file:
-                    largest_file = entry.size
-        max_length = 0
-        longest_dir = ""
-        dirs = set()
-        for this_dir in self.hash_entries.dir_entries():
-            dirs = dirs | {this_dir}
-            length = len(Path(this_dir).parts) - 1
-            if length > max_length:
-                longest_dir = this_dir
-                max_length = length
+        """Returns summary information on archive, or on a single disc.  This is read from statistics kept up to
+        date as the archive changes rather than by going through the entries."""
+        if for_disc_num is None:
+            stats = self.hash_entries.stats
+        else:
+            stats = self.hash_entries.disc_stats(for_disc_num)
+        count_files = stats.files
+        size_files = stats.bytes
+        largest_file = stats.largest
+        entries_no_disc = self.hash_entries.disc_stats(None).files
+        max_length = stats.max_depth
+        longest_dir = stats.longest_dir
         result = ""
         if for_disc_num is not None:
             result += f'/n>>>>>>>>> Disc {for_disc_num} <<<<<<<<<<<<<<<<\n'
@@ -195,11 +350,16 @@ class HashDatabase:
             else:  # Can only write size
                 result += f"  Disc segment size = {self.int_catalogue_size:,} bytes\n"
             result += f"  Number of discs = {self.last_disc_number+1:,}\n"
+            disc_usage = getattr(self, "disc_usage", None)
+            if disc_usage and for_disc_num is None:
+                result += self.fill_report()
+            elif disc_usage and for_disc_num < len(disc_usage):
+                result += f"  Disc fill = {disc_usage[for_disc_num] / self.segment_size:.2%}\n"
         if entries_no_disc > 0 and self.is_segmented:
             result += (
                 f"  {entries_no_disc} entries have not been allocated a disc number and should have been.\n"
             )
-        result += f"Number of dirs  = {len(dirs)}\n"
+        result += f"Number of dirs  = {stats.dir_count}\n"
         result += f"Max dir depth   = {max_length} (on ISO UDF file system)\n"
         result += f" Dir =: {longest_dir}\n"
         return result
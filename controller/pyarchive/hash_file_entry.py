@@ -1,7 +1,9 @@
 import datetime as dt
+from io import StringIO
 from collections import OrderedDict
 from enum import Enum
 import json
+import posixpath
 from mmap import mmap, ACCESS_READ
 from pathlib import Path, PurePosixPath
 from os import fsdecode, fsencode, getcwd, lstat, readlink, stat_result
@@ -12,6 +14,9 @@ import dill
 from stat import S_ISLNK, S_ISREG
 
 from .consts import *
+from .catalogue import write_entries
+from .dir_table import DirectoryTable
+from .stats import ArchiveStats
 from .tools import mangle_file_for_iso9660, mangle_dir_for_iso9660
 
 
@@ -31,8 +36,7 @@ def interpret_disc_capacity(size):
     elif size_as_text == "dvd":  # DVD-R SL DVD+R is slightly bigger
         return p("4,707,319,808")
     elif size_as_text == "bluray" or size_as_text == "bd":
-        # return p("25,025,314,816   ")  # Theoretical maximum but ISO's are create slightly bigger
-        return p("23,000,000,000   ")  # Try < 99% 99% still too large
+        return p("25,025,314,816")  # segment sizes images exactly so the whole disc can be used
     elif size_as_text == "bd-dl":
         return p("50,050,629,632")
     elif size_as_text == "bd-xl":
@@ -53,8 +57,111 @@ class HashFileEntries(OrderedDict):
         result = cls()
         result.iso_path_root = iso_path_root
         result.path = path
+        result._dir_table = DirectoryTable()
         return result
 
+    def __getstate__(self):
+        """The disc index and statistics are rebuilt when next used rather than pickled"""
+        state = self.__dict__.copy()
+        for name in ("_disc_index", "_disc_stats", "_stats"):
+            state.pop(name, None)
+        return state
+
+    def __setitem__(self, file_hash, entry):
+        old = self.get(file_hash)
+        if old is not None:
+            self._unindex(old)
+            self._count(old, -1)
+        super().__setitem__(file_hash, entry)
+        self._index(entry)
+        self._count(entry, 1)
+
+    def __delitem__(self, file_hash):
+        entry = self[file_hash]
+        self._unindex(entry)
+        self._count(entry, -1)
+        super().__delitem__(file_hash)
+
+    @property
+    def disc_index(self):
+        """disc_num -> {file_hash: entry} of the entries on each disc, in catalogue order, with the entries not
+        yet on a disc under None.  It is built when first used after loading or segmenting and then kept up to date
+        as entries are added, removed or moved to another disc."""
+        if "_disc_index" not in self.__dict__:
+            index = {}
+            disc_stats = {}
+            for file_hash, entry in self.items():
+                index.setdefault(entry.disc_num, {})[file_hash] = entry
+                disc_stats.setdefault(entry.disc_num, ArchiveStats()).add(entry.size, entry.directory)
+            self._disc_index = index
+            self._disc_stats = disc_stats
+        return self._disc_index
+
+    def discard_index(self):
+        """Drops the disc index, eg before every entry is moved to a disc, so it is rebuilt in catalogue order"""
+        self.__dict__.pop("_disc_index", None)
+        self.__dict__.pop("_disc_stats", None)
+
+    def _index(self, entry):
+        index = self.__dict__.get("_disc_index")
+        if index is not None:
+            index.setdefault(entry.disc_num, {})[entry.file_hash] = entry
+            self._disc_stats.setdefault(entry.disc_num, ArchiveStats()).add(entry.size, entry.directory)
+
+    def _unindex(self, entry):
+        index = self.__dict__.get("_disc_index")
+        if index is not None:
+            on_disc = index.get(entry.disc_num)
+            if on_disc is not None and on_disc.get(entry.file_hash) is entry:
+                del on_disc[entry.file_hash]
+                self._disc_stats[entry.disc_num].remove(entry.size, entry.directory)
+                if not on_disc:
+                    del index[entry.disc_num]
+                    del self._disc_stats[entry.disc_num]
+
+    @property
+    def stats(self):
+        """ArchiveStats of all the entries, built when first used and then kept up to date"""
+        if "_stats" not in self.__dict__:
+            stats = ArchiveStats()
+            for entry in self.values():
+                stats.add(entry.size, entry.directory)
+            self._stats = stats
+        return self._stats
+
+    def disc_stats(self, disc_num):
+        """ArchiveStats of the entries on disc disc_num, None for those not on a disc"""
+        self.disc_index  # Builds the statistics of each disc along with the index
+        return self._disc_stats.get(disc_num) or ArchiveStats()
+
+    def _count(self, entry, change):
+        stats = self.__dict__.get("_stats")
+        if stats is not None:
+            if change > 0:
+                stats.add(entry.size, entry.directory)
+            else:
+                stats.remove(entry.size, entry.directory)
+
+    def _move_to_disc(self, entry, disc_num):
+        """Called by HashFileEntry.disc_num to keep the index up to date"""
+        indexed = "_disc_index" in self.__dict__ and self.get(entry.file_hash) is entry
+        if indexed:
+            self._unindex(entry)
+        entry._disc_num = disc_num
+        if indexed:
+            self._index(entry)
+
+    def disc_entries(self, disc_num):
+        """The entries on disc disc_num, None for those not on a disc"""
+        return self.disc_index.get(disc_num, {}).values()
+
+    @property
+    def dir_table(self):
+        """DirectoryTable shared by all the entries for their UDF paths"""
+        if "_dir_table" not in self.__dict__:  # Created before entries shared a table
+            self._dir_table = DirectoryTable()
+        return self._dir_table
+
     def entry_to_path(self, this_entry):
         """ Converts a fileEntry object to an ISO path via relative path
 
@@ -71,12 +178,9 @@ class HashFileEntries(OrderedDict):
         #  Does it already exist
         try:
             existing_entry = self[this_entry.file_hash]  # Look up by File hash
-            if existing_entry.has_file_path(
-                self.entry_to_path(this_entry)
-            ):  # Already is entered then ignore otherwise add to list of directories
-                pass
-            else:
-                existing_entry.add_path(self.entry_to_path(this_entry))
+            existing_entry.add_path(self.entry_to_path(this_entry))  # Ignored if already there
+            if existing_entry.block_crc32 is None:
+                existing_entry.block_crc32 = getattr(this_entry, "block_crc32", None)
         except AttributeError:  # file_hash is not yet defined
             raise PyArchiveError(
                 f"Adding {self.entry_to_path(this_entry)} with no file_hash - run calculate_file_hash()"
@@ -91,6 +195,7 @@ class HashFileEntries(OrderedDict):
                     mtime=this_entry.mtime,
                     catalogue_num=catalogue_num,
                     disc_num=this_entry.disc_num,
+                    block_crc32=getattr(this_entry, "block_crc32", None),
                 )
             else:  # Adding a file without a hash must be an error
                 raise PyArchiveError(
@@ -113,44 +218,61 @@ class HashFileEntries(OrderedDict):
         pass
 
     def to_json(self):
-        header = "{\n"
-        result = ""
-        footer = "}\n"
-        for i, entry in enumerate(self.values()):
-            if i:
-                result += " , "  # Can;t have trailing comma
-            result += entry.to_json_entry() + "\n"
-        return header + result + footer
+        f = StringIO()
+        write_entries(f, self, indent="")
+        return f.getvalue() + "\n"
 
     def dir_entries(self, disc_num=None):
-        """Iterate over all files in the hash entry list and build a dictionary of all of them"""
+        """Returns a dictionary of the UDF directories holding the entries, on disc_num if given.  Parents come before
+        their children."""
         result = {}
-
-        def update_dir_list(udf_path):
-            nonlocal result
-            if str(udf_path) not in result:
-                # Make sure parent is in
-                if len(udf_path.parts) > 2:  # Has parent
-                    update_dir_list(
-                        udf_path.parent
-                    )  # Recursive parent traversal to make sure every
-                    # level of directory is included.
-                result[str(udf_path)] = ""
-
-        for entry in self.values():
-            if disc_num is None or disc_num == entry.disc_num:
-                update_dir_list(
-                    entry.udf_absolute_path.parent
-                )  # Only add parent but do it recursively
-            # else Do not add this directory to this entry
+        seen = set()
+        dir_table = self.dir_table
+        entries = self.values() if disc_num is None else self.disc_entries(disc_num)
+        for entry in entries:
+            if entry.chunks is not None:  # Only its chunks are on a disc, in the data root
+                continue
+            dir_id = entry._dir_id
+            if dir_id in seen:
+                continue
+            seen.add(dir_id)
+            directory = dir_table[dir_id]
+            missing = []
+            while directory not in result:  # Make sure every level of directory is included
+                missing.append(directory)
+                parent = posixpath.dirname(directory)
+                if parent == directory or parent == "/":
+                    break
+                directory = parent
+            for directory in reversed(missing):
+                result[directory] = ""
         return result
 
 
 class HashFileEntry:
     """This represents a single duplicated file.  In can either be in this catalogue or
     in another catalogue.  You cannot create an entry without know the hash of the file.
+
+    Entries are slotted and keep their UDF paths as (directory id, name) in the parent's DirectoryTable as there
+    is one per unique file and there may be millions of them.
     """
 
+    __slots__ = (
+        "parent",
+        "file_hash",
+        "size",
+        "mtime",
+        "_disc_num",
+        "catalogue_num",
+        "_dir_id",
+        "_name",
+        "_more_paths",
+        "pack",
+        "pack_offset",
+        "chunks",
+        "block_crc32",
+    )
+
     def __init__(
         self,
         parent,
@@ -160,12 +282,16 @@ class HashFileEntry:
         mtime=None,
         disc_num=None,
         catalogue_num=None,
+        pack=None,
+        pack_offset=None,
+        chunks=None,
+        block_crc32=None,
     ):
         # In memory, "filename" should be a relative UDF Path
         self.parent = parent  # eg a HashFileEntries
-        self.filenames = {
-            str(filename): {}
-        }  # a UDF absolute path which is stored on a blank catalogue
+        # a UDF absolute path which is stored on a blank catalogue
+        self._dir_id, self._name = parent.dir_table.split(str(filename))
+        self._more_paths = None  # Ordered dict of the (dir_id, name) of any other paths with the same contents
         self.size = size
         self.mtime = mtime
         self.file_hash = file_hash
@@ -175,12 +301,57 @@ class HashFileEntry:
             catalogue_num
         )  # If None or 0 then in this catalogue otherwise in another catalogue
         #  You will need to look up the catalogue number to the GUID of the cataloge at the start of the catalogue
+        self.pack = pack  # UDF path of the pack holding a small file packed by segment, see iso_layout
+        self.pack_offset = pack_offset
+        self.chunks = chunks  # Hashes of the chunks of a file split by HashDatabase.chunk_files, see chunker
+        self.block_crc32 = block_crc32  # CRC32s of each block of the file, see block_digests
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):  # (dict, slots) from a default pickle
+            state = state[1]
+        filenames = state.pop("filenames", None)  # Pickled before paths were kept in the DirectoryTable
+        self.pack, self.pack_offset = None, None  # Pickled before small files were packed
+        self.chunks = None  # Pickled before large files were chunked
+        self.block_crc32 = None  # Pickled before block CRC32s
+        for name, value in state.items():
+            if name in self.__slots__:
+                setattr(self, name, value)
+        if filenames is not None:
+            paths = iter(filenames)
+            self._dir_id, self._name = self.parent.dir_table.split(next(paths))
+            self._more_paths = None
+            for path in paths:
+                self.add_path(path)
+        elif isinstance(self._more_paths, list):  # Pickled when the other paths were a list
+            self._more_paths = dict.fromkeys(self._more_paths)
+
+    @property
+    def filenames(self):
+        """List of the UDF absolute paths (strings) of this file, the first is the one stored on disc"""
+        dir_table = self.parent.dir_table
+        result = [dir_table.join(self._dir_id, self._name)]
+        if self._more_paths:
+            result.extend(dir_table.join(dir_id, name) for dir_id, name in self._more_paths)
+        return result
 
     @property
     def filename(self):
         """This represents the filename on disc of the hash file.  There may be many filenames eg copies, links
         but only one will be stored on disc"""
-        return PurePosixPath(next(iter(self.filenames.keys())))
+        return PurePosixPath(self.parent.dir_table.join(self._dir_id, self._name))
+
+    @property
+    def directory(self):
+        """Directory of filename as a string, without building the full path"""
+        return self.parent.dir_table[self._dir_id]
+
+    @property
+    def name(self):
+        """Last part of filename"""
+        return self._name
 
     @property
     def disc_num(self):
@@ -191,10 +362,10 @@ class HashFileEntry:
 
     @disc_num.setter
     def disc_num(self, disc_num):
-        self._disc_num = disc_num  # Rely on Archive level lock for overwriting
+        self.parent._move_to_disc(self, disc_num)  # Rely on Archive level lock for overwriting
 
     def __str__(self):
-        return f"{self.filename}, {self.hash}"
+        return f"{self.filename}, {self.file_hash}"
 
     @property
     def file_system_path(self):
@@ -229,41 +400,67 @@ class HashFileEntry:
 
         return "/".join(mangled_dirs) + "/" + mangled + ";1"
 
+    def to_catalogue_dict(self):
+        """Returns the entry as it is stored in catalogue.json, the hash being the key.
+        Keys are in alphabetical order but the filenames are not sorted as the first is the one stored on disc."""
+        result = {}
+        if self.block_crc32 is not None and self.chunks is None:  # A chunked file is checked chunk by chunk
+            result["block_crc32"] = self.block_crc32
+        if self.catalogue_num:
+            result["catalogue_num"] = self.catalogue_num
+        if self.chunks is not None:
+            result["chunks"] = self.chunks
+        if self.disc_num is not None:
+            result["disc_num"] = self.disc_num
+        result["filenames"] = {filename: None for filename in self.filenames}
+        result["mtime"] = dt.datetime.fromtimestamp(self.mtime).strftime(CATALOGUE_TIME_FORMAT)
+        if self.pack is not None:
+            result["pack"] = self.pack
+            result["pack_offset"] = self.pack_offset
+        result["size"] = self.size
+        return result
+
+    @classmethod
+    def from_catalogue_dict(cls, parent, file_hash, data):
+        """Recreates an entry from the hash and dict read back from catalogue.json"""
+        filenames = iter(data["filenames"])
+        result = cls(
+            parent,
+            file_hash,
+            next(filenames),
+            size=data["size"],
+            mtime=dt.datetime.strptime(data["mtime"], CATALOGUE_TIME_FORMAT).timestamp(),
+            disc_num=data.get("disc_num"),
+            catalogue_num=data.get("catalogue_num"),
+            pack=data.get("pack"),
+            pack_offset=data.get("pack_offset"),
+            chunks=data.get("chunks"),
+            block_crc32=data.get("block_crc32"),
+        )
+        for filename in filenames:
+            result.add_path(filename)
+        return result
+
     def to_json_entry(self):
         """Returns a string which is the entry in an object
         """
-        filename_list = ""
-        for i, filename in enumerate(self.filenames):
-            if i:
-                filename_list += ", "
-            filename_list += f'"{filename}" : null'
-        if self.disc_num:
-            disc_num = f'    "disc_num" : {self.disc_num},\n'
-        else:
-            disc_num = ""
-        return (
-            f'"{self.file_hash}"'
-            + ": {\n"
-            + '    "filenames" : {\n'
-            + filename_list
-            + "    },"
-            + disc_num
-            + f'    "size" : {self.size},\n'
-            + f'    "mtime" : "{dt.datetime.fromtimestamp(self.mtime).strftime("%Y-%m-%dT%H:%M:%S")}"\n'
-            + "}\n"
-        )
+        return json.dumps(self.file_hash) + ": " + json.dumps(self.to_catalogue_dict(), ensure_ascii=False, indent=4)
 
     def add_path(self, this_path):
-        self.filenames[str(this_path)] = {}
+        """Adds another UDF path with the same contents, unless it is already stored"""
+        key = self.parent.dir_table.split(str(this_path))
+        if key != (self._dir_id, self._name):
+            if self._more_paths is None:
+                self._more_paths = {}
+            self._more_paths[key] = None
 
     def has_file_path(self, this_path):
         """A has file entry has multiple paths this tests if a UDF path has been stored."""
         # TODO should probably test UDF relative path
-        try:
-            a = self.filenames[str(this_path)]
-            return True
-        except KeyError:
-            return False
+        key = self.parent.dir_table.find(str(this_path))
+        return key is not None and (
+            key == (self._dir_id, self._name) or (self._more_paths is not None and key in self._more_paths)
+        )
 
 
 def iso9660_dir(this_dir):
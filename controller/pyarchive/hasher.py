@@ -0,0 +1,213 @@
+"""Hashing of single files.
+This is kept apart from FileEntry so that hashing can be farmed out to worker processes.  A work item is only
+a path and a size and the result is a (path, digest, block CRC32s) tuple, so nothing but strings cross the process
+boundary and the parent merges the digests back into its own entries.  The block CRC32s, see block_digests, are
+only worked out if a block size is given and come from the same read as the hash.
+
+There are two ways of reading a file:
+    mmap   - map the whole file and hand the mapping to the hash function.  Fast on local discs.
+    stream - read fixed size chunks into a reusable buffer with readinto.  Memory use is bounded by the chunk
+             size and it avoids slow page faults on network shares (SMB/NFS).
+The default of "auto" streams from network file systems and maps everything else.
+"""
+from functools import lru_cache
+from mmap import mmap, ACCESS_READ
+import os
+from os import fsencode, readlink
+from pathlib import Path
+import sys
+import threading
+import time
+
+from .consts import *
+from .block_digests import BlockDigests
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM, HASH_BLAKE2B_TREE, TREE_LEAF_SIZE, empty_hash, hash_file, new_hash
+
+HASH_BACKEND_AUTO = "auto"
+HASH_BACKEND_MMAP = "mmap"
+HASH_BACKEND_STREAM = "stream"
+HASH_BACKENDS = (HASH_BACKEND_AUTO, HASH_BACKEND_MMAP, HASH_BACKEND_STREAM)
+
+LOCAL_CHUNK_SIZE = 1024 * 1024
+NETWORK_CHUNK_SIZE = 8 * 1024 * 1024  # Fewer, bigger requests hide the round trip time
+
+NETWORK_FILESYSTEMS = {
+    "9p", "afs", "ceph", "cifs", "davfs", "fuse.sshfs", "glusterfs", "ncpfs", "nfs", "nfs4",
+    "smb", "smb2", "smb3", "smbfs", "remote",
+}
+
+_local = threading.local()  # Holds the read buffer so each thread reuses its own
+
+
+class HashStats:
+    """Accumulates the amount of data hashed so that throughput can be reported"""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.links = 0  # Hard links given the hash of another link to the same file rather than read again
+
+    def add(self, size, seconds):
+        self.files += 1
+        self.bytes += size
+        self.seconds += seconds
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        result = f"{self.files:,} files, {self.bytes:,} bytes in {self.seconds:.1f} s = {self.bytes_per_sec / 1e6:,.1f} MB/s"
+        if getattr(self, "links", 0):  # Also stats pickled before hard links were counted
+            result += f", {self.links:,} hard links not read again"
+        return result
+
+
+@lru_cache(maxsize=1)
+def _mount_table():
+    """Returns list of (mount point, file system type) longest mount point first.  Only Linux has this table."""
+    mounts = []
+    try:
+        with open("/proc/self/mounts", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    mount_point = fields[1].replace("\\040", " ")
+                    mounts.append((mount_point, fields[2]))
+    except OSError:
+        pass
+    return sorted(mounts, key=lambda m: len(m[0]), reverse=True)
+
+
+@lru_cache(maxsize=1024)
+def filesystem_type(directory):
+    """Best guess at the type of file system holding directory (a string).  Returns 'remote' for Windows network
+    drives and 'unknown' when it can't be found out."""
+    directory = os.path.abspath(directory)
+    if sys.platform == "win32":
+        if directory.startswith("\\\\"):  # UNC path
+            return "remote"
+        try:
+            import ctypes
+
+            DRIVE_REMOTE = 4
+            drive = os.path.splitdrive(directory)[0] + "\\"
+            if ctypes.windll.kernel32.GetDriveTypeW(drive) == DRIVE_REMOTE:
+                return "remote"
+        except (AttributeError, OSError):
+            pass
+        return "unknown"
+    for mount_point, fs_type in _mount_table():
+        if directory == mount_point or directory.startswith(mount_point.rstrip("/") + "/"):
+            return fs_type
+    return "unknown"
+
+
+def choose_backend(filename, backend=HASH_BACKEND_AUTO):
+    """Returns (backend, chunk size) to use for filename"""
+    fs_type = filesystem_type(os.path.dirname(str(filename)))
+    chunk_size = NETWORK_CHUNK_SIZE if fs_type in NETWORK_FILESYSTEMS else LOCAL_CHUNK_SIZE
+    if backend == HASH_BACKEND_AUTO:
+        backend = HASH_BACKEND_STREAM if fs_type in NETWORK_FILESYSTEMS else HASH_BACKEND_MMAP
+    elif backend not in HASH_BACKENDS:
+        raise PyArchiveError(f"Unknown hash backend {backend}, expected one of {HASH_BACKENDS}")
+    return backend, chunk_size
+
+
+def read_buffer(chunk_size):
+    """A bytearray of chunk_size which is reused by every file hashed on this thread"""
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None or len(buffer) != chunk_size:
+        buffer = bytearray(chunk_size)
+        _local.buffer = buffer
+    return buffer
+
+
+def open_sequential(filename):
+    """Opens a file unbuffered for a single front to back read and tells the OS about it."""
+    flags = os.O_RDONLY | getattr(os, "O_BINARY", 0) | getattr(os, "O_SEQUENTIAL", 0)  # O_SEQUENTIAL is Windows
+    fd = os.open(str(filename), flags)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return open(fd, "rb", buffering=0)
+
+
+def stream_hash(f, hash_object, chunk_size):
+    """Feeds the whole of the open (unbuffered) file f into hash_object.  Returns the number of bytes read."""
+    view = memoryview(read_buffer(chunk_size))
+    total = 0
+    while True:
+        n = f.readinto(view)
+        if not n:
+            break
+        hash_object.update(view[:n])
+        total += n
+    if hasattr(os, "posix_fadvise"):  # Don't leave an archive's worth of data in the page cache
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    return total
+
+
+def calculate_path_digests(
+    filename: Path, backend=HASH_BACKEND_AUTO, stats=None, algorithm=DEFAULT_HASH_ALGORITHM, block_size=None
+):
+    """Returns (hex digest, block CRC32s) of a file.  For a symlink the link target is hashed rather than the
+    contents and there are no block CRC32s.
+    :param backend: 'mmap', 'stream' or 'auto' to choose by file system
+    :param stats: optional HashStats to which the bytes read and time taken are added
+    :param algorithm: one of hash_algorithms.HASH_ALGORITHMS.  A tree hashed file of more than one leaf is read
+        and hashed by a thread per core whatever the backend.
+    :param block_size: if given the CRC32 of each block of the file is worked out as it is hashed, otherwise the
+        block CRC32s are None
+    """
+    start = time.perf_counter()
+    size = 0
+    crcs = None
+    if filename.is_file():
+        size = filename.stat().st_size  # Follows a symlink to a file, as is_file does
+        if size > TREE_LEAF_SIZE and algorithm == HASH_BLAKE2B_TREE and not TREE_LEAF_SIZE % (block_size or 1):
+            result, crcs = hash_file(filename, size, block_size=block_size)
+        elif size > 0:
+            backend, chunk_size = choose_backend(filename, backend)
+            hash_object = new_hash(algorithm)
+            if block_size:
+                hash_object = BlockDigests(block_size, hash_object)
+            if backend == HASH_BACKEND_STREAM:
+                with open_sequential(filename) as f:
+                    size = stream_hash(f, hash_object, chunk_size)
+            else:
+                with filename.open("rb") as f:
+                    with mmap(f.fileno(), 0, access=ACCESS_READ) as m:
+                        hash_object.update(m)
+                        size = len(m)
+            result = hash_object.hexdigest()
+            if block_size:
+                crcs = hash_object.crc32
+        else:
+            result = empty_hash(algorithm)
+            if block_size:
+                crcs = ""
+    elif filename.is_symlink():
+        # The link target will suffice as the "contents"
+        target = readlink(str(filename))
+        result = new_hash(algorithm, fsencode(target)).hexdigest()
+    else:
+        return None, None
+    if stats is not None:
+        stats.add(size, time.perf_counter() - start)
+    return result, crcs
+
+
+def calculate_path_hash(filename: Path, backend=HASH_BACKEND_AUTO, stats=None, algorithm=DEFAULT_HASH_ALGORITHM):
+    """Returns the hex digest of a file, see calculate_path_digests"""
+    return calculate_path_digests(filename, backend, stats, algorithm)[0]
+
+
+def hash_work_item(path, size, backend=HASH_BACKEND_AUTO, algorithm=DEFAULT_HASH_ALGORITHM, block_size=None):
+    """Task run in a worker process.
+    :param path: string path of the file to hash
+    :param size: size of the file in bytes, only used by the caller for scheduling
+    :param block_size: block size of the block CRC32s, None for none
+    :return: (path, hex digest, block CRC32s)
+    """
+    return (path,) + calculate_path_digests(Path(path), backend, algorithm=algorithm, block_size=block_size)
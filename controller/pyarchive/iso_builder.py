@@ -0,0 +1,314 @@
+"""Builds the ISO image of one disc.
+
+Archiver.iso_plan gathers everything that goes on a disc into an IsoPlan, which is small and can be pickled, so
+build_iso can run in a worker process without the whole archive (see pipeline).
+
+Files are often hashed days before their disc is built, so each file is hashed again as pycdlib copies it into
+the image and checked against its catalogued hash.  This costs no extra reading.  A file which has changed
+either stops the build or, if quarantining, is written anyway and reported so that it can be archived again.
+Packed small files (see iso_layout) are checked one by one as their pack is written, as are chunks (see chunker),
+which are read from the middle of a chunked file.
+"""
+import os
+
+try:
+    from cStringIO import StringIO as BytesIO
+except ImportError:
+    from io import BytesIO
+import pycdlib
+
+from .consts import *
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM, new_hash
+
+ON_MISMATCH_FAIL = "fail"
+ON_MISMATCH_QUARANTINE = "quarantine"
+ON_MISMATCH_CHOICES = (ON_MISMATCH_FAIL, ON_MISMATCH_QUARANTINE)
+
+
+class HashingReader:
+    """Source file handed to pycdlib which hashes what pycdlib reads from it and checks the hash once the whole
+    file has been read.  The file is only opened when pycdlib comes to copy it and is closed straight after."""
+
+    mode = "rb"  # pycdlib checks for a binary file
+
+    def __init__(
+        self,
+        source,
+        size,
+        file_hash,
+        on_mismatch=ON_MISMATCH_FAIL,
+        quarantined=None,
+        start=0,
+        algorithm=DEFAULT_HASH_ALGORITHM,
+    ):
+        """
+        :param start: byte offset in source of the data, for a chunk
+        :param algorithm: hash algorithm of the archive, see hash_algorithms
+        :param quarantined: list to which (source, catalogued hash, hash of what was read) is appended for each
+            changed file when quarantining
+        """
+        self.source = source
+        self.size = size
+        self.file_hash = file_hash
+        self.on_mismatch = on_mismatch
+        self.quarantined = quarantined
+        self.start = start
+        self.algorithm = algorithm
+        self._file = None
+        self._digest = None
+        self._read = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise PyArchiveError(f"{self.source} can only be read from the start to check its hash")
+        self.close()
+        self._file = open(self.source, "rb")
+        self._file.seek(self.start)
+        self._digest = new_hash(self.algorithm)
+        self._read = 0
+        return 0
+
+    def read(self, size=-1):
+        if self._file is None:
+            self.seek(0)
+        data = self._file.read(size)
+        self._digest.update(data)
+        self._read += len(data)
+        if self._read >= self.size or size < 0 or len(data) < size:  # pycdlib stops at a short read
+            self._check()
+        return data
+
+    def _check(self):
+        self.close()
+        actual = self._digest.hexdigest()
+        if actual != self.file_hash:
+            if self.on_mismatch == ON_MISMATCH_QUARANTINE:
+                self.quarantined.append((self.source, self.file_hash, actual))
+            else:
+                raise PyArchiveError(
+                    f"{self.source} has changed since it was catalogued, hash {actual} expected {self.file_hash}"
+                )
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class PackReader:
+    """Source of a pack handed to pycdlib, reading each packed file through a HashingReader in turn.  Each file
+    takes exactly its catalogued size so that the offsets in the catalogue hold even if a file has changed."""
+
+    mode = "rb"
+
+    def __init__(self, members, on_mismatch=ON_MISMATCH_FAIL, quarantined=None, algorithm=DEFAULT_HASH_ALGORITHM):
+        """
+        :param members: (source path, offset, size, file_hash, offset in source) of each packed file or chunk, in
+            offset order
+        """
+        self.members = members
+        self.size = sum(member[2] for member in members)
+        self.on_mismatch = on_mismatch
+        self.quarantined = quarantined
+        self.algorithm = algorithm
+        self._index = 0
+        self._reader = None
+        self._left = 0  # Bytes of the current member still to come
+        self._short = False  # The current member ended early
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise PyArchiveError("A pack can only be read from the start to check its hashes")
+        self.close()
+        self._index = 0
+        self._short = False
+        return 0
+
+    def _next_member(self):
+        source, _, size, file_hash, start = self.members[self._index]
+        self._reader = HashingReader(
+            source, size, file_hash, self.on_mismatch, self.quarantined, start, self.algorithm
+        )
+        self._reader.seek(0)
+        self._left = size
+
+    def _end_member(self):
+        self.close()
+        self._short = False
+        self._index += 1
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size
+        result = bytearray()
+        # Empty files are read too, even at the end of the pack, so that they are checked
+        while self._index < len(self.members) and (len(result) < size or self.members[self._index][2] == 0):
+            if self._reader is None and not self._short:
+                self._next_member()
+            wanted = min(size - len(result), self._left)
+            if self._short:
+                data = bytes(wanted)  # Pads a file which has shrunk, HashingReader has already checked it
+            else:
+                data = self._reader.read(wanted)
+                self._short = len(data) < wanted
+            result += data
+            self._left -= len(data)
+            if not self._left:
+                self._end_member()
+        return bytes(result)
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+
+class IsoPlan:
+    """What goes on one disc"""
+
+    def __init__(
+        self,
+        disc_num,
+        set_size,
+        readme,
+        catalogue,
+        path_index,
+        segment_size=None,
+        hash_algorithm=DEFAULT_HASH_ALGORITHM,
+    ):
+        """
+        :param disc_num: disc number or None if the archive is not segmented
+        :param set_size: number of discs in the archive
+        :param readme: bytes of README.MKD
+        :param catalogue: path of the catalogue.json to put on the disc
+        :param path_index: path of the catalogue.idx to put on the disc
+        :param segment_size: capacity of the disc in bytes, if known the image is checked against it
+        :param hash_algorithm: algorithm of the file hashes, see hash_algorithms
+        """
+        self.disc_num = disc_num
+        self.set_size = set_size
+        self.readme = readme
+        self.catalogue = str(catalogue)
+        self.path_index = str(path_index)
+        self.segment_size = segment_size
+        self.hash_algorithm = hash_algorithm
+        self.directories = []  # UDF directories, parents before children
+        self.files = []  # (source path, UDF path, size, file_hash)
+        # UDF path of each pack -> (source path, offset, size, file_hash, offset in source) of the files in it
+        self.packs = {}
+
+    def add_directory(self, udf_path):
+        self.directories.append(udf_path)
+
+    def add_file(self, source, udf_path, size, file_hash):
+        self.files.append((source, udf_path, size, file_hash))
+
+    def add_packed_file(self, pack, source, offset, size, file_hash, source_offset=0):
+        """Adds a file, or with source_offset a chunk of source, at offset in pack"""
+        self.packs.setdefault(pack, []).append((source, offset, size, file_hash, source_offset))
+
+    @property
+    def is_empty(self):
+        return not self.files and not self.packs
+
+    @property
+    def seqnum(self):
+        return 0 if self.disc_num is None else self.disc_num
+
+    @property
+    def data_size(self):
+        return sum(size for _, _, size, _ in self.files) + sum(
+            member[2] for members in self.packs.values() for member in members
+        )
+
+
+def new_iso(plan, on_mismatch=ON_MISMATCH_FAIL, quarantined=None):
+    """Returns a pycdlib image with everything in plan added, each file checked against its hash as it is written.
+    See HashingReader for on_mismatch and quarantined."""
+    if on_mismatch not in ON_MISMATCH_CHOICES:
+        raise PyArchiveError(f"Unknown on_mismatch {on_mismatch}, expected one of {ON_MISMATCH_CHOICES}")
+    iso = pycdlib.PyCdlib()
+    iso.new(
+        interchange_level=3,
+        udf="2.60",
+        app_ident_str="PyArchive (C) 2018 drummonds.net",
+        abstract_file="README.MKD",
+        set_size=plan.set_size,
+        seqnum=plan.seqnum,
+    )
+    iso.add_fp(
+        BytesIO(plan.readme),
+        len(plan.readme),
+        "/README.MKD;1",
+        udf_path="/README.MKD",
+    )
+    iso.add_file(
+        plan.catalogue,
+        "/CATALOGUE.JSON;1",
+        udf_path="/catalogue.json"  # Same catalogue for each disc
+        # So that you can go to single disc and then find where to go next - which disc to read rather than
+        # having to read all the files.
+    )
+    iso.add_file(
+        plan.path_index,
+        "/" + PATH_INDEX_ISO_NAME,
+        udf_path="/" + PATH_INDEX_FILENAME,  # Sorted index so "pyarchive find" need not parse the catalogue
+    )
+    # Todo add_file which says which disc this is in which catalogue
+    for dir_count, this_dir in enumerate(plan.directories):
+        # Todo add Bridge format and iso9660
+        # After 10^8 directories (which breaks a standard ISO 9660 the formatting will vary
+        if this_dir == "/DATA":
+            iso.add_directory("/DATA", udf_path="/DATA")  # Add root data directory to both ISO and UDF
+        else:
+            iso.add_directory(
+                f"/DATA/{dir_count:08}", udf_path=this_dir
+            )  # Note can't use "/" as ISO 9660 root as we are adding
+            # a directory and this would only be the root
+    algorithm = getattr(plan, "hash_algorithm", DEFAULT_HASH_ALGORITHM)
+    for file_count, (source, udf_path, _, file_hash) in enumerate(plan.files):
+        size = os.stat(source).st_size  # The catalogue has the size of a symlink, not of what it links to
+        iso.add_fp(
+            HashingReader(source, size, file_hash, on_mismatch, quarantined, algorithm=algorithm),
+            size,
+            f"/DATA/{file_count:08}",  # All data files in same directory and anonymise names :(
+            udf_path=udf_path,
+        )
+    for pack_count, (udf_path, members) in enumerate(plan.packs.items(), len(plan.files)):
+        reader = PackReader(sorted(members, key=lambda member: member[1]), on_mismatch, quarantined, algorithm)
+        iso.add_fp(reader, reader.size, f"/DATA/{pack_count:08}", udf_path=udf_path)
+    return iso
+
+
+def build_iso(plan, filename, pretend=False, on_mismatch=ON_MISMATCH_FAIL, quarantined=None):
+    """Builds the image of plan and writes it to filename.
+    Nothing is written if pretend or if there are no files on the disc.
+    :return: filename or None if nothing was written
+    """
+    iso = new_iso(plan, on_mismatch, quarantined)
+    if pretend or plan.is_empty:  # Will not write out a cataloge with no files in it
+        iso.close()
+        return None
+    # If file exists then iso.write will just overwrite part of it so need to delete it first.
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+    try:
+        iso.write(filename)
+    except BaseException:
+        if os.path.exists(filename):
+            os.remove(filename)  # Don't leave a part written image that looks like a disc
+        raise
+    finally:
+        iso.close()
+    size = os.path.getsize(filename)
+    if plan.segment_size is not None and size > plan.segment_size:
+        raise PyArchiveError(f"{filename} is {size:,} bytes, more than the disc size of {plan.segment_size:,}")
+    return filename
+
+
+def iso_filename(job_name, disc_num):
+    if disc_num is None:
+        return f"{job_name}.iso"
+    return f"{job_name}_{disc_num:04}.iso"
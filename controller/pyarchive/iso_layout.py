@@ -0,0 +1,244 @@
+"""Exact size of the ISO images that Archiver.write_iso makes with pycdlib.
+
+pycdlib lays an image out (see PyCdlib._reshuffle_extents) as:
+    sectors 0-258      system area, ISO 9660 and UDF volume descriptors, UDF anchor and file set descriptor
+    UDF directories    breadth first, for each a file entry sector then its file identifiers packed into sectors
+    UDF file entries   one sector for each file
+    path tables        little then big endian, each allocated in pairs of sectors
+    ISO 9660 root      README.MKD;1, CATALOGUE.JSON;1, CATALOGUE.IDX;1 and DATA, one sector
+    ISO 9660 DATA      a 42 byte record for every directory and file on the disc, records don't cross sectors
+    ISO 9660 subdirs   one sector each, they only hold . and ..
+    file data          each file rounded up to whole sectors, empty files take none
+    UDF anchor         the last sector
+
+write_iso names every ISO 9660 file and directory with an 8 digit number inside DATA so only the UDF side
+depends on the real names.  DiscLayout adds files one at a time keeping the sector count exact so that segment
+can pack a disc to within a few sectors of its capacity.
+
+Optionally small files are packed: each directory on a disc gets a pack file holding its small files one after
+another, unaligned, so that they cost only their bytes rather than a sector, a file entry and a file identifier
+each.  The catalogue records the pack and offset of each packed file so it can still be restored on its own.
+"""
+import posixpath
+
+SECTOR_SIZE = 2048
+DEFAULT_MARGIN_SECTORS = 16  # Kept free on each disc in case the layout of a later pycdlib differs
+
+SYSTEM_SECTORS = 259  # Everything before the UDF directories
+ANCHOR_SECTORS = 1
+ISO_ROOT_SECTORS = 1
+ISO_DOT_RECORDS = 68  # . and .. in each ISO 9660 directory
+ISO_DATA_RECORD = 42  # Record with an 8 character name
+ISO_CHUNK_SIZE = 0xFFFFF800  # Largest file extent one ISO 9660 record can describe
+UDF_FID_HEADER = 38
+UDF_PARENT_FID = 40
+PATH_TABLE_ROOT = 10
+PATH_TABLE_DATA = 12
+PATH_TABLE_SUBDIR = 16
+
+PACK_NAME = ".pyarchive-pack-{:04}"
+PACK_MAX_SIZE = 1 << 30  # A new pack is started rather than go over this, well within one ISO 9660 record
+
+# Most sectors one file or one new directory can add beyond the file's own data
+FILE_BOUND = 2  # File entry and a file identifier spilling into another sector
+PACK_BOUND = 1  # A packed file is not sector aligned so may spill into one more sector
+DIRECTORY_BOUND = 9  # File entry, identifier sector, parent identifier spill, ISO directory, DATA record spill
+# and a pair of sectors on both path tables
+
+
+def sectors(size):
+    return -(-size // SECTOR_SIZE)
+
+
+def fid_length(name):
+    """Bytes of the UDF file identifier descriptor for name, which pycdlib stores as latin-1 if it can and
+    UTF-16 otherwise"""
+    try:
+        encoded = name.encode("latin-1")
+    except UnicodeEncodeError:
+        encoded = name.encode("utf-16-be")
+    length = UDF_FID_HEADER + len(encoded) + 1
+    return (length + 3) // 4 * 4
+
+
+def iso_records(size):
+    """Number of ISO 9660 directory records for a file, files over 4 GiB are split into several extents"""
+    return max(1, -(-size // ISO_CHUNK_SIZE))
+
+
+def path_table_sectors(dir_count):
+    """Sectors of both path tables for the root, DATA and dir_count directories inside DATA"""
+    size = PATH_TABLE_ROOT + PATH_TABLE_DATA + PATH_TABLE_SUBDIR * dir_count
+    return 2 * (-(-sectors(size) // 2) * 2)
+
+
+def pack_path(directory, count):
+    """UDF path of the count'th pack in directory"""
+    return posixpath.join(directory, PACK_NAME.format(count))
+
+
+def iso_data_sectors(records):
+    """Sectors of the ISO 9660 DATA directory holding records entries"""
+    first = (SECTOR_SIZE - ISO_DOT_RECORDS) // ISO_DATA_RECORD
+    if records <= first:
+        return 1
+    return 1 + -(-(records - first) // (SECTOR_SIZE // ISO_DATA_RECORD))
+
+
+class DiscLayout:
+    """Sector count of one disc, built up as entries are added"""
+
+    def __init__(self, root_files=(), data_root="/DATA", packable=None):
+        """
+        :param root_files: (name, size) of the files written to the root of every disc
+        :param data_root: UDF directory holding the archived files, it is DATA on the ISO 9660 side
+        :param packable: function of an entry which is True if it is to be packed, None to pack nothing
+        """
+        self.data_root = data_root
+        self.packable = packable
+        self.packs = {}  # directory -> (number of packs, bytes in the last pack)
+        self.fid_bytes = {"/": UDF_PARENT_FID + sum(fid_length(name) for name, _ in root_files)}
+        self.udf_dir_sectors = 1 + sectors(self.fid_bytes["/"])
+        self.file_entries = len(root_files)
+        self.data_sectors = sum(sectors(size) for _, size in root_files)
+        self.subdirs = 0
+        self.data_records = 0
+        self.entries = 0
+        self.sectors = self._total(self._state())
+        self._planned = None  # (entry, plan) of the last cost so that add doesn't work it out again
+
+    def _state(self):
+        return self.udf_dir_sectors, self.file_entries, self.subdirs, self.data_records, self.data_sectors
+
+    @staticmethod
+    def _total(state):
+        udf_dir_sectors, file_entries, subdirs, data_records, data_sectors = state
+        return (
+            SYSTEM_SECTORS
+            + udf_dir_sectors
+            + file_entries
+            + path_table_sectors(subdirs)
+            + ISO_ROOT_SECTORS
+            + iso_data_sectors(data_records)
+            + subdirs
+            + data_sectors
+            + ANCHOR_SECTORS
+        )
+
+    @property
+    def size(self):
+        """Size in bytes of the image"""
+        return self.sectors * SECTOR_SIZE
+
+    def is_packed(self, entry):
+        return self.packable is not None and self.packable(entry)
+
+    def _plan(self, entry):
+        """Works out adding entry.  Returns (state after, file identifier bytes added to each directory, new
+        directories, (directory, packs, offset, bytes in the last pack) if it is packed)."""
+        directory = entry.directory
+        name, size, pack = entry.name, entry.size, None
+        if self.is_packed(entry):
+            count, used = self.packs.get(directory, (0, PACK_MAX_SIZE))
+            if used + size <= PACK_MAX_SIZE:  # Goes on the end of the last pack
+                state = (
+                    self.udf_dir_sectors,
+                    self.file_entries,
+                    self.subdirs,
+                    self.data_records,
+                    self.data_sectors + sectors(used + size) - sectors(used),
+                )
+                return state, {}, (), (directory, count, used, used + size)
+            name, pack = PACK_NAME.format(count), (directory, count + 1, 0, size)  # Starts a new pack
+        fid = fid_length(name)
+        data_sectors = self.data_sectors + sectors(size)
+        old = self.fid_bytes.get(directory)
+        if old is not None:  # Usual case of a directory already on the disc
+            state = (
+                self.udf_dir_sectors + sectors(old + fid) - sectors(old),
+                self.file_entries + 1,
+                self.subdirs,
+                self.data_records + iso_records(size),
+                data_sectors,
+            )
+            return state, {directory: fid}, (), pack
+        added = {directory: fid}
+        new_dirs = []
+        while directory not in self.fid_bytes:
+            new_dirs.append(directory)
+            parent, name = posixpath.split(directory)
+            added[parent] = added.get(parent, 0) + fid_length(name)
+            directory = parent
+        udf_dir_sectors = self.udf_dir_sectors
+        for directory, fid_bytes in added.items():
+            old = self.fid_bytes.get(directory)
+            if old is None:
+                udf_dir_sectors += 1 + sectors(UDF_PARENT_FID + fid_bytes)
+            else:
+                udf_dir_sectors += sectors(old + fid_bytes) - sectors(old)
+        subdirs = len(new_dirs) - (self.data_root in new_dirs)
+        state = (
+            udf_dir_sectors,
+            self.file_entries + 1,
+            self.subdirs + subdirs,
+            self.data_records + subdirs + iso_records(size),
+            data_sectors,
+        )
+        return state, added, new_dirs, pack
+
+    def cost(self, entry):
+        """Sectors that adding entry would add to the disc"""
+        plan = self._plan(entry)
+        self._planned = entry, plan
+        return self._total(plan[0]) - self.sectors
+
+    def bound(self, entry):
+        """Most sectors that adding entry could add to a disc which already has its directory"""
+        return file_bound(entry) + (PACK_BOUND if self.is_packed(entry) else 0)
+
+    def add(self, entry):
+        """Adds entry, returning the sectors it added.  The pack and pack_offset of entry are set if it is packed
+        and cleared if not."""
+        if self._planned is not None and self._planned[0] is entry:
+            state, added, new_dirs, pack = self._planned[1]
+        else:
+            state, added, new_dirs, pack = self._plan(entry)
+        self._planned = None
+        if pack is None:
+            entry.pack, entry.pack_offset = None, None
+        else:
+            directory, count, offset, used = pack
+            self.packs[directory] = count, used
+            entry.pack, entry.pack_offset = pack_path(directory, count - 1), offset
+        (
+            self.udf_dir_sectors,
+            self.file_entries,
+            self.subdirs,
+            self.data_records,
+            self.data_sectors,
+        ) = state
+        for directory in new_dirs:
+            self.fid_bytes[directory] = UDF_PARENT_FID
+        for directory, fid_bytes in added.items():
+            self.fid_bytes[directory] += fid_bytes
+        self.entries += 1
+        before = self.sectors
+        self.sectors = self._total(state)
+        return self.sectors - before
+
+
+def file_bound(entry):
+    """Most sectors that adding entry could add to a disc which already has its directory"""
+    return sectors(entry.size) + FILE_BOUND + iso_records(entry.size)
+
+
+def pack_bound(size):
+    """Most sectors that packing files of size bytes in all into one directory could add to a disc, allowing for a
+    pack already there and for starting new ones"""
+    return sectors(size) + PACK_BOUND + (size // PACK_MAX_SIZE + 2) * (FILE_BOUND + 1)
+
+
+def directory_bound(directory):
+    """Most sectors that creating directory and any of its parents could add to a disc"""
+    return DIRECTORY_BOUND * (directory.count("/") if directory != "/" else 0)
+
@@ -0,0 +1,215 @@
+"""Streams an ISO image into a pipe or FIFO as it is built, so a disc need not be staged as a file first.
+
+pycdlib writes the descriptors and directories of an image in any order, seeking about, and then the data of
+each file, mostly in ascending order.  SequentialWriter gives pycdlib a seekable file which holds writes back
+only until nothing more can be written before them, so the image comes out in order and, once the file data has
+started, almost all of it goes straight through.  A RingBuffer, drained by its own thread, sits between it and the pipe to keep the burner fed while
+pycdlib waits on a slow source file system.
+
+    mkfifo /tmp/burn.fifo
+    cdrecord -v dev=/dev/sr0 -tsize=... /tmp/burn.fifo &
+    archiver.write_iso(disc_num=3, stream_to="/tmp/burn.fifo")
+"""
+from bisect import bisect_right
+import hashlib
+import os
+import queue
+import threading
+
+from .consts import *
+from .iso_builder import ON_MISMATCH_FAIL, new_iso
+from .iso_layout import SECTOR_SIZE, sectors
+
+STREAM_CHUNK_SIZE = 1 << 20
+DEFAULT_STREAM_BUFFER = 256 << 20  # Rides out a few seconds of source stall at Blu-ray burn speeds
+_ZEROS = bytes(STREAM_CHUNK_SIZE)
+
+
+class RingBuffer:
+    """Bounded buffer of chunks in front of out, drained by a thread"""
+
+    def __init__(self, out, size=DEFAULT_STREAM_BUFFER, chunk_size=STREAM_CHUNK_SIZE):
+        self.out = out
+        self.chunk_size = chunk_size
+        self._chunks = queue.Queue(max(1, size // chunk_size))
+        self._partial = bytearray()
+        self._error = None
+        self._thread = threading.Thread(target=self._drain, name="iso-ring-buffer", daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                break
+            if self._error is None:  # After an error keep taking chunks so that write never blocks for ever
+                try:
+                    self.out.write(chunk)
+                except BaseException as e:
+                    self._error = e
+        if self._error is None:
+            try:
+                self.out.flush()
+            except BaseException as e:
+                self._error = e
+
+    def _check(self):
+        if self._error is not None:
+            raise PyArchiveError(f"Writing the image stream failed: {self._error}") from self._error
+
+    def write(self, data):
+        self._check()
+        self._partial += data
+        while len(self._partial) >= self.chunk_size:
+            self._chunks.put(bytes(self._partial[: self.chunk_size]))
+            del self._partial[: self.chunk_size]
+        return len(data)
+
+    def close(self):
+        """Waits for everything to be written to out"""
+        if self._partial:
+            self._chunks.put(bytes(self._partial))
+            self._partial = bytearray()
+        self._chunks.put(None)
+        self._thread.join()
+        self._check()
+
+
+class SequentialWriter:
+    """Seekable file for pycdlib which writes to sink in order.
+    pycdlib writes the descriptors and directories first and then the data of each file.  extents is (start, end)
+    of the data of each file in the order pycdlib writes them, which need not be the order they are on the disc.
+    Writes are held until nothing more can be written before them, that is until every file whose data is before
+    them has been written.  The UDF anchor after the data is written first and held until close."""
+
+    def __init__(self, sink, extents):
+        self.sink = sink
+        self.size = 0  # End of the furthest write
+        self._pos = 0
+        self._sent = 0  # Everything before this has gone to sink
+        self._held = []  # (offset, data) not yet sent
+        self._by_offset = sorted((start, end, i) for i, (start, end) in enumerate(extents))
+        self._starts = [start for start, _, _ in self._by_offset]
+        self._current = -1  # Extent being written, in pycdlib's order
+        self._complete = 0  # _by_offset[:_complete] have all been written
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+    def _zeros(self, count):
+        while count > 0:
+            self.sink.write(_ZEROS[: min(count, STREAM_CHUNK_SIZE)])
+            count -= STREAM_CHUNK_SIZE
+
+    def _send(self, limit):
+        """Sends everything held before limit, filling the gaps with zeros"""
+        keep = []
+        for offset, data in sorted(self._held, key=lambda held: held[0]):
+            if offset >= limit:
+                keep.append((offset, data))
+                continue
+            if offset < self._sent:
+                raise PyArchiveError(f"Cannot stream image, overlapping writes at offset {offset:,}")
+            self._zeros(offset - self._sent)
+            self.sink.write(data)
+            self._sent = offset + len(data)
+        self._held = keep
+        self._zeros(limit - self._sent)
+        self._sent = max(self._sent, limit)
+
+    def _limit(self):
+        """Offset before which nothing more will be written, given that a file's data is being written at _pos"""
+        i = bisect_right(self._starts, self._pos) - 1
+        if i < 0 or self._pos >= self._by_offset[i][1]:
+            return None  # Not file data
+        self._current = max(self._current, self._by_offset[i][2])
+        while self._by_offset[self._complete][2] < self._current:
+            self._complete += 1
+        start, _, index = self._by_offset[self._complete]
+        return self._pos if index == self._current else start
+
+    def write(self, data):
+        data = bytes(data)
+        if self._pos < self._sent:
+            raise PyArchiveError(
+                f"Cannot stream image, pycdlib went back to offset {self._pos:,} after {self._sent:,} had been sent"
+            )
+        limit = self._limit()
+        if limit is not None and limit > self._sent:
+            self._send(limit)
+        if self._pos == self._sent:
+            self.sink.write(data)
+            self._sent += len(data)
+        else:
+            self._held.append((self._pos, data))
+        self._pos += len(data)
+        self.size = max(self.size, self._pos)
+        return len(data)
+
+    def close(self):
+        self._send(self.size)
+
+
+def image_extents(iso):
+    """(start, end) of the data of each file, in the order pycdlib writes them, and the size of the image"""
+    iso._reshuffle_extents()  # pycdlib only lays out the image when writing, so lay it out now
+    extents = [
+        (ino.extent_location() * SECTOR_SIZE, (ino.extent_location() + sectors(ino.get_data_length())) * SECTOR_SIZE)
+        for ino in iso.inodes
+        if ino.get_data_length() > 0
+    ]
+    return extents, iso.pvd.space_size * SECTOR_SIZE
+
+
+def stream_iso(
+    plan, out, buffer_size=DEFAULT_STREAM_BUFFER, progress=None, on_mismatch=ON_MISMATCH_FAIL, quarantined=None
+):
+    """Builds the image of plan writing it in order to out, a binary file object or the path of a FIFO.
+    Nothing is written if there are no files on the disc.
+    :param progress: called with (bytes done, total bytes) as the image is written
+    :param on_mismatch: what to do with a file that has changed since it was hashed, see iso_builder
+    :return: size of the image
+    """
+    if plan.is_empty:
+        return 0
+    if isinstance(out, (str, os.PathLike)):
+        with open(out, "wb") as f:  # Waits for the burner to open a FIFO
+            return stream_iso(plan, f, buffer_size, progress, on_mismatch, quarantined)
+    iso = new_iso(plan, on_mismatch, quarantined)
+    try:
+        extents, size = image_extents(iso)
+        if plan.segment_size is not None and size > plan.segment_size:
+            raise PyArchiveError(f"Image is {size:,} bytes, more than the disc size of {plan.segment_size:,}")
+        buffer = RingBuffer(out, buffer_size)
+        try:
+            writer = SequentialWriter(buffer, extents)
+            iso.write_fp(writer, blocksize=STREAM_CHUNK_SIZE, progress_cb=progress)
+            writer.close()
+        finally:
+            buffer.close()
+    finally:
+        iso.close()
+    return writer.size
+
+
+def checksum_stream(fp, algorithm="sha512", blocksize=STREAM_CHUNK_SIZE):
+    """Reads fp to the end as a burner would.  Stands in for the burner when testing streaming.
+    :return: (bytes read, hex digest)
+    """
+    digest = hashlib.new(algorithm)
+    count = 0
+    while True:
+        block = fp.read(blocksize)
+        if not block:
+            break
+        digest.update(block)
+        count += len(block)
+    return count, digest.hexdigest()
@@ -0,0 +1,158 @@
+"""Seeds file hashes from SHA-512 manifests already in the tree so that those files need not be read at all.
+
+Many trees already hold SHA512SUM, *.sha512sum or DIGESTS files from earlier tools, perhaps clear signed (.asc).
+Each line gives the hash of a file relative to the manifest's directory, either as sha512sum writes it,
+"<hash>  <name>" or "<hash> *<name>", or BSD style "SHA512 (<name>) = <hash>".  Other lines, such as the hashes of
+other algorithms in a DIGESTS file or a signature, are skipped.
+
+A hash is only taken for a file, not a symlink, which is older than its manifest and so has not changed since the
+manifest was written.  How far each manifest is trusted is set by the policy:
+    off    - manifests are ignored, the default for init and archive as a stale line only shows up when the image
+             is built
+    trust  - every hash is taken
+    sample - a random sample of the files in each manifest is hashed and the manifest is only used if all match
+"""
+from fnmatch import fnmatch
+import math
+import os
+import random
+import re
+from sys import stderr
+
+from .consts import *
+from .file_entry import FileEntryType
+from .hasher import HASH_BACKEND_AUTO, HashStats, calculate_path_hash
+
+MANIFEST_OFF = "off"
+MANIFEST_TRUST = "trust"
+MANIFEST_SAMPLE = "sample"
+MANIFEST_POLICIES = (MANIFEST_OFF, MANIFEST_TRUST, MANIFEST_SAMPLE)
+
+DEFAULT_SAMPLE_FRACTION = 0.01
+DEFAULT_SAMPLE_MIN = 4  # Files checked in each manifest however small the fraction
+
+# fnmatch patterns, specifically:
+IMPORT_FILENAME_PATTERNS = [
+    HASH_FILENAME,
+    HASH_FILENAME + ".asc",
+    "*.sha512sum",
+    "*.sha512sum.asc",
+    "DIGESTS",
+    "DIGESTS.asc",
+]  # Not catalogue.json, its paths are relative to the data root of an archive rather than to its directory
+
+_GNU_LINE = re.compile(r"^(\\?)([0-9a-fA-F]{128}) [ *](.+)$")
+_BSD_LINE = re.compile(r"^(\\?)SHA512 ?\((.+)\) ?= ?([0-9a-fA-F]{128})$")
+_ESCAPE = re.compile(r"\\(.)")
+_UNESCAPED = {"n": "\n", "r": "\r", "\\": "\\"}
+
+
+def is_manifest(name):
+    return any(fnmatch(name, pattern) for pattern in IMPORT_FILENAME_PATTERNS)
+
+
+def _unescape(name):
+    """sha512sum starts the line with a backslash and escapes a name holding a backslash or a newline"""
+    return _ESCAPE.sub(lambda m: _UNESCAPED.get(m.group(1), m.group(0)), name)
+
+
+def parse_manifest(lines):
+    """Yields (name, lower case hash) of each SHA-512 line of a manifest"""
+    in_signature = False
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.startswith("-----BEGIN PGP SIGNATURE"):
+            in_signature = True
+        elif line.startswith("-----END PGP SIGNATURE"):
+            in_signature = False
+        elif not in_signature:
+            if line.startswith("- "):  # Dash escaped by the clear signature
+                line = line[2:]
+            match = _GNU_LINE.match(line)
+            if match:
+                escaped, file_hash, name = match.groups()
+            else:
+                match = _BSD_LINE.match(line)
+                if not match:
+                    continue
+                escaped, name, file_hash = match.groups()
+            yield (_unescape(name) if escaped else name), file_hash.lower()
+
+
+class ManifestStats:
+    """What import_manifests did"""
+
+    def __init__(self):
+        self.manifests = 0
+        self.rejected = 0  # Manifests which failed the sample check
+        self.imported = 0  # Files given a hash from a manifest
+        self.stale = 0  # Files changed since their manifest was written, or symlinks, which are hashed as usual
+        self.missing = 0  # Manifest lines naming a file that isn't in the tree
+        self.sampled = HashStats()
+
+    def __str__(self):
+        result = f"{self.imported:,} hashes from {self.manifests - self.rejected:,} of {self.manifests:,} manifests"
+        result += f", {self.stale:,} stale, {self.missing:,} missing"
+        if self.sampled.files:
+            result += f", sampled {self.sampled}"
+        return result
+
+
+def import_manifests(
+    file_db,
+    policy=MANIFEST_OFF,
+    sample_fraction=DEFAULT_SAMPLE_FRACTION,
+    sample_min=DEFAULT_SAMPLE_MIN,
+    backend=HASH_BACKEND_AUTO,
+):
+    """Fills in the file_hash of the entries of file_db named in the manifests found in the tree, so that hashing
+    skips them.  Entries which already have a hash, eg from the hash cache, are left alone.
+    :param policy: one of MANIFEST_POLICIES
+    :param sample_fraction: fraction of the files of each manifest hashed when sampling, at least sample_min
+    :param backend: how sampled files are read, see hasher
+    :return: ManifestStats
+    """
+    if policy not in MANIFEST_POLICIES:
+        raise PyArchiveError(f"Unknown manifest policy {policy}, expected one of {MANIFEST_POLICIES}")
+    stats = ManifestStats()
+    if policy == MANIFEST_OFF:
+        return stats
+    entries = file_db.file_entries
+    manifests = [
+        entry
+        for entry in entries.values()
+        if entry.type == FileEntryType.TYPE_FILE and is_manifest(os.path.basename(entry.path))
+    ]
+    for manifest in manifests:
+        stats.manifests += 1
+        directory = os.path.dirname(manifest.path)
+        found = []  # (entry, file_hash)
+        try:
+            with open(manifest.path, encoding="utf-8", errors="surrogateescape") as f:
+                for name, file_hash in parse_manifest(f):
+                    entry = entries.get(os.path.normpath(os.path.join(directory, name)))
+                    if entry is None:
+                        stats.missing += 1
+                    elif getattr(entry, "file_hash", None) is not None:
+                        continue
+                    elif entry.type != FileEntryType.TYPE_FILE or entry.mtime >= manifest.mtime:
+                        stats.stale += 1
+                    else:
+                        found.append((entry, file_hash))
+        except OSError as e:
+            stderr.write(f"Can't read manifest {manifest.path}: {e}\n")
+            stats.rejected += 1
+            continue
+        if policy == MANIFEST_SAMPLE and found:
+            count = min(len(found), max(sample_min, math.ceil(len(found) * sample_fraction)))
+            for entry, file_hash in random.sample(found, count):
+                actual = calculate_path_hash(entry.filename, backend, stats.sampled)
+                if actual != file_hash:
+                    stderr.write(f"Not using manifest {manifest.path}, {entry.path} no longer matches it\n")
+                    stats.rejected += 1
+                    found = []
+                    break
+        for entry, file_hash in found:
+            entry.file_hash = file_hash
+        stats.imported += len(found)
+    return stats
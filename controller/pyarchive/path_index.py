@@ -0,0 +1,187 @@
+"""Sorted binary index of every path in the archive, written to each disc next to catalogue.json.
+
+Finding which disc holds a file from catalogue.json means parsing the whole catalogue.  The index instead is
+memory mapped and binary searched so a lookup touches a few pages whatever the size of the archive.
+
+Layout, all integers little endian:
+    header  - magic b"PYAIDX01", record count (u64), digest size (u32), reserved (u32)
+    offsets - record count u64 file offsets, one per record in path order
+    records - path length (u32), UTF-8 path, raw digest, disc number (i32, -1 if not segmented)
+Records are sorted by the UTF-8 bytes of the path.
+"""
+from fnmatch import fnmatchcase
+from mmap import mmap, ACCESS_READ
+from pathlib import Path
+import re
+import struct
+
+from .consts import *
+
+MAGIC = b"PYAIDX01"
+HEADER = struct.Struct("<8sQII")
+OFFSET = struct.Struct("<Q")
+PATH_LENGTH = struct.Struct("<I")
+DISC_NUM = struct.Struct("<i")
+_WILDCARD = re.compile(r"[*?\[]")
+
+
+def _records(hash_db):
+    """(path bytes, digest bytes, disc_num) for every path of every entry"""
+    for entry in hash_db.files():
+        digest = bytes.fromhex(entry.file_hash)
+        disc_num = -1 if entry.disc_num is None else entry.disc_num
+        for filename in entry.filenames:
+            yield filename.encode("utf-8", "surrogateescape"), digest, disc_num
+
+
+def path_matcher(pattern):
+    """Returns a test of whether a path matches pattern as PathIndex.find matches it"""
+    if _WILDCARD.search(pattern) is None:
+        directory = pattern.rstrip("/") + "/"
+        return lambda path: path == pattern or path.startswith(directory)
+    return lambda path: fnmatchcase(path, pattern)
+
+
+def path_index_size(hash_db):
+    """Size in bytes of the index that write_path_index would write, without building it"""
+    size = HEADER.size
+    for path, digest, _ in _records(hash_db):
+        size += OFFSET.size + PATH_LENGTH.size + len(path) + len(digest) + DISC_NUM.size
+    return size
+
+
+def write_path_index(hash_db, filename=PATH_INDEX_FILENAME):
+    """Writes the sorted path index of hash_db"""
+    records = sorted(_records(hash_db))
+    digest_size = len(records[0][1]) if records else 0
+    offset = HEADER.size + OFFSET.size * len(records)
+    with open(str(filename), "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(records), digest_size, 0))
+        for path, digest, _ in records:
+            f.write(OFFSET.pack(offset))
+            offset += PATH_LENGTH.size + len(path) + digest_size + DISC_NUM.size
+        for path, digest, disc_num in records:
+            f.write(PATH_LENGTH.pack(len(path)))
+            f.write(path)
+            f.write(digest)
+            f.write(DISC_NUM.pack(disc_num))
+
+
+class PathIndex:
+    """Binary searchable view of a path index held in any buffer, usually an mmap"""
+
+    def __init__(self, buffer, offset=0):
+        """
+        :param buffer: bytes like object holding the index
+        :param offset: where the index starts in buffer, eg its extent in an ISO image
+        """
+        self.buffer = buffer
+        self.base = offset
+        magic, self.count, self.digest_size, _ = HEADER.unpack_from(buffer, offset)
+        if magic != MAGIC:
+            raise PyArchiveError("Not a pyarchive path index")
+
+    def __len__(self):
+        return self.count
+
+    def _path(self, i):
+        """Returns (path bytes, offset of the digest) of record i"""
+        record = self.base + OFFSET.unpack_from(self.buffer, self.base + HEADER.size + OFFSET.size * i)[0]
+        length = PATH_LENGTH.unpack_from(self.buffer, record)[0]
+        start = record + PATH_LENGTH.size
+        return bytes(self.buffer[start : start + length]), start + length
+
+    def record(self, i):
+        """Returns (path, hex digest, disc_num) of record i, disc_num being None if not segmented"""
+        path, digest_at = self._path(i)
+        digest = bytes(self.buffer[digest_at : digest_at + self.digest_size]).hex()
+        disc_num = DISC_NUM.unpack_from(self.buffer, digest_at + self.digest_size)[0]
+        return path.decode("utf-8", "surrogateescape"), digest, None if disc_num < 0 else disc_num
+
+    def lower_bound(self, path_bytes):
+        """Index of the first record whose path is not less than path_bytes"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._path(middle)[0] < path_bytes:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lookup(self, path):
+        """Returns the record for exactly path or None"""
+        path_bytes = path.encode("utf-8", "surrogateescape")
+        i = self.lower_bound(path_bytes)
+        if i < self.count and self._path(i)[0] == path_bytes:
+            return self.record(i)
+        return None
+
+    def with_prefix(self, prefix):
+        """Yields the records whose paths start with prefix"""
+        prefix_bytes = prefix.encode("utf-8", "surrogateescape")
+        i = self.lower_bound(prefix_bytes)
+        while i < self.count and self._path(i)[0].startswith(prefix_bytes):
+            yield self.record(i)
+            i += 1
+
+    def find(self, pattern):
+        """Yields records matching pattern.  A pattern without wildcards matches that file or everything in that
+        directory, otherwise it is an fnmatch pattern and only the range sharing its literal prefix is searched."""
+        match = _WILDCARD.search(pattern)
+        if match is None:
+            exact = self.lookup(pattern)
+            if exact is not None:
+                yield exact
+            yield from self.with_prefix(pattern.rstrip("/") + "/")
+        else:
+            for record in self.with_prefix(pattern[: match.start()]):
+                if fnmatchcase(record[0], pattern):
+                    yield record
+
+
+def _iso_root_file(f, name):
+    """Finds a file in the root directory of an ISO 9660 image by reading the primary volume descriptor and the
+    root directory.  This is much quicker than having pycdlib parse every directory of a large disc.
+    Returns (offset, length) in bytes or None."""
+    f.seek(16 * 2048)
+    pvd = f.read(2048)
+    if pvd[0:6] != b"\x01CD001":
+        raise PyArchiveError("Not an ISO 9660 image")
+    block_size = struct.unpack_from("<H", pvd, 128)[0]
+    root = pvd[156:190]
+    extent, length = struct.unpack_from("<I", root, 2)[0], struct.unpack_from("<I", root, 10)[0]
+    f.seek(extent * block_size)
+    directory = f.read(length)
+    wanted = name.encode("ascii")
+    position = 0
+    while position < len(directory):
+        record_length = directory[position]
+        if record_length == 0:  # Records don't cross sectors, move to the next one
+            position = (position // block_size + 1) * block_size
+            continue
+        name_length = directory[position + 32]
+        if directory[position + 33 : position + 33 + name_length] == wanted:
+            file_extent = struct.unpack_from("<I", directory, position + 2)[0]
+            file_length = struct.unpack_from("<I", directory, position + 10)[0]
+            return file_extent * block_size, file_length
+        position += record_length
+    return None
+
+
+def open_path_index(source):
+    """Opens the path index of a mounted disc (directory), an ISO image or an index file.
+    The index is memory mapped so the returned PathIndex only reads the pages it searches."""
+    source = Path(source)
+    if source.is_dir():
+        source = source / PATH_INDEX_FILENAME
+    with source.open("rb") as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            offset = 0
+        else:
+            found = _iso_root_file(f, PATH_INDEX_ISO_NAME)
+            if found is None:
+                raise PyArchiveError(f"No path index found in {source}")
+            offset = found[0]
+        buffer = mmap(f.fileno(), 0, access=ACCESS_READ)
+    return PathIndex(buffer, offset)
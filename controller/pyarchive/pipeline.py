@@ -0,0 +1,179 @@
+"""Builds disc images ahead of the burner.
+
+Building an image reads every file on the disc, which takes as long as burning it, so IsoPipeline builds the next
+few images in worker processes while the current one is being burned.  Finished images are handed over in disc
+order through a queue:
+
+    with archiver.iso_pipeline(workers=2, lookahead=3, staging_budget=80e9) as pipeline:
+        for disc_num, filename in pipeline:
+            burn_disk(filename)
+            archiver.mark_disc_burned(disc_num)
+
+At most lookahead images are built or waiting to be burned at once, and their total predicted size is kept within
+staging_budget bytes of the staging disk.  An image is released, and deleted if remove_burned, when the next one
+is asked for, when release is called or when the pipeline is closed.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import queue
+import threading
+
+from .consts import *
+from .iso_builder import ON_MISMATCH_FAIL, build_iso, iso_filename
+
+_DONE = None
+
+
+def _build(plan, filename, on_mismatch):
+    """Runs in a worker, returns the files quarantined"""
+    quarantined = []
+    build_iso(plan, filename, on_mismatch=on_mismatch, quarantined=quarantined)
+    return quarantined
+
+
+class IsoPipeline:
+    def __init__(
+        self,
+        archiver,
+        disc_nums,
+        job_name="new",
+        workers=2,
+        lookahead=2,
+        staging_budget=None,
+        staging_dir=".",
+        remove_burned=True,
+        on_mismatch=ON_MISMATCH_FAIL,
+    ):
+        """
+        :param disc_nums: discs to build, in the order they are burned
+        :param workers: number of processes building images
+        :param lookahead: most images built or being built that have not yet been released
+        :param staging_budget: most bytes of images on the staging disk, None for no limit.  A single image is
+            always allowed so that an image bigger than the budget does not stop the pipeline.
+        :param staging_dir: directory the images are written to
+        :param remove_burned: delete each image when it is released
+        :param on_mismatch: 'fail' or 'quarantine' a file which has changed since it was hashed, see iso_builder
+        """
+        if lookahead < 1:
+            raise PyArchiveError(f"lookahead must be at least 1, not {lookahead}")
+        self.archiver = archiver
+        self.job_name = job_name
+        self.workers = workers
+        self.lookahead = lookahead
+        self.staging_budget = staging_budget
+        self.staging_dir = staging_dir
+        self.remove_burned = remove_burned
+        self.on_mismatch = on_mismatch
+        self._todo = deque(disc_nums)
+        self._building = deque()  # (disc_num, filename, future) in disc order
+        self._staged = {}  # disc_num -> predicted bytes of images built or being built and not yet released
+        self._condition = threading.Condition()
+        self._queue = queue.Queue()  # (disc_num, filename, quarantined), an exception or _DONE
+        self._executor = None
+        self._thread = None
+        self._closed = False
+
+    def _expected_size(self, disc_num):
+        hash_db = self.archiver.hash_db
+        try:
+            return hash_db.disc_usage[disc_num]
+        except (AttributeError, IndexError, TypeError):
+            return hash_db.segment_size
+
+    def _has_room(self, size):
+        if len(self._staged) >= self.lookahead:
+            return False
+        if self.staging_budget is None or not self._staged:
+            return True
+        return sum(self._staged.values()) + size <= self.staging_budget
+
+    def _fill(self):
+        """Starts building discs while there is room.  Called holding _condition."""
+        while self._todo and not self._closed:
+            disc_num = self._todo[0]
+            size = self._expected_size(disc_num)
+            if not self._has_room(size):
+                break
+            self._todo.popleft()
+            plan = self.archiver.iso_plan(disc_num)
+            if plan.is_empty:  # Nothing to burn
+                continue
+            filename = os.path.join(self.staging_dir, iso_filename(self.job_name, disc_num))
+            self._staged[disc_num] = size
+            future = self._executor.submit(_build, plan, filename, self.on_mismatch)
+            self._building.append((disc_num, filename, future))
+        self._condition.notify_all()
+
+    def _deliver(self):
+        """Hands finished images to the queue in disc order"""
+        try:
+            while True:
+                with self._condition:
+                    while not self._building and self._todo and not self._closed:
+                        self._condition.wait()
+                    if not self._building:
+                        break
+                    disc_num, filename, future = self._building[0]
+                quarantined = future.result()
+                with self._condition:
+                    self._building.popleft()
+                self._queue.put((disc_num, filename, quarantined))
+        except BaseException as e:
+            self._queue.put(e)
+        else:
+            self._queue.put(_DONE)
+
+    def start(self):
+        if self._thread is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+            with self._condition:
+                self._fill()
+            self._thread = threading.Thread(target=self._deliver, name="iso-pipeline", daemon=True)
+            self._thread.start()
+        return self
+
+    def release(self, disc_num):
+        """The image of disc_num has been burned so frees its space for building another"""
+        with self._condition:
+            if self._staged.pop(disc_num, None) is None:
+                return
+            if self.remove_burned:
+                try:
+                    os.remove(os.path.join(self.staging_dir, iso_filename(self.job_name, disc_num)))
+                except FileNotFoundError:
+                    pass
+            self._fill()
+
+    def __iter__(self):
+        """Yields (disc_num, filename) of each image as it is finished, in disc order"""
+        self.start()
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                self.close()
+                raise PyArchiveError(f"Building disc image failed: {item}") from item
+            disc_num, filename, quarantined = item
+            for source, file_hash, actual_hash in quarantined:
+                self.archiver.quarantine(disc_num, source, file_hash, actual_hash)
+            yield disc_num, filename
+            self.release(disc_num)
+        self.close()
+
+    def close(self):
+        """Stops building any more images, waiting for those being built"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        for disc_num in list(self._staged):  # Built but never burned
+            self.release(disc_num)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,396 @@
+"""Keeps the state of an archiving project in SQLite rather than a dill pickle of the whole Archiver.
+
+The job state (paths, segment size, locked, which discs are burned) is a handful of small rows so loading a
+project costs the same whatever its size.  The file and hash databases are only read from the store when the
+Archiver first uses them, and saving compares each entry with what was loaded so that, for example, segmenting
+or marking a disc as burned only writes the rows that changed.
+
+Tables:
+    job        - key/value JSON state of the Archiver, FileDatabase and HashDatabase
+    files      - one row per FileEntry
+    hashes     - one row per HashFileEntry, indexed on disc_num
+    hash_paths - the UDF paths of each HashFileEntry, the first being the one written to disc
+    chunks     - one row per Chunk of the chunked files, see chunker
+    discs      - state of each disc eg burned
+"""
+from collections import OrderedDict
+import json
+from pathlib import Path, PurePosixPath
+import sqlite3
+import time
+
+from .consts import *
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, type INTEGER, file_hash TEXT, disc_num INTEGER,
+    block_crc32 TEXT
+);
+CREATE TABLE IF NOT EXISTS hashes (
+    file_hash TEXT PRIMARY KEY, size INTEGER, mtime REAL, disc_num INTEGER, catalogue_num INTEGER, pack TEXT,
+    pack_offset INTEGER, chunks TEXT, block_crc32 TEXT
+);
+CREATE INDEX IF NOT EXISTS hashes_disc_num ON hashes (disc_num);
+CREATE TABLE IF NOT EXISTS hash_paths (file_hash TEXT NOT NULL, udf_path TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS hash_paths_file_hash ON hash_paths (file_hash);
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_hash TEXT PRIMARY KEY, size INTEGER, disc_num INTEGER, pack TEXT, pack_offset INTEGER
+);
+CREATE TABLE IF NOT EXISTS discs (disc_num INTEGER PRIMARY KEY, state TEXT, updated REAL);
+"""
+
+PROJECT_STORE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+
+DISC_BURNED = "burned"
+
+# HashDatabase attributes kept in the job table
+HASH_DB_STATE = (
+    "version",
+    "segment_size",
+    "last_disc_number",
+    "str_catalogue_size",
+    "int_catalogue_size",
+    "segment_strategy",
+    "disc_usage",
+    "pack_threshold",
+    "hash_algorithm",
+    "block_size",
+    "span_min",
+    "spanned",
+)
+
+# Columns added to a table since it was first created, added to older stores when they are opened
+ADDED_COLUMNS = (
+    ("hashes", "pack", "TEXT"),
+    ("hashes", "pack_offset", "INTEGER"),
+    ("hashes", "chunks", "TEXT"),
+    ("hashes", "block_crc32", "TEXT"),
+    ("files", "block_crc32", "TEXT"),
+)
+
+
+def is_project_store(filename):
+    return Path(str(filename)).suffix.lower() in PROJECT_STORE_SUFFIXES
+
+
+def _file_row(entry):
+    file_type = entry.type.value if entry.type is not None else None
+    return (
+        entry.path,
+        entry.size,
+        entry.mtime,
+        file_type,
+        getattr(entry, "file_hash", None),
+        entry.disc_num,
+        getattr(entry, "block_crc32", None),
+    )
+
+
+def _hash_row(entry):
+    chunks = json.dumps(entry.chunks) if entry.chunks is not None else None
+    return (
+        entry.file_hash,
+        entry.size,
+        entry.mtime,
+        entry.disc_num,
+        entry.catalogue_num,
+        entry.pack,
+        entry.pack_offset,
+        chunks,
+        entry.block_crc32,
+    )
+
+
+def _chunk_row(chunk):
+    return chunk.file_hash, chunk.size, chunk.disc_num, chunk.pack, chunk.pack_offset
+
+
+class ProjectStore:
+    def __init__(self, filename=PROJECT_STORE_FILENAME):
+        self.filename = str(filename)
+        self._connection = None
+        self._job = {}  # key -> JSON as last read or written
+        self._files = None  # path -> row as last read or written, None if never loaded
+        self._hashes = None  # file_hash -> (row, paths) as last read or written
+        self._chunks = None  # chunk_hash -> row as last read or written
+
+    def __getstate__(self):
+        """The connection can't be pickled, it is reopened on first use.  Neither are the snapshots of what is
+        in the store kept, so the next save after unpickling rewrites the entries."""
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_job"] = {}
+        state["_files"] = None
+        state["_hashes"] = None
+        state["_chunks"] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filename)
+            self._connection.executescript(SCHEMA)
+            for table, column, column_type in ADDED_COLUMNS:
+                columns = [row[1] for row in self._connection.execute(f"PRAGMA table_info({table})")]
+                if column not in columns:
+                    self._connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # Job state
+
+    def _read_job(self):
+        self._job = dict(self.connection.execute("SELECT key, value FROM job"))
+        return {key: json.loads(value) for key, value in self._job.items()}
+
+    def _write_job(self, key, value):
+        text = json.dumps(value, sort_keys=True)
+        if self._job.get(key) != text:
+            self.connection.execute("INSERT OR REPLACE INTO job VALUES (?, ?)", (key, text))
+            self._job[key] = text
+
+    def load(self):
+        """Returns an Archiver with its job state.  The file and hash databases are read when first used."""
+        from .archive import Archiver
+
+        job = self._read_job()
+        if "archiver" not in job:
+            raise PyArchiveError(f"No archiving project in {self.filename}")
+        archiver = Archiver()
+        state = job["archiver"]
+        archiver.iso_path_root = PurePosixPath(state["iso_path_root"])
+        archiver.job_name = state["job_name"]
+        archiver.locked = state["locked"]
+        archiver.quarantined = state.get("quarantined", {})
+        archiver.store = self
+        return archiver
+
+    def load_database(self, name):
+        """Reads 'file_db' or 'hash_db' back.  Raises AttributeError if it was never saved, which is what the
+        Archiver would raise for a database it has not yet created."""
+        job = self._read_job()
+        if name not in job:
+            raise AttributeError(name)
+        if name == "file_db":
+            return self._load_file_db(job["file_db"])
+        return self._load_hash_db(job["hash_db"])
+
+    def save(self, archiver):
+        """Writes the parts of the archiver which have changed since they were loaded or last saved."""
+        with self.connection:
+            self._write_job(
+                "archiver",
+                {
+                    "iso_path_root": str(archiver.iso_path_root),
+                    "job_name": getattr(archiver, "job_name", None),
+                    "locked": archiver.is_locked,
+                    "quarantined": getattr(archiver, "quarantined", {}),
+                },
+            )
+            state = vars(archiver)  # Only save databases that are in memory, others are unchanged in the store
+            if "file_db" in state:
+                self._save_file_db(state["file_db"])
+            if "hash_db" in state:
+                self._save_hash_db(state["hash_db"])
+        archiver.store = self
+
+    # Discs
+
+    def mark_disc(self, disc_num, disc_state):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO discs VALUES (?, ?, ?)", (disc_num, disc_state, time.time())
+            )
+
+    def disc_states(self):
+        """Returns dict of disc_num -> state"""
+        return dict(self.connection.execute("SELECT disc_num, state FROM discs"))
+
+    # File database
+
+    def _load_file_db(self, state):
+        from .file_db import FileDatabase
+        from .file_entry import FileEntry, FileEntryType
+
+        file_db = FileDatabase(Path(state["path"]))
+        file_db.segment_size = state["segment_size"]
+        file_db.last_disc_number = state["last_disc_number"]
+        file_db.hash_algorithm = state.get("hash_algorithm", file_db.hash_algorithm)
+        file_db.block_size = state.get("block_size")
+        self._files = {}
+        for row in self.connection.execute("SELECT * FROM files ORDER BY rowid"):
+            path, size, mtime, file_type, file_hash, disc_num, block_crc32 = row
+            entry = FileEntry(
+                file_db,
+                path,
+                size,
+                mtime,
+                FileEntryType(file_type) if file_type is not None else None,
+                disc_num,
+            )
+            entry.file_hash = file_hash
+            entry.block_crc32 = block_crc32
+            file_db.file_entries[path] = entry
+            self._files[path] = row
+        return file_db
+
+    def _save_file_db(self, file_db):
+        self._write_job(
+            "file_db",
+            {
+                "path": str(file_db.path),
+                "segment_size": file_db.segment_size,
+                "last_disc_number": file_db.last_disc_number,
+                "hash_algorithm": getattr(file_db, "hash_algorithm", DEFAULT_HASH_ALGORITHM),
+                "block_size": getattr(file_db, "block_size", None),
+            },
+        )
+        if self._files is None:  # New database so replace whatever was there
+            self.connection.execute("DELETE FROM files")
+            self._files = {}
+        changed = []
+        for entry in file_db.files():
+            row = _file_row(entry)
+            if self._files.get(entry.path) != row:
+                changed.append(row)
+                self._files[entry.path] = row
+        self.connection.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET"
+            " size=excluded.size, mtime=excluded.mtime, type=excluded.type, file_hash=excluded.file_hash,"
+            " disc_num=excluded.disc_num, block_crc32=excluded.block_crc32",
+            changed,
+        )
+        removed = self._files.keys() - file_db.file_entries.keys()
+        self.connection.executemany("DELETE FROM files WHERE path=?", ((path,) for path in removed))
+        for path in removed:
+            del self._files[path]
+
+    # Hash database
+
+    def _load_hash_db(self, state):
+        from .hash_db import HashDatabase
+        from .hash_file_entry import HashFileEntry
+
+        hash_db = HashDatabase(None, PurePosixPath(state["iso_path_root"]), Path(state["path"]))
+        for key in HASH_DB_STATE:
+            if key in state:
+                setattr(hash_db, key, state[key])
+        hash_db.hash_algorithm = hash_db.hash_algorithm or DEFAULT_HASH_ALGORITHM  # Saved from an older pickle
+        paths = {}
+        for file_hash, udf_path in self.connection.execute(
+            "SELECT file_hash, udf_path FROM hash_paths ORDER BY rowid"
+        ):
+            paths.setdefault(file_hash, []).append(udf_path)
+        entries = hash_db.hash_entries
+        self._hashes = {}
+        for row in self.connection.execute("SELECT * FROM hashes ORDER BY rowid"):
+            file_hash, size, mtime, disc_num, catalogue_num, pack, pack_offset, chunks, block_crc32 = row
+            these_paths = paths.get(file_hash, [])
+            entry = HashFileEntry(
+                entries,
+                file_hash,
+                these_paths[0],
+                size=size,
+                mtime=mtime,
+                disc_num=disc_num,
+                catalogue_num=catalogue_num,
+                pack=pack,
+                pack_offset=pack_offset,
+                chunks=json.loads(chunks) if chunks is not None else None,
+                block_crc32=block_crc32,
+            )
+            for udf_path in these_paths[1:]:
+                entry.add_path(udf_path)
+            entries[file_hash] = entry
+            self._hashes[file_hash] = (row, tuple(these_paths))
+        self._load_chunks(hash_db)
+        return hash_db
+
+    def _load_chunks(self, hash_db):
+        from .chunker import Chunk
+
+        data_root = str(hash_db.iso_path_root)
+        self._chunks = {}
+        for row in self.connection.execute("SELECT * FROM chunks ORDER BY rowid"):
+            chunk_hash, size, disc_num, pack, pack_offset = row
+            if hash_db.chunks is None:
+                hash_db.chunks = OrderedDict()
+            hash_db.chunks[chunk_hash] = Chunk(chunk_hash, size, data_root, disc_num, pack, pack_offset)
+            self._chunks[chunk_hash] = row
+
+    def _save_chunks(self, hash_db):
+        if self._chunks is None:  # New database so replace whatever was there
+            self.connection.execute("DELETE FROM chunks")
+            self._chunks = {}
+        chunks = getattr(hash_db, "chunks", None) or {}
+        changed = []
+        for chunk in chunks.values():
+            row = _chunk_row(chunk)
+            if self._chunks.get(chunk.file_hash) != row:
+                changed.append(row)
+                self._chunks[chunk.file_hash] = row
+        self.connection.executemany(
+            "INSERT INTO chunks VALUES (?, ?, ?, ?, ?) ON CONFLICT (chunk_hash) DO UPDATE SET"
+            " size=excluded.size, disc_num=excluded.disc_num, pack=excluded.pack, pack_offset=excluded.pack_offset",
+            changed,
+        )
+        removed = self._chunks.keys() - chunks.keys()
+        self.connection.executemany("DELETE FROM chunks WHERE chunk_hash=?", ((chunk_hash,) for chunk_hash in removed))
+        for chunk_hash in removed:
+            del self._chunks[chunk_hash]
+
+    def _save_hash_db(self, hash_db):
+        state = {
+            "iso_path_root": str(hash_db.iso_path_root),
+            "path": str(hash_db.hash_entries.path),
+        }
+        for key in HASH_DB_STATE:
+            state[key] = getattr(hash_db, key, None)
+        self._write_job("hash_db", state)
+        if self._hashes is None:  # New database so replace whatever was there
+            self.connection.execute("DELETE FROM hashes")
+            self.connection.execute("DELETE FROM hash_paths")
+            self._hashes = {}
+        changed_rows = []
+        changed_paths = []
+        for entry in hash_db.files():
+            row = _hash_row(entry)
+            paths = tuple(entry.filenames)
+            old = self._hashes.get(entry.file_hash)
+            if old is None or old[0] != row:
+                changed_rows.append(row)
+            if old is None or old[1] != paths:
+                changed_paths.append(entry.file_hash)
+            self._hashes[entry.file_hash] = (row, paths)
+        self.connection.executemany(
+            "INSERT INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (file_hash) DO UPDATE SET"
+            " size=excluded.size, mtime=excluded.mtime, disc_num=excluded.disc_num,"
+            " catalogue_num=excluded.catalogue_num, pack=excluded.pack, pack_offset=excluded.pack_offset,"
+            " chunks=excluded.chunks, block_crc32=excluded.block_crc32",
+            changed_rows,
+        )
+        removed = self._hashes.keys() - hash_db.hash_entries.keys()
+        for file_hash in removed:
+            del self._hashes[file_hash]
+        self.connection.executemany(
+            "DELETE FROM hashes WHERE file_hash=?", ((file_hash,) for file_hash in removed)
+        )
+        self.connection.executemany(
+            "DELETE FROM hash_paths WHERE file_hash=?",
+            ((file_hash,) for file_hash in list(removed) + changed_paths),
+        )
+        self.connection.executemany(
+            "INSERT INTO hash_paths VALUES (?, ?)",
+            (
+                (file_hash, udf_path)
+                for file_hash in changed_paths
+                for udf_path in self._hashes[file_hash][1]
+            ),
+        )
+        self._save_chunks(hash_db)
@@ -0,0 +1,460 @@
+"""Plans and carries out restoring files from the discs of an archive.
+
+restore_plan finds the files matching a pattern in catalogue.json and works out the discs to load: the fewest
+that hold every file, each loaded once, in disc order.  A file's contents are read once however many paths share
+them and written to all of those paths.  The plan is plain data (to_dict) so that a disc robot, or a person, can
+load the discs in turn and call restore_disc for each:
+
+    plan = restore_plan("catalogue.json", "/DATA/2012/")
+    for disc in plan.discs:
+        robot.load(disc.disc_num)
+        print(restore_disc(disc, "/dev/sr0", "restored"))
+
+The catalogue does not say where on a disc each file is so the reads of a disc are planned in path order.
+restore_disc puts them in extent order when it is given an image or a device, as verify_disc does.
+
+A chunked file (see chunker) may have chunks on several discs.  Each chunk is read once, checked and written at
+its offsets in the files being put together, then once every disc has been read finish_restore checks each of
+those files against its own hash and only then gives it its name.
+"""
+import datetime as dt
+import os
+from pathlib import Path, PurePosixPath
+import time
+
+from .consts import *
+from .catalogue import CatalogueReader
+from .chunker import chunk_label
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM, new_hash
+from .path_index import path_matcher
+from .verify import (
+    DEFAULT_READ_AHEAD,
+    READ_BLOCK_SIZE,
+    ReadAhead,
+    VerifyReport,
+    catalogue_algorithm,
+    catalogue_pack,
+    image_items,
+    mount_items,
+    open_image,
+    _disc_key,
+)
+
+
+class RestoreRead:
+    """One file or chunk read from a disc and written to one or more destinations"""
+
+    def __init__(self, disc_path, file_hash, size, mtime, destinations, pack=None, offsets=None):
+        """
+        :param disc_path: UDF path of the file on the disc, or chunk_label of a chunk
+        :param mtime: modification time as written in the catalogue, None for a chunk
+        :param destinations: paths relative to the restore directory
+        :param pack: (pack UDF path, offset) if the file is packed, see iso_layout, or for a chunk
+        :param offsets: for a chunk the offset in each destination it is written at, a destination appearing once
+            for each place the chunk is in it
+        """
+        self.disc_path = disc_path
+        self.file_hash = file_hash
+        self.size = size
+        self.mtime = mtime
+        self.destinations = destinations
+        self.pack = pack
+        self.offsets = offsets
+
+    def to_dict(self):
+        return {
+            "disc_path": self.disc_path,
+            "file_hash": self.file_hash,
+            "size": self.size,
+            "mtime": self.mtime,
+            "destinations": self.destinations,
+            "pack": None if self.pack is None else self.pack[0],
+            "pack_offset": None if self.pack is None else self.pack[1],
+            "offsets": self.offsets,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["disc_path"],
+            data["file_hash"],
+            data["size"],
+            data["mtime"],
+            data["destinations"],
+            catalogue_pack(data),
+            data.get("offsets"),
+        )
+
+
+class RestoreDisc:
+    """The reads from one disc"""
+
+    def __init__(self, disc_num, reads=None, hash_algorithm=DEFAULT_HASH_ALGORITHM):
+        self.disc_num = disc_num
+        self.reads = reads if reads is not None else []
+        self.hash_algorithm = hash_algorithm
+
+    @property
+    def size(self):
+        return sum(read.size for read in self.reads)
+
+    def to_dict(self):
+        return {
+            "disc_num": self.disc_num,
+            "hash_algorithm": self.hash_algorithm,
+            "reads": [read.to_dict() for read in self.reads],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["disc_num"],
+            [RestoreRead.from_dict(read) for read in data["reads"]],
+            data.get("hash_algorithm", DEFAULT_HASH_ALGORITHM),
+        )
+
+
+class RestorePlan:
+    """The discs to load, in order, to restore the files matching pattern"""
+
+    def __init__(self, pattern, discs=None, assemble=None, hash_algorithm=DEFAULT_HASH_ALGORITHM):
+        """
+        :param assemble: {"file_hash", "size", "mtime", "destinations"} of each chunked file, see finish_restore
+        :param hash_algorithm: algorithm of the archive's hashes, see hash_algorithms
+        """
+        self.pattern = pattern
+        self.discs = discs if discs is not None else []
+        self.assemble = assemble if assemble is not None else []
+        self.hash_algorithm = hash_algorithm
+
+    @property
+    def files(self):
+        whole = sum(len(read.destinations) for disc in self.discs for read in disc.reads if read.offsets is None)
+        return whole + sum(len(chunked["destinations"]) for chunked in self.assemble)
+
+    @property
+    def size(self):
+        return sum(disc.size for disc in self.discs)
+
+    def to_dict(self):
+        return {
+            "pattern": self.pattern,
+            "hash_algorithm": self.hash_algorithm,
+            "discs": [disc.to_dict() for disc in self.discs],
+            "assemble": self.assemble,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data["pattern"],
+            [RestoreDisc.from_dict(disc) for disc in data["discs"]],
+            data.get("assemble"),
+            data.get("hash_algorithm", DEFAULT_HASH_ALGORITHM),
+        )
+
+    def __str__(self):
+        result = f"Restoring {self.pattern}, {self.files:,} files, {self.size:,} bytes from {len(self.discs)} discs\n"
+        for disc in self.discs:
+            result += f"  Disc {disc.disc_num}: {len(disc.reads):,} reads, {disc.size:,} bytes\n"
+        return result
+
+
+def choose_discs(locations):
+    """Picks the fewest discs holding every file.  Files only on one disc decide those discs, then the disc holding
+    the most files still needed is taken in turn, the lowest numbered on a tie.
+    :param locations: file_hash -> discs holding it
+    :return: file_hash -> disc to read it from
+    """
+    chosen = {}
+    taken = set()
+    for file_hash, discs in locations.items():
+        if len(discs) == 1:
+            chosen[file_hash] = next(iter(discs))
+            taken.add(chosen[file_hash])
+    needed = {file_hash: discs for file_hash, discs in locations.items() if file_hash not in chosen}
+    while needed:
+        counts = {}
+        for file_hash, discs in needed.items():
+            on_taken = [disc_num for disc_num in discs if disc_num in taken]
+            if on_taken:
+                chosen[file_hash] = min(on_taken, key=_disc_key)
+            else:
+                for disc_num in discs:
+                    counts[disc_num] = counts.get(disc_num, 0) + 1
+        needed = {file_hash: discs for file_hash, discs in needed.items() if file_hash not in chosen}
+        if counts:
+            taken.add(max(counts, key=lambda disc_num: (counts[disc_num], -_disc_key(disc_num))))
+    return chosen
+
+
+def _destination(path, data_root):
+    """Path of a restored file relative to the restore directory"""
+    path = PurePosixPath(path)
+    if path.is_relative_to(data_root):
+        path = path.relative_to(data_root)
+    parts = [part for part in path.parts if part != "/"]
+    if ".." in parts:
+        raise PyArchiveError(f"Will not restore {path} outside the restore directory")
+    return "/".join(parts)
+
+
+def restore_plan(catalogue, pattern, data_root="/DATA"):
+    """Plans restoring the files matching pattern, as "pyarchive find" matches them, from the discs of the catalogue.
+    :param catalogue: path of catalogue.json, eg from any disc of the archive
+    :param data_root: UDF directory of the archived files, paths are restored relative to it
+    :return: RestorePlan
+    """
+    matches = path_matcher(pattern)
+    locations = {}
+    reads = {}
+    assemble = []
+    chunked = []
+    with open(str(catalogue), encoding="utf-8") as f:
+        reader = CatalogueReader(f)
+        for file_hash, data in reader:
+            filenames = list(data["filenames"])
+            destinations = [_destination(filename, data_root) for filename in filenames if matches(filename)]
+            if not destinations:
+                continue
+            if "chunks" in data:  # The chunk table comes after the files
+                chunked.append((data["chunks"], destinations))
+                assemble.append(
+                    {"file_hash": file_hash, "size": data["size"], "mtime": data["mtime"], "destinations": destinations}
+                )
+                continue
+            locations[file_hash] = {data.get("disc_num")}
+            reads[file_hash] = RestoreRead(
+                filenames[0], file_hash, data["size"], data["mtime"], destinations, catalogue_pack(data)
+            )
+        chunk_table = reader.header.get("chunks", {})
+        algorithm = catalogue_algorithm(reader)
+    for chunks, destinations in chunked:
+        offset = 0
+        for chunk_hash in chunks:
+            data = chunk_table[chunk_hash]
+            label = chunk_label(chunk_hash)  # Keyed apart from a whole file with the same contents
+            if label not in reads:
+                locations[label] = {data.get("disc_num")}
+                reads[label] = RestoreRead(label, chunk_hash, data["size"], None, [], catalogue_pack(data), [])
+            for destination in destinations:
+                reads[label].destinations.append(destination)
+                reads[label].offsets.append(offset)
+            offset += data["size"]
+    if not reads:
+        raise PyArchiveError(f"No files in {catalogue} match {pattern}")
+    by_disc = {}
+    for key, disc_num in choose_discs(locations).items():
+        by_disc.setdefault(disc_num, []).append(reads[key])
+    plan = RestorePlan(pattern, assemble=assemble, hash_algorithm=algorithm)
+    for disc_num in sorted(by_disc, key=_disc_key):
+        reads = sorted(by_disc[disc_num], key=lambda read: read.pack or (read.disc_path, 0))
+        plan.discs.append(RestoreDisc(disc_num, reads, algorithm))
+    return plan
+
+
+class RestoreReport(VerifyReport):
+    """Outcome of restore_disc"""
+
+    action = "Restored"
+
+
+class _Outputs:
+    """Files being written for one read, to temporary names until the hash is checked"""
+
+    def __init__(self, read, dest):
+        self.paths = [Path(dest) / destination for destination in read.destinations]
+        self.files = []
+        for path in self.paths:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.files.append(open(self._temp(path), "wb"))
+
+    @staticmethod
+    def _temp(path):
+        return path.with_name(path.name + ".part")
+
+    def write(self, block):
+        for f in self.files:
+            f.write(block)
+
+    def keep(self, mtime):
+        self.close()
+        for path in self.paths:
+            _rename(self._temp(path), path, mtime)
+
+    def discard(self):
+        self.close()
+        for path in self.paths:
+            try:
+                os.remove(self._temp(path))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+
+
+class _ChunkOutputs:
+    """Places a chunk is written to in the files being put together.  It is written straight to the first place as
+    it is read, so that a spanned piece as big as a disc (see spanning) is never held in memory, and copied from
+    there to the others once its hash is checked.  If the hash doesn't match what was written is cleared."""
+
+    def __init__(self, read, dest):
+        self.places = [
+            (_Outputs._temp(Path(dest) / destination), offset)
+            for destination, offset in zip(read.destinations, read.offsets)
+        ]
+        path, offset = self.places[0]
+        self.file = _open_at(path, offset)
+        self.written = 0
+
+    def write(self, block):
+        self.file.write(block)
+        self.written += len(block)
+
+    def keep(self, mtime):
+        self.file.flush()
+        source, start = self.places[0]
+        for path, offset in self.places[1:]:
+            with _open_at(path, offset) as f:
+                self.file.seek(start)
+                left = self.written
+                while left:
+                    block = self.file.read(min(READ_BLOCK_SIZE, left))
+                    f.write(block)
+                    left -= len(block)
+        self.close()
+
+    def discard(self):
+        if self.file is None:
+            return
+        _, offset = self.places[0]
+        if self.file.seek(0, os.SEEK_END) <= offset + self.written:  # Nothing after it, just cut it off
+            self.file.truncate(offset)
+        else:
+            self.file.seek(offset)
+            left = self.written
+            zeros = bytes(READ_BLOCK_SIZE)
+            while left:
+                left -= self.file.write(zeros[: min(READ_BLOCK_SIZE, left)])
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def _open_at(path, offset):
+    """path opened for writing at offset, keeping whatever else has been written to it"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    f = open(path, "r+b" if path.exists() else "w+b")
+    f.seek(offset)
+    return f
+
+
+def _rename(temp, path, mtime):
+    """Gives a checked file its name and catalogued modification time"""
+    timestamp = dt.datetime.strptime(mtime, CATALOGUE_TIME_FORMAT).timestamp()
+    os.replace(temp, path)
+    os.utime(path, (timestamp, timestamp))
+
+
+def restore_disc(disc, source, dest, read_ahead=DEFAULT_READ_AHEAD):
+    """Restores the reads of disc (a RestoreDisc) from source, a mounted disc (directory), an image or a device,
+    into the directory dest.  Each file is checked against its hash and only kept if it matches.
+    :return: RestoreReport
+    """
+    source = Path(source)
+    report = RestoreReport(source, disc.disc_num)
+    entries = [(read.disc_path, read.file_hash, read.size, read.pack) for read in disc.reads]
+    if source.is_dir():
+        items = mount_items(source, entries, report.failures)
+        image = None
+    else:
+        iso = open_image(source)
+        try:
+            items = image_items(iso, entries, report.failures)
+        finally:
+            iso.close()
+        image = str(source)
+    reads = {read.disc_path: read for read in disc.reads}
+    start = time.perf_counter()
+    reader = ReadAhead(items, image, read_ahead)
+    outputs = None
+    digest = None
+    try:
+        for index, block in reader:
+            if index < 0:
+                raise PyArchiveError(f"Cannot read {source}: {block}")
+            path, file_hash, _, _ = items[index]
+            if outputs is None:
+                outputs = (_Outputs if reads[path].offsets is None else _ChunkOutputs)(reads[path], dest)
+                digest = new_hash(disc.hash_algorithm)
+            if isinstance(block, Exception):
+                outputs.discard()
+                report.failures.append((path, f"read error: {block}"))
+            elif block is None:
+                actual = digest.hexdigest()
+                if actual == file_hash:
+                    outputs.keep(reads[path].mtime)
+                    report.files += 1
+                else:
+                    outputs.discard()
+                    report.failures.append((path, f"hash {actual} expected {file_hash}"))
+            else:
+                digest.update(block)
+                outputs.write(block)
+                report.bytes += len(block)
+                continue
+            outputs = None
+    finally:
+        reader.close()
+        if outputs is not None:
+            outputs.discard()
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+class AssembleReport(RestoreReport):
+    """Outcome of finish_restore"""
+
+    action = "Assembled"
+
+    @property
+    def title(self):
+        return f"{self.action} chunked files in {self.source}"
+
+
+def finish_restore(plan, dest):
+    """Checks each chunked file of plan, put together in the directory dest by restore_disc for every disc of plan,
+    against its hash and only then gives it its name.
+    :return: RestoreReport
+    """
+    report = AssembleReport(dest, None)
+    start = time.perf_counter()
+    for chunked in plan.assemble:
+        for destination in chunked["destinations"]:
+            path = Path(dest) / destination
+            temp = _Outputs._temp(path)
+            digest = new_hash(plan.hash_algorithm)
+            try:
+                with open(temp, "r+b") as f:
+                    f.truncate(chunked["size"])
+                    for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+                        digest.update(block)
+                        report.bytes += len(block)
+            except OSError as e:
+                report.failures.append((destination, f"not put together: {e}"))
+                continue
+            actual = digest.hexdigest()
+            if actual == chunked["file_hash"]:
+                _rename(temp, path, chunked["mtime"])
+                report.files += 1
+            else:
+                os.remove(temp)
+                report.failures.append((destination, f"hash {actual} expected {chunked['file_hash']}"))
+    report.seconds = time.perf_counter() - start
+    return report
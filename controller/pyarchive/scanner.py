@@ -0,0 +1,112 @@
+"""Walks a directory tree with os.scandir.
+Each file costs exactly one stat: DirEntry.stat(follow_symlinks=False) gives size, mtime and type together and
+is handed on to FileEntry rather than stat'ing the file again.  The exception is Windows, where that stat has no
+device or inode number, which the hash cache and finding hard links need, so there each file is lstat'ed as well.
+Paths are kept as strings; building a Path is left to whoever needs one.
+
+The order is depth first and top down like os.walk, but the names within each directory are sorted so that the
+same tree is always scanned in the same order whatever the file system returns.  As with os.walk symlinks to
+directories are not followed and are not reported as files.
+
+On a network share the time goes on round trips rather than bandwidth, so scan_tree_threaded lists the next few
+directories due to be scanned in a thread pool while the current one is being reported.  It yields exactly the
+same entries in exactly the same order as scan_tree.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+from sys import stderr
+import time
+
+
+class ScanStats:
+    """Counts what a scan has done so that the scan rate can be reported"""
+
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.seconds = 0.0
+
+    @property
+    def files_per_sec(self):
+        return self.files / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return f"{self.files:,} files in {self.dirs:,} dirs in {self.seconds:.1f} s = {self.files_per_sec:,.0f} files/s"
+
+
+def list_directory(dirpath):
+    """Lists one directory.
+    Returns (files, subdirs) where files is a list of (dirpath, name, stat_result) and subdirs is a list of
+    directory paths, both sorted by name."""
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_symlink() and entry.is_dir():
+                        pass  # Symlink to a directory, os.walk neither follows nor lists it as a file
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        if not st.st_ino:  # Windows leaves st_dev and st_ino 0 here, lstat fills them in
+                            st = os.lstat(entry.path)
+                        files.append((dirpath, entry.name, st))
+                except OSError as e:  # Vanished since listing or no permission
+                    stderr.write(f"Skipping {entry.path}: {e}\n")
+    except OSError as e:
+        stderr.write(f"Can't scan {dirpath}: {e}\n")
+    files.sort(key=lambda f: f[1])
+    subdirs.sort()
+    return files, subdirs
+
+
+def scan_tree(root, stats=None):
+    """Yields (dirpath, name, stat_result) for every file and symlink under root.
+    :param root: string path of the top directory
+    :param stats: optional ScanStats which is updated as the scan proceeds
+    """
+    start = time.perf_counter()
+    stack = [root]
+    while stack:
+        dirpath = stack.pop()
+        files, subdirs = list_directory(dirpath)
+        if stats is not None:
+            stats.dirs += 1
+            stats.files += len(files)
+        yield from files
+        stack.extend(reversed(subdirs))  # So that the first subdirectory is scanned next
+        if stats is not None:
+            stats.seconds = time.perf_counter() - start
+
+
+def scan_tree_threaded(root, stats=None, workers=8, max_pending=None):
+    """Same as scan_tree but directories are listed concurrently by a pool of worker threads.
+    The stack of directories still to scan is in the order they will be reported, so the listings requested are
+    always the next ones needed: siblings and the first children of the directory being reported.
+    :param workers: number of listing threads
+    :param max_pending: most directory listings that are queued, running or finished but not yet reported.
+        Defaults to four per worker.
+    """
+    if max_pending is None:
+        max_pending = workers * 4
+    start = time.perf_counter()
+    listings = {}  # dirpath -> Future of list_directory
+    stack = [root]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while stack:
+            for dirpath in reversed(stack[-max_pending:]):
+                if len(listings) >= max_pending:
+                    break
+                if dirpath not in listings:
+                    listings[dirpath] = pool.submit(list_directory, dirpath)
+            dirpath = stack.pop()
+            files, subdirs = listings.pop(dirpath).result()
+            if stats is not None:
+                stats.dirs += 1
+                stats.files += len(files)
+            yield from files
+            stack.extend(reversed(subdirs))
+            if stats is not None:
+                stats.seconds = time.perf_counter() - start
@@ -0,0 +1,235 @@
+"""Strategies for allocating entries to discs.
+
+    next-fit             - entries in catalogue order, a new disc is started as soon as the next entry doesn't fit.
+                           This is what segment has always done; it keeps each directory together but leaves
+                           space at the end of every disc.
+    first-fit-decreasing - largest entries first, each onto the lowest numbered disc it fits on.  Packs tightest.
+    best-fit-locality    - entries are grouped by directory and, largest group first, each group goes onto the
+                           disc it fills most tightly, so a directory is normally all on one disc.  A directory
+                           bigger than a disc is cut into disc sized runs in catalogue order first.
+
+All run in O(n log n) for n entries.  Sizes are in sectors from iso_layout.  The size of a disc is exact but
+the first-fit and best-fit searches use the iso_layout bounds for an entry (or a run) so that it is sure to fit
+on the disc chosen.  Each returns a DiscLayout for each disc and sets disc_num on every entry, and the DiscLayout
+sets the pack of any small file it packs, see iso_layout.
+
+Given a Spanner a file too big for a disc is cut into pieces rather than being an error, and next-fit and
+first-fit-decreasing may cut a file to top up a disc.  Next-fit cuts a file as it places it so its pieces are on
+consecutive discs.  The others cut files too big for a disc first and place the pieces by size so they need not
+be, see spanning.
+"""
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from .consts import *
+from .iso_layout import directory_bound, file_bound, pack_bound
+
+SEGMENT_NEXT_FIT = "next-fit"
+SEGMENT_FIRST_FIT_DECREASING = "first-fit-decreasing"
+SEGMENT_BEST_FIT_LOCALITY = "best-fit-locality"
+SEGMENT_STRATEGIES = (SEGMENT_NEXT_FIT, SEGMENT_FIRST_FIT_DECREASING, SEGMENT_BEST_FIT_LOCALITY)
+
+
+class _FirstFitTree:
+    """Max segment tree over the free space of each disc so that the lowest numbered disc with enough space is
+    found in O(log discs)."""
+
+    def __init__(self):
+        self.leaves = 1
+        self.tree = [0, 0]  # tree[leaves + i] is free space on disc i, unopened discs have 0
+        self.count = 0
+
+    def _set(self, i, free):
+        i += self.leaves
+        self.tree[i] = free
+        i //= 2
+        while i:
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+            i //= 2
+
+    def open_disc(self, free):
+        if self.count == self.leaves:  # Double the tree
+            leaves = self.tree[self.leaves : self.leaves + self.count]
+            self.leaves *= 2
+            self.tree = [0] * (2 * self.leaves)
+            self.tree[self.leaves : self.leaves + self.count] = leaves
+            for i in range(self.leaves - 1, 0, -1):
+                self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+        self.count += 1
+        self._set(self.count - 1, free)
+        return self.count - 1
+
+    def find(self, size):
+        """Lowest numbered disc with at least size free, or None"""
+        if self.tree[1] < size:
+            return None
+        i = 1
+        while i < self.leaves:
+            i = 2 * i if self.tree[2 * i] >= size else 2 * i + 1
+        return i - self.leaves
+
+    def use(self, disc_num, size):
+        self._set(disc_num, self.tree[self.leaves + disc_num] - size)
+
+
+def next_fit(entries, capacity, new_disc, spanner=None):
+    empty = new_disc()
+    room = capacity - empty.sectors
+    discs = [new_disc()]
+    for entry in entries:
+        disc = discs[-1]
+        pieces = [entry]
+        if spanner is not None and disc.cost(entry) > capacity - disc.sectors:
+            pieces = spanner.span(entry, disc, capacity - disc.sectors, empty, room)
+        for piece in pieces:
+            if spanner is not None and not spanner.keep(piece):
+                continue
+            if discs[-1].cost(piece) > capacity - discs[-1].sectors:
+                discs.append(new_disc())
+            discs[-1].add(piece)
+            piece.disc_num = len(discs) - 1
+    return discs
+
+
+def first_fit_decreasing(entries, capacity, new_disc, spanner=None):
+    bound = new_disc().bound
+    sized = sorted(((directory_bound(entry.directory) + bound(entry), i, entry) for i, entry in enumerate(entries)), key=lambda s: (-s[0], s[1]))
+    tree = _FirstFitTree()
+    discs = []
+    for entry_bound, _, entry in sized:
+        disc_num = tree.find(entry_bound)
+        while disc_num is None and spanner is not None and discs:  # Top up the disc with the most space
+            most = tree.find(tree.tree[1])
+            head, entry = spanner.top_up(discs[most], tree.tree[tree.leaves + most], entry)
+            if head is None:
+                break
+            if spanner.keep(head):
+                tree.use(most, discs[most].add(head))
+                head.disc_num = most
+            disc_num = tree.find(directory_bound(entry.directory) + bound(entry))
+        if spanner is not None and not spanner.keep(entry):
+            continue
+        if disc_num is None:
+            discs.append(new_disc())
+            disc_num = tree.open_disc(capacity - discs[-1].sectors)
+        disc = discs[disc_num]
+        tree.use(disc_num, disc.add(entry))
+        entry.disc_num = disc_num
+    return discs
+
+
+def _directory_runs(entries, room, is_packed):
+    """Groups entries by directory, cutting any directory too big for the room on an empty disc into runs that fit.
+    The packed files of a run share a pack so are bounded together.
+    Returns a list of (upper bound in sectors, entries)."""
+    directories = OrderedDict()
+    for entry in entries:
+        directories.setdefault(entry.directory, []).append(entry)
+
+    def added_bound(entry, packed):
+        """Bound of adding entry to a run whose packed files come to packed bytes, None if it has none"""
+        if not is_packed(entry):
+            return file_bound(entry)
+        if packed is None:
+            return pack_bound(entry.size)
+        return pack_bound(packed + entry.size) - pack_bound(packed)
+
+    runs = []
+    for directory, members in directories.items():
+        run, run_bound, packed = [], directory_bound(directory), None
+        for entry in members:
+            bound = added_bound(entry, packed)
+            if run and run_bound + bound > room:
+                runs.append((run_bound, run))
+                run, run_bound, packed = [], directory_bound(directory), None
+                bound = added_bound(entry, packed)
+            run.append(entry)
+            run_bound += bound
+            if is_packed(entry):
+                packed = (packed or 0) + entry.size
+        runs.append((run_bound, run))
+    return runs
+
+
+def best_fit_locality(entries, capacity, new_disc):
+    empty = new_disc()
+    runs = _directory_runs(entries, capacity - empty.sectors, empty.is_packed)
+    runs = sorted(enumerate(runs), key=lambda r: (-r[1][0], r[0]))
+    free = []  # Sorted (free sectors, disc_num) of each disc
+    discs = []
+    for _, (bound, run) in runs:
+        i = bisect_left(free, (bound, -1))  # Smallest free space that is enough
+        if i < len(free):
+            _, disc_num = free.pop(i)
+        else:
+            disc_num = len(discs)
+            discs.append(new_disc())
+        disc = discs[disc_num]
+        for entry in run:
+            disc.add(entry)
+            entry.disc_num = disc_num
+        insort(free, (capacity - disc.sectors, disc_num))
+    return discs
+
+
+STRATEGY_FUNCTIONS = {
+    SEGMENT_NEXT_FIT: next_fit,
+    SEGMENT_FIRST_FIT_DECREASING: first_fit_decreasing,
+    SEGMENT_BEST_FIT_LOCALITY: best_fit_locality,
+}
+
+
+def segment_entries(entries, capacity, new_disc, strategy=SEGMENT_NEXT_FIT, spanner=None):
+    """Allocates each entry to a disc.
+    :param entries: list of HashFileEntry
+    :param capacity: sectors available on each disc
+    :param new_disc: function returning an empty DiscLayout
+    :param spanner: spanning.Spanner to cut files too big for a disc, and to top up discs, None to keep all whole
+    :return: list of DiscLayout, one for each disc
+    """
+    try:
+        allocate = STRATEGY_FUNCTIONS[strategy]
+    except KeyError:
+        raise PyArchiveError(f"Unknown segment strategy {strategy}, expected one of {SEGMENT_STRATEGIES}")
+    empty = new_disc()
+    room = capacity - empty.sectors
+    result = []
+    for entry in entries:
+        if directory_bound(entry.directory) + empty.bound(entry) > room and empty.cost(entry) > room:
+            if spanner is None or not spanner.can_cut(entry):
+                raise PyArchiveError(
+                    f"Disc too small, cannot fit file {entry.filename} of {entry.size:,} bytes on a disc with overhead."
+                )
+            if strategy != SEGMENT_NEXT_FIT:  # They place the pieces by size so cut it now
+                result.extend(spanner.split(entry, empty, room))
+                continue
+        result.append(entry)
+    if strategy == SEGMENT_BEST_FIT_LOCALITY:  # Cuts nothing more so the pieces are final
+        discs = allocate([entry for entry in result if spanner is None or spanner.keep(entry)], capacity, new_disc)
+    else:
+        discs = allocate(result, capacity, new_disc, spanner)
+    return _drop_empty(discs, result + (list(spanner.pieces.values()) if spanner is not None else []))
+
+
+def _drop_empty(discs, entries):
+    """Numbers the discs that have anything on them from 0 up, dropping any that are empty"""
+    if all(disc.entries for disc in discs):
+        return discs
+    numbers = {}
+    for disc_num, disc in enumerate(discs):
+        if disc.entries:
+            numbers[disc_num] = len(numbers)
+    for entry in entries:
+        if entry.disc_num is not None:
+            entry.disc_num = numbers.get(entry.disc_num, entry.disc_num)
+    return [disc for disc in discs if disc.entries] or discs[:1]
+
+
+def fill_report(disc_usage, segment_size):
+    """Text report of how full each disc is"""
+    result = ""
+    for disc_num, used in enumerate(disc_usage):
+        result += f"  Disc {disc_num:4} {used:>17,} bytes {used / segment_size:7.2%} full\n"
+    if disc_usage:
+        result += f"  Mean fill {sum(disc_usage) / (len(disc_usage) * segment_size):.2%}\n"
+    return result
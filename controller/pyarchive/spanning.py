@@ -0,0 +1,178 @@
+"""Spanning a file over several discs.
+
+A file too big for an empty disc is cut into pieces that each fill a disc, and with a minimum piece size
+(segment --span-min) the next-fit and first-fit-decreasing strategies also cut a file that doesn't fit so that its
+head tops up the space left at the end of a disc.  Best-fit-locality keeps its files whole unless they are too
+big for a disc.
+
+Next-fit cuts a file as it places it: the head tops up the last disc and each piece after it starts the next new
+disc, so the pieces of a file are on consecutive discs, one to a disc.  First-fit-decreasing and best-fit-locality
+place entries by size so a file too big for a disc is cut into disc sized pieces before they start.  Those fill
+new discs one after another but the last, smaller, piece is placed like any other entry, so the pieces of a file
+need not be on consecutive discs.  A piece which fills a disc is never cut again to top up another.
+
+The segmenter places each piece like a chunk, packed into the data root (see iso_layout).  Just before a piece
+goes onto a disc its part of the file is read and hashed, and as with chunks each distinct piece is stored once:
+a piece the same as one already going on the discs, eg of a disc image full of zeros, is left off and takes no
+space.  HashDatabase.segment then turns the pieces into Chunks, so that the catalogue lists the pieces of a spanned
+file in order under "chunks" and verify and restore treat it just as they do a chunked file, see chunker.  Each
+piece is checked as its disc is read and the file is put together and checked against its own hash once every
+disc has been read.
+"""
+import os
+
+from .consts import *
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM, new_hash
+from .iso_layout import SECTOR_SIZE
+
+SPAN_READ_SIZE = 1024 * 1024
+
+
+class SpanPiece:
+    """size bytes of entry from offset on, placed on a disc by the segmenter like a Chunk"""
+
+    __slots__ = ("entry", "offset", "size", "directory", "disc_num", "pack", "pack_offset", "piece_hash")
+
+    def __init__(self, entry, offset, size, directory):
+        """
+        :param directory: UDF directory the piece is packed into, the data root
+        """
+        self.entry = entry
+        self.offset = offset
+        self.size = size
+        self.directory = directory
+        self.disc_num = None
+        self.pack = None
+        self.pack_offset = None
+        self.piece_hash = None  # Set by Spanner.keep
+
+    @property
+    def name(self):
+        return f"{self.entry.file_hash}+{self.offset}"
+
+    @property
+    def filename(self):
+        return f"{self.entry.filename} from byte {self.offset:,}"
+
+
+class Spanner:
+    """Cuts entries into SpanPieces for the segmenter and keeps track of the pieces that are left"""
+
+    def __init__(self, spannable, data_root, min_size=0, algorithm=DEFAULT_HASH_ALGORITHM, stored=()):
+        """
+        :param spannable: function of an entry which is True if it may be cut
+        :param min_size: smallest piece cut to top up a disc, 0 to only cut entries too big for a disc
+        :param algorithm: hash algorithm of the archive, see hash_algorithms
+        :param stored: hashes of the chunks going on the discs, a piece the same as one of them is left off
+        """
+        self.spannable = spannable
+        self.data_root = data_root
+        self.min_size = min_size
+        self.algorithm = algorithm
+        self.stored = set(stored)
+        self.pieces = {}  # id -> SpanPiece, those cut again are dropped
+        self.filling = set()  # ids of the pieces cut to fill an empty disc
+
+    def can_cut(self, entry):
+        return isinstance(entry, SpanPiece) or self.spannable(entry)
+
+    def fit(self, disc, free, entry):
+        """Most bytes from the start of entry which go in free sectors of disc, 0 if none do"""
+        whole, offset = (entry.entry, entry.offset) if isinstance(entry, SpanPiece) else (entry, 0)
+        size = min(entry.size, free * SECTOR_SIZE)
+        while size > 0:
+            over = disc.cost(SpanPiece(whole, offset, size, self.data_root)) - free
+            if over <= 0:
+                return size
+            size -= over * SECTOR_SIZE
+        return 0
+
+    def cut(self, entry, size):
+        """Returns (the first size bytes of entry, the rest) as SpanPieces"""
+        if isinstance(entry, SpanPiece):
+            self.pieces.pop(id(entry), None)
+            whole, offset = entry.entry, entry.offset
+        else:
+            whole, offset = entry, 0
+        head = SpanPiece(whole, offset, size, self.data_root)
+        rest = SpanPiece(whole, offset + size, entry.size - size, self.data_root)
+        self.pieces[id(head)] = head
+        self.pieces[id(rest)] = rest
+        return head, rest
+
+    def keep(self, entry):
+        """Called just before entry goes on a disc.  A piece is hashed and False is returned if the same data is
+        already going on the discs, when it is to be left off."""
+        if not isinstance(entry, SpanPiece):
+            return True
+        entry.piece_hash = hash_piece(entry.entry, entry.offset, entry.size, self.algorithm)
+        if entry.piece_hash in self.stored:
+            return False
+        self.stored.add(entry.piece_hash)
+        return True
+
+    def split(self, entry, empty, room):
+        """Cuts entry into pieces which each fill an empty disc with room free sectors"""
+        result = []
+        while entry.size > 0:
+            size = self.fit(empty, room, entry)
+            if size >= entry.size:
+                break
+            if size <= 0:
+                raise PyArchiveError(f"Disc too small, cannot fit any of file {entry.filename} on a disc with overhead.")
+            head, entry = self.cut(entry, size)
+            self.filling.add(id(head))
+            result.append(head)
+        return result + [entry]
+
+    def top_up(self, disc, free, entry):
+        """Cuts entry so that its head fills the free sectors of disc if both parts are at least min_size bytes.
+        Returns (head or None, the rest).  A piece which fills an empty disc is left whole."""
+        if not self.min_size or not self.can_cut(entry) or id(entry) in self.filling:
+            return None, entry
+        size = self.fit(disc, free, entry)
+        if size < self.min_size or entry.size - size < self.min_size:
+            return None, entry
+        return self.cut(entry, size)
+
+    def span(self, entry, disc, free, empty, room):
+        """Cuts entry, which doesn't fit in the free sectors of disc, for placing on disc and the discs after it.
+        Returns the head that tops up disc, if it is cut to, followed by pieces which each fill an empty disc with
+        room free sectors, the last holding the rest.  That is [entry] if it is not cut at all.
+        :param disc: last disc, None if there are none yet
+        """
+        head, rest = (None, entry) if disc is None else self.top_up(disc, free, entry)
+        return ([] if head is None else [head]) + self.split(rest, empty, room)
+
+    def spanned(self):
+        """{entry: its pieces in file order} of the entries that were cut"""
+        result = {}
+        for piece in sorted(self.pieces.values(), key=lambda p: p.offset):
+            result.setdefault(piece.entry, []).append(piece)
+        return result
+
+
+def max_pieces(sizes, disc_size, top_ups=0):
+    """Most pieces that files of sizes bytes could be cut into, for allowing for them in the catalogue
+    :param top_ups: most discs that may be topped up
+    """
+    half = disc_size // 2  # Far less than the room on an empty disc
+    return sum(size // half + 1 for size in sizes if size > half) + top_ups
+
+
+def hash_piece(entry, offset, size, algorithm=DEFAULT_HASH_ALGORITHM):
+    """Hex digest of size bytes from offset on of the file of entry, which must not have changed since it was hashed"""
+    path = str(entry.file_system_path)
+    st = os.stat(path)
+    if st.st_size != entry.size or int(st.st_mtime) != int(entry.mtime):
+        raise PyArchiveError(f"{path} has changed since it was hashed so cannot be spanned")
+    result = new_hash(algorithm)
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while size > 0:
+            data = f.read(min(SPAN_READ_SIZE, size))
+            if not data:
+                raise PyArchiveError(f"{path} has changed since it was hashed so cannot be spanned")
+            result.update(data)
+            size -= len(data)
+    return result.hexdigest()
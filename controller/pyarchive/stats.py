@@ -0,0 +1,88 @@
+"""Running statistics of a set of entries so that get_info doesn't rescan the archive.
+
+Entries are added and removed with the size and directory they had at the time, so a database keeps its
+statistics up to date as entries come and go, and reading them is O(1).
+"""
+from collections import Counter
+from pathlib import PurePosixPath
+
+
+class ArchiveStats:
+    def __init__(self, path_class=PurePosixPath, ancestors=True):
+        """
+        :param path_class: class of the directory paths, used to find parents and depths
+        :param ancestors: count every directory above those holding files, as is needed to make them on a disc,
+            otherwise only directories which hold files are counted
+        """
+        self.path_class = path_class
+        self.ancestors = ancestors
+        self.files = 0
+        self.bytes = 0
+        self.largest = 0
+        self._sizes = Counter()  # size -> number of files, to find the largest after one is removed
+        self._dirs = {}  # directory -> number of files in it (or below it)
+        self.depths = Counter()  # depth -> number of directories
+        self._at_depth = {}  # depth -> {directory: None}, to name one of the deepest directories
+
+    def _directories(self, directory):
+        """The directory and, if counting them, its ancestors below the root"""
+        yield directory
+        if self.ancestors:
+            path = self.path_class(directory)
+            while len(path.parts) > 2:
+                path = path.parent
+                yield str(path)
+
+    def _depth(self, directory):
+        return len(self.path_class(directory).parts) - 1
+
+    def add(self, size, directory):
+        self.files += 1
+        self.bytes += size
+        self._sizes[size] += 1
+        if size > self.largest:
+            self.largest = size
+        for this_dir in self._directories(directory):
+            count = self._dirs.get(this_dir, 0)
+            self._dirs[this_dir] = count + 1
+            if count == 0:
+                depth = self._depth(this_dir)
+                self.depths[depth] += 1
+                self._at_depth.setdefault(depth, {})[this_dir] = None
+
+    def remove(self, size, directory):
+        self.files -= 1
+        self.bytes -= size
+        self._sizes[size] -= 1
+        if not self._sizes[size]:
+            del self._sizes[size]
+            if size == self.largest:
+                self.largest = max(self._sizes, default=0)
+        for this_dir in self._directories(directory):
+            count = self._dirs[this_dir] - 1
+            if count:
+                self._dirs[this_dir] = count
+            else:
+                del self._dirs[this_dir]
+                depth = self._depth(this_dir)
+                self.depths[depth] -= 1
+                if not self.depths[depth]:
+                    del self.depths[depth]
+                del self._at_depth[depth][this_dir]
+                if not self._at_depth[depth]:
+                    del self._at_depth[depth]
+
+    @property
+    def dir_count(self):
+        return len(self._dirs)
+
+    @property
+    def max_depth(self):
+        return max(self.depths, default=0)
+
+    @property
+    def longest_dir(self):
+        """One of the deepest directories"""
+        if not self._at_depth:
+            return ""
+        return next(iter(self._at_depth[self.max_depth]))
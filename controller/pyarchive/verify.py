@@ -0,0 +1,357 @@
+"""Checks a burned disc, or its image, against the catalogue written on it.
+
+Files are read in the order of their data on the disc so that the drive only ever reads forwards, with a thread
+keeping read_ahead bytes queued while the main thread hashes.  An image or a device (eg /dev/sr0) is opened with
+pycdlib, which gives the extent of each file, and read directly.  A mounted disc does not show where its files
+are so they are read in path order, which is close to the order write_iso laid them out in.
+
+A chunked file (see chunker) is not on any disc as a whole, instead each of its chunks is checked against the
+chunk's hash on the disc holding it.  Files are hashed with the algorithm named in the catalogue, SHA-512 if it
+names none.
+
+If the catalogue has block CRC32s (see block_digests) they are checked along with the hash, so a file which fails
+is reported with its damaged blocks, and a quick check only checks them.
+"""
+import io
+from pathlib import Path
+import queue
+import threading
+import time
+
+import pycdlib
+
+from .consts import *
+from .catalogue import CatalogueReader
+from .chunker import chunk_label
+from .block_digests import BlockDigests, damaged_blocks, describe_blocks
+from .hash_algorithms import DEFAULT_HASH_ALGORITHM, check_algorithm, new_hash
+from .iso_layout import SECTOR_SIZE
+
+READ_BLOCK_SIZE = 1 << 20
+DEFAULT_READ_AHEAD = 64 << 20
+_DONE = None
+
+
+class VerifyReport:
+    """Outcome of verify_disc"""
+
+    action = "Verified"
+
+    def __init__(self, source, disc_num):
+        self.source = str(source)
+        self.disc_num = disc_num
+        self.files = 0
+        self.quick = 0  # Of the files, those checked by their block CRC32s alone
+        self.bytes = 0
+        self.seconds = 0.0
+        self.failures = []  # (udf path, reason)
+
+    @property
+    def ok(self):
+        return not self.failures
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    @property
+    def title(self):
+        return f"{self.action} disc {self.disc_num} from {self.source}"
+
+    def __str__(self):
+        result = f"{self.title}\n"
+        result += f"  Files checked = {self.files:,}\n"
+        if getattr(self, "quick", 0):
+            result += f"    by CRC32    = {self.quick:,}\n"
+        result += f"  Data read     = {self.bytes:,} bytes in {self.seconds:.1f}s, {self.bytes_per_sec / 1e6:.1f} MB/s\n"
+        result += f"  Failures      = {len(self.failures):,}\n"
+        for path, reason in self.failures:
+            result += f"    {path}: {reason}\n"
+        return result
+
+
+def catalogue_pack(data):
+    """(pack UDF path, offset) of a catalogue entry dict if the file is packed, see iso_layout, otherwise None"""
+    return (data["pack"], data["pack_offset"]) if data.get("pack") is not None else None
+
+
+def _disc_key(disc_num):
+    return -1 if disc_num is None else disc_num
+
+
+def _on_disc(entries, size_of):
+    """True if the mounted disc holds entries, found by a file which isn't packed, whose path is on just one disc, or
+    failing that by every pack being there at its full size, as every disc has packs of the same name
+    :param size_of: function of a UDF path returning the size of the file there or None if there is none
+    """
+    for path, _, _, pack in entries:
+        if pack is None:
+            return size_of(path) is not None
+    packs = {}
+    for _, _, size, (pack, offset) in entries:
+        packs[pack] = max(packs.get(pack, 0), offset + size)
+    return all(size_of(pack) == size for pack, size in packs.items())
+
+
+def _disc_entries(reader, disc_num=None, size_of=None):
+    """Returns (disc_num, [(udf path, file_hash, size, pack)], {file_hash: block CRC32s}) of the files and chunks
+    catalogued on the disc, pack being (pack UDF path, offset) for a packed file or a chunk, whose udf path is its
+    chunk_label.
+    A segmented catalogue is split by disc, if disc_num is None the disc is the one whose files exist, see _on_disc."""
+    by_disc = {}
+    block_crc32 = {}
+    for file_hash, data in reader:
+        if "chunks" in data:  # Checked chunk by chunk
+            continue
+        if "block_crc32" in data:
+            block_crc32[file_hash] = data["block_crc32"]
+        by_disc.setdefault(data.get("disc_num"), []).append(
+            (next(iter(data["filenames"])), file_hash, data["size"], catalogue_pack(data))
+        )
+    for chunk_hash, data in reader.header.get("chunks", {}).items():
+        by_disc.setdefault(data.get("disc_num"), []).append(
+            (chunk_label(chunk_hash), chunk_hash, data["size"], catalogue_pack(data))
+        )
+    if "last_disc_number" not in reader.header:  # Not segmented, everything is on the one disc
+        return None, [entry for entries in by_disc.values() for entry in entries], block_crc32
+    if disc_num is None:
+        found = [d for d in sorted(by_disc, key=_disc_key) if _on_disc(by_disc[d], size_of)]
+        if not found:
+            raise PyArchiveError("None of the catalogued files are on this disc")
+        if len(found) > 1:
+            raise PyArchiveError(f"Cannot tell which disc this is, it could be any of {found}, give the disc number")
+        disc_num = found[0]
+    return disc_num, by_disc.get(disc_num, []), block_crc32
+
+
+class ReadAhead:
+    """Reads each (udf path, file_hash, size, location) in turn on a thread, queueing (index, block) with a
+    None block at the end of each file or an exception if it could not be read"""
+
+    def __init__(self, items, image=None, read_ahead=DEFAULT_READ_AHEAD, block_size=READ_BLOCK_SIZE):
+        """
+        :param items: location is the byte offset in image, or (path, byte offset) of the file if there is no image
+        :param image: path of the image or device holding the files
+        """
+        self.items = items
+        self.image = image
+        self.block_size = block_size
+        self.blocks = queue.Queue(max(1, read_ahead // block_size))
+        self._stop = False
+        self._thread = threading.Thread(target=self._read, name="verify-read-ahead", daemon=True)
+        self._thread.start()
+
+    def _read_file(self, index, f, size):
+        left = size
+        while left and not self._stop:
+            block = f.read(min(self.block_size, left))
+            if not block:
+                raise PyArchiveError(f"Ended {left:,} bytes early")
+            self.blocks.put((index, block))
+            left -= len(block)
+
+    def _read(self):
+        image = None
+        try:
+            if self.image is not None:
+                image = open(self.image, "rb")
+            for index, (_, _, size, location) in enumerate(self.items):
+                if self._stop:
+                    break
+                try:
+                    if image is not None:
+                        image.seek(location)
+                        self._read_file(index, image, size)
+                    else:
+                        path, offset = location
+                        with open(path, "rb") as f:
+                            f.seek(offset)
+                            self._read_file(index, f, size)
+                    self.blocks.put((index, None))
+                except (OSError, PyArchiveError) as e:
+                    self.blocks.put((index, e))
+        except OSError as e:
+            self.blocks.put((-1, e))
+        finally:
+            if image is not None:
+                image.close()
+            self.blocks.put(_DONE)
+
+    def __iter__(self):
+        while True:
+            item = self.blocks.get()
+            if item is _DONE:
+                return
+            yield item
+
+    def close(self):
+        self._stop = True
+        while self._thread.is_alive():  # Unblock the reader
+            try:
+                self.blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def catalogue_algorithm(reader):
+    """Hash algorithm of the catalogue read by reader, once it has been read"""
+    return check_algorithm(reader.header.get("hash_algorithm", DEFAULT_HASH_ALGORITHM))
+
+
+def _check(
+    report, items, reader, algorithm=DEFAULT_HASH_ALGORITHM, block_crc32=None, block_size=None, quick=False
+):
+    """Hashes each file as its blocks come from reader.
+    :param block_crc32: file_hash -> block CRC32s of the files that have them, which are worked out as well
+    :param quick: only work out the block CRC32s of the files that have them
+    """
+    block_crc32 = block_crc32 if block_size else {}
+    digest = None
+    for index, block in reader:
+        if index < 0:
+            raise PyArchiveError(f"Cannot read {report.source}: {block}")
+        path, file_hash, size, _ = items[index]
+        expected_crc32 = block_crc32.get(file_hash)
+        crc_only = quick and expected_crc32 is not None
+        if digest is None:
+            digest = None if crc_only else new_hash(algorithm)
+            if expected_crc32 is not None:
+                digest = BlockDigests(block_size, digest)
+        if isinstance(block, Exception):
+            where = f" in block {digest.block:,}" if expected_crc32 is not None else ""
+            report.failures.append((path, f"read error{where}: {block}"))
+            digest = None
+        elif block is None:
+            damaged = damaged_blocks(expected_crc32, digest.crc32) if expected_crc32 is not None else []
+            if crc_only:
+                if damaged:
+                    report.failures.append((path, describe_blocks(damaged, block_size)))
+                report.quick += 1
+            else:
+                actual = digest.hexdigest()
+                if actual != file_hash:
+                    reason = f"hash {actual} expected {file_hash}"
+                    if damaged:
+                        reason += f", {describe_blocks(damaged, block_size)}"
+                    report.failures.append((path, reason))
+            report.files += 1
+            digest = None
+        else:
+            digest.update(block)
+            report.bytes += len(block)
+
+
+def image_items(iso, entries, failures):
+    """(udf path, file_hash, size, byte offset) of the (udf path, file_hash, size, pack) entries on the image in
+    extent order, adding (udf path, reason) to failures for those which are not there"""
+    items = []
+    packs = {}
+    for path, file_hash, size, pack in entries:
+        try:
+            if pack is None:
+                record = iso.get_record(udf_path=path)
+            elif pack[0] in packs:
+                record = packs[pack[0]]
+            else:
+                record = packs[pack[0]] = iso.get_record(udf_path=pack[0])
+        except pycdlib.pycdlibexception.PyCdlibException:
+            failures.append((path, "missing"))
+            continue
+        if pack is None:
+            size = record.get_data_length()  # The catalogue has the size of a symlink rather than of its target
+            location = record.inode.extent_location() * SECTOR_SIZE if size else 0
+        else:
+            location = record.inode.extent_location() * SECTOR_SIZE + pack[1] if record.get_data_length() else 0
+        items.append((path, file_hash, size, location))
+    items.sort(key=lambda item: item[3])
+    return items
+
+
+def mount_items(mount, entries, failures):
+    """(udf path, file_hash, size, (path, byte offset)) of the entries on a mounted disc in path order, see
+    image_items"""
+    items = []
+    for path, file_hash, size, pack in entries:
+        local = mount / (path if pack is None else pack[0]).lstrip("/")
+        try:
+            local_size = local.stat().st_size
+        except OSError:
+            failures.append((path, "missing"))
+            continue
+        if pack is None:
+            items.append((path, file_hash, local_size, (str(local), 0)))
+        else:
+            items.append((path, file_hash, size, (str(local), pack[1])))
+    items.sort(key=lambda item: item[3])
+    return items
+
+
+def open_image(source):
+    """Opens an image or a device with pycdlib"""
+    iso = pycdlib.PyCdlib()
+    try:
+        iso.open(str(source))
+    except pycdlib.pycdlibexception.PyCdlibException as e:
+        raise PyArchiveError(f"Cannot open {source} as a disc image: {e}")
+    return iso
+
+
+def _readme_disc_num(source):
+    """Disc number in README.MKD of the disc mounted at source, None if it doesn't say"""
+    try:
+        match = README_DISC_PATTERN.search((source / README_FILENAME).read_text(encoding="utf-8"))
+    except OSError:
+        return None
+    return int(match.group(1)) if match else None
+
+
+def _file_size(source, path):
+    """Size of the file at UDF path on the disc mounted at source, None if there is none"""
+    try:
+        return (source / path.lstrip("/")).stat().st_size
+    except OSError:
+        return None
+
+
+def verify_disc(source, disc_num=None, read_ahead=DEFAULT_READ_AHEAD, quick=False):
+    """Rehashes every file catalogued on the disc in source, a mounted disc (directory), an image or a device.
+    :param disc_num: which disc this is, by default the volume sequence number of an image or, for a mounted
+        disc, the number in its README.MKD or failing that the disc whose files are there
+    :param quick: check the files which have block CRC32s by those alone rather than by their hash
+    :return: VerifyReport
+    """
+    source = Path(source)
+    if source.is_dir():
+        if disc_num is None:
+            disc_num = _readme_disc_num(source)
+        with (source / DB_FILENAME).open(encoding="utf-8") as f:
+            reader = CatalogueReader(f)
+            disc_num, entries, block_crc32 = _disc_entries(reader, disc_num, lambda path: _file_size(source, path))
+        algorithm = catalogue_algorithm(reader)
+        block_size = reader.header.get("block_size")
+        report = VerifyReport(source, disc_num)
+        items = mount_items(source, entries, report.failures)
+        image = None
+    else:
+        iso = open_image(source)
+        try:
+            if disc_num is None:
+                disc_num = iso.pvd.seqnum
+            with iso.open_file_from_iso(udf_path="/" + DB_FILENAME) as f:
+                reader = CatalogueReader(io.TextIOWrapper(io.BufferedReader(f), encoding="utf-8"))
+                disc_num, entries, block_crc32 = _disc_entries(reader, disc_num)
+            algorithm = catalogue_algorithm(reader)
+            block_size = reader.header.get("block_size")
+            report = VerifyReport(source, disc_num)
+            items = image_items(iso, entries, report.failures)
+        finally:
+            iso.close()
+        image = str(source)
+    start = time.perf_counter()
+    reader = ReadAhead(items, image, read_ahead)
+    try:
+        _check(report, items, reader, algorithm, block_crc32, block_size, quick)
+    finally:
+        reader.close()
+    report.seconds = time.perf_counter() - start
+    return report
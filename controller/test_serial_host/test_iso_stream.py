@@ -0,0 +1,88 @@
+"""
+Check that an image streamed through a pipe is the same as the one build_iso writes, with checksum_stream reading
+the pipe as the burner would.  pycdlib stamps the image with the time and a random UDF id so the clock and random
+are pinned while each image is made.
+"""
+import hashlib
+import os
+from pathlib import Path
+import random
+import tempfile
+import threading
+from unittest import mock
+
+import pytest
+
+from pyarchive import Archiver
+from pyarchive.consts import PyArchiveError
+from pyarchive.iso_builder import build_iso
+from pyarchive.iso_stream import checksum_stream, stream_iso
+
+CLOCK = 1500000000.0
+
+
+def make_archive():
+    """Segmented archive of a small random tree in a new working directory, as write_iso expects"""
+    os.chdir(tempfile.mkdtemp())
+    source = Path("source").absolute()
+    rng = random.Random(0)
+    for d in range(3):
+        (source / f"dir{d}").mkdir(parents=True)
+        for i in range(20):
+            (source / f"dir{d}" / f"file{i}.bin").write_bytes(rng.randbytes(rng.randint(0, 200000)))
+    ar = Archiver()
+    ar.create_file_database(source)
+    ar.convert_to_hash_database()
+    ar.segment(3000000)
+    ar.hash_db.save()
+    return ar
+
+
+def pinned(make_image):
+    random.seed(0)
+    with mock.patch("time.time", return_value=CLOCK):
+        return make_image()
+
+
+def stream_through_pipe(plan, read_size=None):
+    """Streams plan into a pipe read by checksum_stream in a thread, or by a reader which gives up after read_size
+    bytes.  Returns (stream_iso result, checksum_stream result)."""
+    r, w = os.pipe()
+    read = {}
+
+    def reader():
+        with os.fdopen(r, "rb") as f:
+            if read_size is None:
+                read["checksum"] = checksum_stream(f)
+            else:
+                f.read(read_size)
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        with os.fdopen(w, "wb", buffering=0) as out:
+            size = stream_iso(plan, out)
+    finally:
+        thread.join()
+    return size, read.get("checksum")
+
+
+def test_stream_matches_build_iso():
+    ar = make_archive()
+    for disc_num in range(ar.last_disc_num):
+        pinned(lambda: build_iso(ar.iso_plan(disc_num), "built.iso"))
+        built = Path("built.iso").read_bytes()
+        size, (count, digest) = pinned(lambda: stream_through_pipe(ar.iso_plan(disc_num)))
+        assert size == count == len(built)
+        assert digest == hashlib.sha512(built).hexdigest()
+
+
+def test_reader_failure():
+    ar = make_archive()
+    with pytest.raises(PyArchiveError, match="Writing the image stream failed"):
+        stream_through_pipe(ar.iso_plan(0), read_size=65536)
+
+
+if __name__ == "__main__":
+    test_stream_matches_build_iso()
+    test_reader_failure()